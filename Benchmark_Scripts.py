@@ -0,0 +1,587 @@
+## Benchmark Scripts
+#
+# Runs Extractor -> Cleaner -> Loader over synthetic tweets against in-process stand-ins for each database,
+# so ingest performance can be measured (and compared between changes) without any database running.
+#
+# Example:
+#     python Benchmark_Scripts.py --sizes 1000 10000 100000 --sinks file mongodb elasticsearch neo4j
+#     python Benchmark_Scripts.py --sizes 100000 --sinks mongodb elasticsearch neo4j multi
+#     python Benchmark_Scripts.py --check-shards
+
+# Import required libraries
+import os
+import shutil
+import json
+import gzip
+import bz2
+import random
+import time
+import tracemalloc
+import argparse
+
+# Optional in-memory MongoDB for the 'mongodb' stand-in
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import elasticsearch
+
+from Clean_Load_Scripts import pyarrow, zstandard, as_document
+from Clean_Load_Scripts import Extractor, Cleaner, Loader, Metrics, NO_METRICS, AdaptiveBatchController
+from Clean_Load_Scripts import MongoDBLoader, Neo4jLoader, ElasticSearchLoader, ParquetLoader, FanOutLoader
+
+
+## Synthetic Data
+
+class TweetGenerator:
+    '''
+    Generates reproducible synthetic tweets with the fields the Cleaner and the loaders touch. The mix
+    of awkward records is tunable: null_place_rate of tweets have place set to null, missing_place_rate
+    have no place key at all, and poi_rate of the places are points of interest (a bounding box with
+    all four corners on the same point). Tweets are drawn from a fixed pool of place_count places and
+    user_count users, so the same places and users repeat the way they do in a real stream. '''
+
+    user_fields = ['name', 'screen_name', 'description', 'location', 'lang', 'time_zone', 'verified', 'utc_offset',
+                   'created_at', 'listed_count', 'friends_count', 'followers_count', 'favourites_count',
+                   'is_translator', 'statuses_count']
+
+    def __init__(self, seed=0, null_place_rate=0.05, missing_place_rate=0.01, poi_rate=0.2, coordinates_rate=0.3,
+                 mentions_per_tweet=1, hashtags_per_tweet=2, place_count=500, user_count=5000):
+        self.seed = seed
+        self.null_place_rate = null_place_rate
+        self.missing_place_rate = missing_place_rate
+        self.poi_rate = poi_rate
+        self.coordinates_rate = coordinates_rate
+        self.mentions_per_tweet = mentions_per_tweet
+        self.hashtags_per_tweet = hashtags_per_tweet
+        self.place_count = place_count
+        self.user_count = user_count
+        self.random = random.Random(seed)
+
+    def make_place(self, place_number):
+        ''' Places are derived from their number alone, so a place always has the same bounding box. '''
+        place_random = random.Random(self.seed * 1000003 + place_number)
+        is_poi = place_random.random() < self.poi_rate
+        west = place_random.uniform(-125.0, -67.0)
+        south = place_random.uniform(25.0, 49.0)
+        if is_poi:
+            east, north = west, south
+        else:
+            east = west + place_random.uniform(0.01, 2.0)
+            north = south + place_random.uniform(0.01, 2.0)
+
+        place = dict()
+        place['id'] = format(place_number, 'x').rjust(16, '0')
+        place['url'] = "https://api.twitter.com/1.1/geo/id/" + place['id'] + ".json"
+        place['place_type'] = "poi" if is_poi else place_random.choice(["city", "neighborhood", "admin"])
+        place['name'] = "Place " + str(place_number)
+        place['full_name'] = "Place " + str(place_number) + ", USA"
+        place['country_code'] = "US"
+        place['country'] = "United States"
+        place['bounding_box'] = dict()
+        place['bounding_box']['type'] = "Polygon"
+        place['bounding_box']['coordinates'] = [[[west, south], [west, north], [east, north], [east, south]]]
+        place['attributes'] = dict()
+        return(place)
+
+    def make_user(self, user_number):
+        user = {field: None for field in self.user_fields}
+        user['id'] = user_number
+        user['id_str'] = str(user_number)
+        user['name'] = "User " + str(user_number)
+        user['screen_name'] = "user" + str(user_number)
+        user['lang'] = "en"
+        user['verified'] = False
+        user['created_at'] = "Mon Jan 01 00:00:00 +0000 2018"
+        user['listed_count'] = user_number % 17
+        user['friends_count'] = user_number % 1009
+        user['followers_count'] = user_number % 2003
+        user['favourites_count'] = user_number % 307
+        user['is_translator'] = False
+        user['statuses_count'] = user_number % 5003
+        return(user)
+
+    def make_tweet(self, tweet_number):
+        rnd = self.random
+        tweet_id = 900000000000000000 + tweet_number
+        user_number = rnd.randrange(self.user_count)
+
+        tweet = dict()
+        tweet['created_at'] = "Mon Jan 01 00:00:00 +0000 2018"
+        tweet['id'] = tweet_id
+        tweet['id_str'] = str(tweet_id)
+        tweet['timestamp_ms'] = str(1514764800000 + tweet_number * 1000)
+        tweet['lang'] = "en"
+        tweet['favorited'] = False
+        tweet['retweeted'] = False
+        tweet['retweet_count'] = 0
+        tweet['favorite_count'] = rnd.randrange(10)
+        tweet['quote_count'] = 0
+        tweet['reply_count'] = 0
+        tweet['user'] = self.make_user(user_number)
+
+        entities = dict()
+        entities['hashtags'] = [{'text': "tag" + str(rnd.randrange(200)), 'indices': [0, 0]}
+                                for i in range(self.hashtags_per_tweet)]
+        entities['user_mentions'] = []
+        for i in range(self.mentions_per_tweet):
+            mentioned = rnd.randrange(self.user_count)
+            entities['user_mentions'].append({'id': mentioned, 'id_str': str(mentioned), 'name': "User " + str(mentioned),
+                                              'screen_name': "user" + str(mentioned), 'indices': [0, 0]})
+        entities['urls'] = []
+        entities['symbols'] = []
+        tweet['entities'] = entities
+        tweet['text'] = "Synthetic tweet " + str(tweet_number) + " " + " ".join("#" + tag['text'] for tag in entities['hashtags'])
+
+        draw = rnd.random()
+        if draw < self.missing_place_rate:
+            pass # no 'place' key at all
+        elif draw < self.missing_place_rate + self.null_place_rate:
+            tweet['place'] = None
+        else:
+            tweet['place'] = self.make_place(rnd.randrange(self.place_count))
+
+        if rnd.random() < self.coordinates_rate and tweet.get('place') is not None:
+            west, south = tweet['place']['bounding_box']['coordinates'][0][0]
+            east, north = tweet['place']['bounding_box']['coordinates'][0][2]
+            tweet['coordinates'] = {'type': "Point", 'coordinates': [rnd.uniform(west, east), rnd.uniform(south, north)]}
+        else:
+            tweet['coordinates'] = None
+        tweet['geo'] = None
+        return(tweet)
+
+    def write_files(self, data_path, record_count, records_per_file=10000, compression=None):
+        ''' Writes record_count tweets as NDJSON files of records_per_file tweets each, the way the
+        Extractor expects to find them. compression can be "gz", "bz2" or "zst" to write compressed
+        files. Returns the list of file names written. '''
+        if not os.path.exists(data_path):
+            os.makedirs(data_path)
+        openers = {None: open, "gz": gzip.open, "bz2": bz2.open, "zst": zstandard.open if zstandard is not None else None}
+        file_names = []
+        tweet_number = 0
+        while tweet_number < record_count:
+            file_name = "tweets_" + str(len(file_names)).rjust(5, '0') + ".json" + ("." + compression if compression else "")
+            with openers[compression](data_path + file_name, "wt") as data_file:
+                for i in range(min(records_per_file, record_count - tweet_number)):
+                    data_file.write(json.dumps(self.make_tweet(tweet_number)))
+                    data_file.write("\n")
+                    tweet_number += 1
+            file_names.append(file_name)
+        return(file_names)
+
+
+## Database Stand-ins
+#
+# The stand-ins accept writes without doing the database's work, so what gets timed is the loader's own
+# cost: batching, flattening records and serializing requests. The 'mongodb' stand-in needs mongomock,
+# which does keep the documents (in memory), so it's much slower than a real server.
+
+class FileSinkLoader:
+    ''' Writes records to an NDJSON file. A baseline for how fast records can be serialized at all. '''
+
+    metrics = NO_METRICS
+
+    counts_failures = True
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.connection = None
+
+    def initialize_connection(self):
+        self.connection = open(self.output_path, "a")
+
+    def load_record(self, record):
+        self.connection.write(json.dumps(as_document(record)))
+        self.connection.write("\n")
+
+    def bulk_load_records(self, record_list):
+        self.connection.write("".join(json.dumps(as_document(record)) + "\n" for record in record_list))
+
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class MockMongoDBLoader(MongoDBLoader):
+    ''' MongoDBLoader backed by a mongomock client instead of a server. mongomock checks a unique index by
+    scanning every document already in the collection, which would make the load quadratic, so the
+    geo_id index isn't created. '''
+
+    def initialize_connection(self):
+        self.build_indexes_after_load = True
+        client_key = MongoDBLoader.client_key('mongodb://' + self.db_host + ':' + self.db_port)
+        if client_key not in MongoDBLoader.clients:
+            MongoDBLoader.clients[client_key] = mongomock.MongoClient()
+        super().initialize_connection()
+
+class FakeNeo4jResult:
+    def consume(self):
+        pass
+
+    def single(self):
+        return({'version': "5.20.0"}) # only used for Neo4jLoader.server_version_query
+
+class FakeNeo4jTransaction:
+    def __init__(self, session):
+        self.session = session
+        self.is_closed = False
+
+    def run(self, statement, parameters=None):
+        for value in (parameters or {}).values():
+            if isinstance(value, list):
+                self.session.rows_written += len(value)
+        return(FakeNeo4jResult())
+
+    def commit(self):
+        self.is_closed = True
+
+    def rollback(self):
+        self.is_closed = True
+
+    def closed(self):
+        return(self.is_closed)
+
+class FakeNeo4jSession:
+    def __init__(self, driver):
+        self.driver = driver
+        self.rows_written = 0
+
+    def run(self, statement, parameters=None):
+        return(FakeNeo4jResult())
+
+    def begin_transaction(self):
+        return(FakeNeo4jTransaction(self))
+
+    def close(self):
+        self.driver.rows_written += self.rows_written
+        self.rows_written = 0
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class FakeNeo4jDriver:
+    def __init__(self):
+        self.rows_written = 0
+
+    def session(self):
+        return(FakeNeo4jSession(self))
+
+    def close(self):
+        pass
+
+class FakeNeo4jLoader(Neo4jLoader):
+    ''' Neo4jLoader with a driver that accepts every transaction. '''
+
+    def initialize_connection(self):
+        self.connection = FakeNeo4jDriver()
+        self.initialize_dimension_cache()
+        if self.create_schema:
+            self.initialize_schema()
+
+class FakeIndicesClient:
+    def __init__(self):
+        self.settings = {"refresh_interval": "1s", "number_of_replicas": "1"}
+
+    def exists(self, index):
+        return(True)
+
+    def create(self, index, body):
+        pass
+
+    def get_settings(self, index):
+        return({index: {'settings': {'index': dict(self.settings)}}})
+
+    def put_settings(self, index, body):
+        self.settings.update(body['index'])
+
+    def refresh(self, index):
+        pass
+
+class FakeElasticsearch:
+    ''' Answers the bulk API with a 'created' item for every action, after the bulk helpers have
+    serialized the request body with the real serializer. '''
+
+    def __init__(self):
+        self.transport = elasticsearch_transport()
+        self.indices = FakeIndicesClient()
+        self.documents_written = 0
+
+    def ping(self):
+        return(True)
+
+    def index(self, index, doc_type, body, id=None, routing=None):
+        self.transport.serializer.dumps(body)
+        self.documents_written += 1
+
+    def bulk(self, body, *args, **kwargs):
+        lines = body.splitlines()
+        items = []
+        for action_line in lines[0::2]:
+            op_type, action = json.loads(action_line).popitem()
+            items.append({op_type: {'_index': action.get('_index'), '_id': action.get('_id'), 'status': 201}})
+        self.documents_written += len(items)
+        return({'took': 0, 'errors': False, 'items': items})
+
+def elasticsearch_transport():
+    ''' The bulk helpers only use the client's transport for its serializer. '''
+    transport = lambda: None
+    transport.serializer = elasticsearch.serializer.JSONSerializer()
+    return(transport)
+
+class FakeElasticSearchLoader(ElasticSearchLoader):
+
+    def initialize_connection(self):
+        self.client = FakeElasticsearch()
+
+class StandInFanOutLoader(FanOutLoader):
+    ''' FanOutLoader over the stand-ins. Each target's db_type is the name of a stand-in sink. '''
+
+    def __init__(self, targets, run_path, metrics=NO_METRICS):
+        super().__init__(targets, metrics=metrics)
+        self.run_path = run_path
+
+    def connect_sink(self, target):
+        loader = Loader(None, None, None, metrics=self.metrics)
+        sink = target.pop('db_type')
+        connect_stand_in(loader, sink, self.run_path, **target)
+        return(loader.db_connection)
+
+# The stand-ins the 'multi' sink writes to at once
+FAN_OUT_SINKS = ("mongodb", "elasticsearch", "neo4j")
+
+def connect_stand_in(loader, sink, run_path, **loader_options):
+    ''' Stand-in counterpart to Loader.get_connection(). The 'multi' sink fans out to the targets
+    option (by default one of each of FAN_OUT_SINKS), with the other loader options going to all of them. '''
+    if sink == "multi":
+        targets = []
+        for target in loader_options.pop('targets', [{"db_type": fan_out_sink} for fan_out_sink in FAN_OUT_SINKS]):
+            target_options = dict(loader_options)
+            target_options.update(target)
+            targets.append(target_options)
+        loader.db_connection = StandInFanOutLoader(targets, run_path, metrics=loader.metrics)
+    if sink == "file":
+        loader.db_connection = FileSinkLoader(run_path + "sink.json")
+    if sink == "mongodb":
+        loader.db_connection = MockMongoDBLoader("localhost", "27017", None, None, "benchmark",
+                                                 os.path.basename(run_path.rstrip("/")), **loader_options)
+    if sink == "neo4j":
+        loader.db_connection = FakeNeo4jLoader("localhost", "7687", None, None, **loader_options)
+    if sink == "elasticsearch":
+        loader.db_connection = FakeElasticSearchLoader("localhost", "9200", "benchmark", **loader_options)
+    if sink == "parquet":
+        loader.db_connection = ParquetLoader(run_path + "dataset/", **loader_options) # the real thing, it's all local
+    loader.db_connection.initialize_connection()
+    loader.db_connection.metrics = loader.metrics
+    if not isinstance(loader.db_connection, FanOutLoader):
+        loader.db_connection.dead_letters = loader.dead_letters.for_sink(sink)
+
+
+## Benchmark
+
+def run_pipeline(data_path, logs_path, sink, mode="batch", chunk_size=5000, vectorized=False, compact=False,
+                 external_decompression=False, extractor_options=None, metrics=NO_METRICS, **loader_options):
+    ''' Extracts, cleans and loads every file in data_path into the given stand-in, the same way the
+    notebooks drive the scripts. mode is 'batch' (whole files) or 'stream' (chunk_size records at a
+    time). compact=True cleans into CompactTweets. extractor_options go to the Extractor (e.g.
+    shard_size). Returns the number of records loaded. '''
+    extractor = Extractor(data_path, logs_path, external_decompression=external_decompression, metrics=metrics,
+                          **(extractor_options or {}))
+    record_count = 0
+    while extractor.next_file_available():
+        if mode == "stream":
+            data_stream, file_name = extractor.get_next_file_stream(chunk_size)
+            cleaner = Cleaner(data_stream, file_name, logs_path, metrics=metrics, compact=compact)
+            cleaned = cleaner.clean_stream(vectorized=vectorized)
+            counted = ChunkCounter(cleaned)
+            loader = Loader(counted, file_name, logs_path, metrics=metrics)
+            connect_stand_in(loader, sink, logs_path, **loader_options)
+            loader.load_stream_data()
+            record_count += counted.record_count
+        else:
+            data, file_name = extractor.get_next_file()
+            cleaner = Cleaner(data, file_name, logs_path, metrics=metrics, compact=compact)
+            cleaned = cleaner.clean_data_vectorized() if vectorized else cleaner.clean_data()
+            loader = Loader(cleaned, file_name, logs_path, metrics=metrics)
+            connect_stand_in(loader, sink, logs_path, **loader_options)
+            loader.load_batch_data()
+            record_count += len(cleaned)
+    extractor.checkpoints.close()
+    return(record_count)
+
+class ChunkCounter:
+    ''' Passes cleaned chunks through while counting the records in them. '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.record_count = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.record_count += len(chunk)
+            yield chunk
+
+def sum_stage_times(metrics_path):
+    ''' Adds up the per-file metrics written to metrics.json into total seconds per stage. '''
+    stage_times = dict()
+    with open(metrics_path) as metrics_file:
+        for line in metrics_file:
+            for stage, stage_metrics in json.loads(line)['stages'].items():
+                stage_times[stage] = stage_times.get(stage, 0.0) + stage_metrics['time']
+    return(stage_times)
+
+def reset_stand_ins():
+    ''' Drops the shared mongomock clients, so one run's documents don't carry over into the next. '''
+    for client_key in list(MongoDBLoader.clients):
+        if mongomock is not None and isinstance(MongoDBLoader.clients[client_key], mongomock.MongoClient):
+            del MongoDBLoader.clients[client_key]
+    MongoDBLoader.indexed_collections.clear()
+
+def benchmark_run(data_path, run_path, sink, measure_memory=True, **run_options):
+    '''
+    Benchmarks one sink over the files in data_path. The pipeline runs once with metrics enabled for
+    throughput and per-stage timings, and (with measure_memory) once more under tracemalloc for the
+    peak memory, since tracing every allocation slows the run down too much to time it. '''
+    if os.path.exists(run_path):
+        shutil.rmtree(run_path)
+    logs_path = run_path + "logs/"
+    metrics = Metrics(logs_path)
+
+    reset_stand_ins()
+    begin = time.time()
+    record_count = run_pipeline(data_path, logs_path, sink, metrics=metrics, **run_options)
+    seconds = time.time() - begin
+
+    result = dict()
+    result['sink'] = sink
+    result['records'] = record_count
+    result['seconds'] = seconds
+    result['records_per_sec'] = record_count / seconds if seconds > 0 else None
+    result['stages'] = sum_stage_times(logs_path + "metrics.json")
+    result['peak_memory_mb'] = None
+
+    if measure_memory:
+        shutil.rmtree(run_path)
+        reset_stand_ins()
+        tracemalloc.start()
+        try:
+            run_pipeline(data_path, logs_path, sink, **run_options)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['peak_memory_mb'] = peak / (1024 * 1024)
+    reset_stand_ins()
+    return(result)
+
+def run_benchmarks(work_path, sizes=(1000, 10000, 100000), sinks=("file", "mongodb", "elasticsearch", "neo4j"),
+                   records_per_file=10000, seed=0, measure_memory=True, generator_options=None, compression=None,
+                   adaptive_batching=False, **run_options):
+    '''
+    Generates size synthetic tweets for every size in sizes (with the same seed, so the runs are
+    comparable between changes) and benchmarks each sink against them. Runs at several sizes show how
+    throughput and memory scale. compression ("gz", "bz2" or "zst") writes the data files compressed.
+    adaptive_batching gives each database stand-in its own AdaptiveBatchController. The "multi" sink
+    loads into the MongoDB, Elasticsearch and Neo4j stand-ins at once with a FanOutLoader.
+    Results are printed as a table and written to benchmark_results.json in work_path. Any extra
+    keyword arguments go to run_pipeline() (mode, chunk_size, vectorized, compact,
+    external_decompression and loader options such as chunk_size for the loaders). '''
+    if not work_path.endswith("/"):
+        work_path += "/"
+    if "mongodb" in sinks and mongomock is None:
+        print("Benchmark: mongomock isn't installed, skipping the mongodb stand-in.")
+        sinks = [sink for sink in sinks if sink != "mongodb"]
+    if "parquet" in sinks and pyarrow is None:
+        print("Benchmark: pyarrow isn't installed, skipping the parquet sink.")
+        sinks = [sink for sink in sinks if sink != "parquet"]
+
+    results = []
+    for size in sizes:
+        data_path = work_path + "data_" + str(size) + "/"
+        if os.path.exists(data_path):
+            shutil.rmtree(data_path)
+        TweetGenerator(seed=seed, **(generator_options or {})).write_files(data_path, size, records_per_file, compression)
+        for sink in sinks:
+            print("Benchmark: " + sink + " with " + str(size) + " records...")
+            sink_options = dict(run_options)
+            if adaptive_batching and sink in ("mongodb", "elasticsearch", "neo4j"):
+                sink_options['batch_controller'] = AdaptiveBatchController()
+            if sink == "multi":
+                sink_options['targets'] = [{"db_type": fan_out_sink} for fan_out_sink in FAN_OUT_SINKS
+                                           if fan_out_sink != "mongodb" or mongomock is not None]
+                if adaptive_batching:
+                    for target in sink_options['targets']:
+                        target['batch_controller'] = AdaptiveBatchController()
+            result = benchmark_run(data_path, work_path + "run_" + sink + "_" + str(size) + "/", sink,
+                                   measure_memory=measure_memory, **sink_options)
+            result['size'] = size
+            results.append(result)
+
+    with open(work_path + "benchmark_results.json", "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print_results(results)
+    return(results)
+
+def check_shards(work_path, record_count=2500, lines_per_shard=1000, index_every=1000):
+    '''
+    Loads one file of record_count tweets as shards of lines_per_shard lines into the file sink, in
+    both batch and stream mode, and checks every record arrives exactly once. The defaults leave a
+    last shard (lines 2000-2500) that doesn't end on an indexed line. Raises AssertionError if a
+    record goes missing or is loaded twice. '''
+    if not work_path.endswith("/"):
+        work_path += "/"
+    data_path = work_path + "data_shards/"
+    if os.path.exists(data_path):
+        shutil.rmtree(data_path)
+    TweetGenerator().write_files(data_path, record_count, record_count)
+    extractor_options = {"shard_size": 1, "lines_per_shard": lines_per_shard, "index_every": index_every}
+    for mode in ("batch", "stream"):
+        run_path = work_path + "run_shards_" + mode + "/"
+        if os.path.exists(run_path):
+            shutil.rmtree(run_path)
+        logs_path = run_path + "logs/"
+        loaded_count = run_pipeline(data_path, logs_path, "file", mode=mode, extractor_options=extractor_options)
+        with open(logs_path + "sink.json") as sink_file:
+            tweet_ids = [json.loads(line)['id'] for line in sink_file]
+        assert loaded_count == record_count, mode + ": loaded " + str(loaded_count) + " of " + str(record_count) + " records"
+        assert len(set(tweet_ids)) == len(tweet_ids) == record_count, mode + ": the sink holds " + str(len(tweet_ids)) \
+            + " records, " + str(len(set(tweet_ids))) + " of them distinct"
+        print("Benchmark: " + mode + " mode loaded all " + str(record_count) + " records from the shards.")
+
+def print_results(results):
+    print("")
+    print("sink".ljust(14) + "records".rjust(10) + "seconds".rjust(10) + "records/sec".rjust(13) + "peak MB".rjust(10))
+    for result in results:
+        peak = result['peak_memory_mb']
+        print(result['sink'].ljust(14) + str(result['records']).rjust(10) + format(result['seconds'], '.2f').rjust(10)
+              + format(result['records_per_sec'] or 0, '.0f').rjust(13)
+              + (format(peak, '.1f') if peak is not None else "-").rjust(10))
+        for stage, seconds in sorted(result['stages'].items()):
+            print("    " + stage.ljust(44) + format(seconds, '.3f').rjust(10) + "s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the extract/clean/load pipeline on synthetic tweets.")
+    parser.add_argument("--work-path", default="./benchmark/")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--sinks", nargs="+", default=["file", "mongodb", "elasticsearch", "neo4j"])
+    parser.add_argument("--records-per-file", type=int, default=10000)
+    parser.add_argument("--mode", choices=["batch", "stream"], default="batch")
+    parser.add_argument("--vectorized", action="store_true")
+    parser.add_argument("--compact", action="store_true", help="clean into CompactTweets")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compression", choices=["gz", "bz2", "zst"], default=None, help="write compressed data files")
+    parser.add_argument("--external-decompression", action="store_true", help="decompress with pigz/lbzip2/zstd processes")
+    parser.add_argument("--adaptive-batching", action="store_true", help="size bulk requests with an AdaptiveBatchController")
+    parser.add_argument("--check-shards", action="store_true", help="check a sharded file loads every record, then exit")
+    args = parser.parse_args()
+    if args.check_shards:
+        check_shards(args.work_path)
+        raise SystemExit(0)
+    run_benchmarks(args.work_path, sizes=args.sizes, sinks=args.sinks, records_per_file=args.records_per_file,
+                   seed=args.seed, compression=args.compression, measure_memory=not args.no_memory, mode=args.mode,
+                   vectorized=args.vectorized, compact=args.compact, external_decompression=args.external_decompression,
+                   adaptive_batching=args.adaptive_batching)
@@ -2,111 +2,1360 @@
 
 # Import required libraries
 import os, fnmatch
+import re
 import json
+import mmap
+from array import array
+from operator import attrgetter
+import multiprocessing
+import threading
+import queue
+import asyncio
+import sqlite3
+import itertools
+import hashlib
+import gzip
+import bz2
+import io
+import shutil
+import subprocess
+from collections import OrderedDict
+import uuid
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from bson import ObjectId
 import pprint
 import time
+import cProfile
+from contextlib import contextmanager
 import requests
 
 # Libraries for Mongo
 import pymongo
 from bson import Binary, Code
 from bson.json_util import dumps
+from pymongo.write_concern import WriteConcern
 
 # Libraries for Neo4j
-from neo4j.v1 import GraphDatabase
+try:
+    from neo4j.v1 import GraphDatabase # neo4j-driver 1.x
+except ImportError:
+    from neo4j import GraphDatabase # neo4j driver 4.x/5.x, which dropped the neo4j.v1 package
+from neo4j.exceptions import TransientError
 #from neo4j.v1 import exceptions
 
 # Libraries for ElasticSearch
 #from elasticsearch import Elasticsearch
 import elasticsearch
+import elasticsearch.helpers
 
 # Geohashing
 # http://www.willmcginnis.com/2016/01/16/pygeohash-1-0-1-fast-gis-geohash-python/
 import pygeohash as pgh
 
+# Vectorized batch cleaning
+import numpy as np
+
+# Optional faster JSON decoders (see get_json_decoder())
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Optional asyncio drivers (see the Async Loaders)
+try:
+    from motor import motor_asyncio
+except ImportError:
+    motor_asyncio = None
+try:
+    from elasticsearch import AsyncElasticsearch # elasticsearch-py 7.8+ with the [async] extra
+except ImportError:
+    try:
+        from elasticsearch_async import AsyncElasticsearch # the add-on package for elasticsearch-py 6.x
+    except ImportError:
+        AsyncElasticsearch = None
+try:
+    from neo4j import AsyncGraphDatabase # neo4j driver 5.x
+except ImportError:
+    AsyncGraphDatabase = None
+
+# Optional columnar export (see ParquetLoader)
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Optional Zstandard support for .json.zst data files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional inotify support for watching the data directory (see Extractor.watch())
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 # Import database passwords
 import secrets
 
+## Metrics
+
+class Metrics:
+    ''' Collects timings for each stage of the pipeline (reading, decoding, each cleaning step, loading),
+    records and bytes processed per stage, and counters such as driver retries. Stage timings go into
+    a latency histogram, and write() appends a summary with records/sec and bytes/sec for every stage
+    as a JSON line to metrics.json in the logs directory.
+
+    A Metrics object created with enabled=False (like NO_METRICS, the default everywhere) does nothing,
+    so the pipeline classes can call it unconditionally. With profile=True (or the CLEANLOAD_PROFILE
+    environment variable set), the whole run is also profiled with cProfile, and write() saves the
+    stats to profile.prof in the logs directory for use with pstats or snakeviz. Worker processes
+    (which inherit the profiler when they're forked, or start their own) save theirs to
+    profile-<pid>.prof instead, so they don't overwrite each other's. '''
+
+    # Upper bounds, in seconds, of the latency histogram buckets; the last bucket catches everything slower
+    histogram_buckets = (0.001, 0.01, 0.1, 1, 10, 100)
+
+    def __init__(self, logs_path=None, enabled=True, profile=None):
+        self.logs_path = logs_path
+        self.enabled = enabled
+        self.stages = dict()
+        self.counters = dict()
+        if profile is None:
+            profile = bool(os.environ.get("CLEANLOAD_PROFILE"))
+        self.profiler = None
+        if enabled and profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def __getstate__(self):
+        # Profilers can't be sent to other processes; worker processes collect their own metrics
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return(state)
+
+    def record(self, stage, seconds, records=0, bytes_processed=0):
+        if not self.enabled:
+            return
+        if stage not in self.stages:
+            self.stages[stage] = {'calls': 0, 'time': 0.0, 'max_time': 0.0, 'records': 0, 'bytes': 0,
+                                  'histogram': [0] * (len(self.histogram_buckets) + 1)}
+        stage_metrics = self.stages[stage]
+        stage_metrics['calls'] += 1
+        stage_metrics['time'] += seconds
+        stage_metrics['max_time'] = max(stage_metrics['max_time'], seconds)
+        stage_metrics['records'] += records
+        stage_metrics['bytes'] += bytes_processed
+        bucket = 0
+        while bucket < len(self.histogram_buckets) and seconds > self.histogram_buckets[bucket]:
+            bucket += 1
+        stage_metrics['histogram'][bucket] += 1
+
+    @contextmanager
+    def timer(self, stage, records=0, bytes_processed=0):
+        ''' Times the body of a with block as one call of the given stage. '''
+        if not self.enabled:
+            yield
+            return
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - begin, records, bytes_processed)
+
+    def increment(self, counter, amount=1):
+        if self.enabled:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def summary(self):
+        summary = dict()
+        for stage, stage_metrics in self.stages.items():
+            stage_summary = dict(stage_metrics)
+            if stage_metrics['time'] > 0:
+                stage_summary['records_per_sec'] = stage_metrics['records'] / stage_metrics['time']
+                stage_summary['bytes_per_sec'] = stage_metrics['bytes'] / stage_metrics['time']
+            summary[stage] = stage_summary
+        return({'stages': summary, 'counters': dict(self.counters), 'histogram_buckets': list(self.histogram_buckets)})
+
+    def write(self, label):
+        ''' Appends the metrics collected since the last write() to metrics.json, labelled (e.g. with
+        the file name), then starts collecting from zero again. '''
+        if not self.enabled or self.logs_path is None:
+            return
+        metrics_dict = self.summary()
+        metrics_dict['label'] = label
+        metrics_dict['time'] = time.time()
+        metrics_log = open(self.logs_path + "/metrics.json", "a+") # open file in append mode
+        metrics_log.write(json.dumps(metrics_dict))
+        metrics_log.write("\n")
+        metrics_log.close()
+        self.stages = dict()
+        self.counters = dict()
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path()) # cumulative for the whole run
+
+    def profile_path(self):
+        if multiprocessing.parent_process() is None:
+            return(self.logs_path + "/profile.prof")
+        return(self.logs_path + "/profile-" + str(os.getpid()) + ".prof")
+
+NO_METRICS = Metrics(enabled=False)
+
+
+## Checkpoint Store
+
+class CheckpointStore:
+    ''' Keeps track of the load state of every data file in a small SQLite database in the logs
+    directory (checkpoint.db). Each file is a row keyed on its name, with a state of 'pending',
+    'in_flight', 'loaded' or 'failed', so marking a file as done is a single indexed update rather
+    than rewriting a list of every remaining file. SQLite's locking makes it safe to share between
+    worker processes, and because the plan lives on disk, a crashed run can be resumed without
+    rescanning the data directory.
+
+    Files loaded into several databases at once (see FanOutLoader) also get a row per sink in the
+    sink_loads table, so a retry only loads a file into the sinks it failed to load into. '''
+
+    PENDING = 'pending'
+    IN_FLIGHT = 'in_flight'
+    LOADED = 'loaded'
+    FAILED = 'failed'
+
+    def __init__(self, logs_path):
+        self.db_path = logs_path + "/checkpoint.db"
+        self.connection = None
+
+    def __getstate__(self):
+        # SQLite connections can't be shared with other processes, so let each process open its own
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return(state)
+
+    def get_connection(self):
+        if self.connection is None:
+            # isolation_level=None puts the connection in autocommit mode; claim_next() opens its own transaction
+            self.connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL") # let readers carry on while a worker is writing
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_name TEXT NOT NULL UNIQUE,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated REAL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_state_index ON files (state, seq)")
+            # What each data file looked like when it was last queued, for incremental scans (see Extractor.scan())
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    file_name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    content_hash TEXT
+                )""")
+            # Entries for changed files that are loaded again from the start (see queue_changes())
+            self.connection.execute("CREATE TABLE IF NOT EXISTS reloads (file_name TEXT PRIMARY KEY)")
+            # Which sinks of a FanOutLoader each file has been loaded into (see set_sink_states())
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS sink_loads (
+                    file_name TEXT NOT NULL,
+                    sink TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    updated REAL,
+                    PRIMARY KEY (file_name, sink)
+                )""")
+        return(self.connection)
+
+    def reset(self, file_names):
+        ''' Throws away any existing checkpoints and marks every file in file_names as pending. '''
+        connection = self.get_connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM files")
+            connection.execute("DELETE FROM fingerprints")
+            connection.execute("DELETE FROM sink_loads")
+            connection.execute("DELETE FROM reloads")
+            connection.executemany("INSERT INTO files (file_name, state, updated) VALUES (?, ?, ?)",
+                                   [(file_name, self.PENDING, time.time()) for file_name in file_names])
+
+    def add_files(self, file_names):
+        ''' Adds files as pending, leaving any files that are already being tracked alone. '''
+        connection = self.get_connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT OR IGNORE INTO files (file_name, state, updated) VALUES (?, ?, ?)",
+                                   [(file_name, self.PENDING, time.time()) for file_name in file_names])
+
+    def get_fingerprints(self):
+        ''' Returns a dictionary of data file name -> (size, mtime, content hash). '''
+        rows = self.get_connection().execute("SELECT file_name, size, mtime, content_hash FROM fingerprints")
+        return({row[0]: (row[1], row[2], row[3]) for row in rows})
+
+    def queue_changes(self, new_files, changed_files, fingerprints):
+        ''' Records the result of an incremental scan in one transaction. new_files and changed_files
+        are dictionaries of data file name -> the names to queue for it (the file itself, or its
+        shards). New files are added as pending, unless they're already being tracked. Changed files
+        have their old entries (and old shards) replaced with pending ones, so they're loaded again,
+        and the new entries are recorded as reloads (see is_reload()). fingerprints is a list of
+        (file name, size, mtime, content hash) to save. '''
+        now = time.time()
+        connection = self.get_connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for file_name, queue_names in changed_files.items():
+                connection.execute("DELETE FROM files WHERE file_name = ? OR substr(file_name, 1, ?) = ?",
+                                   (file_name, len(file_name) + 1, file_name + "@"))
+                connection.execute("DELETE FROM sink_loads WHERE file_name = ? OR substr(file_name, 1, ?) = ?",
+                                   (file_name, len(file_name) + 1, file_name + "@"))
+                connection.execute("DELETE FROM reloads WHERE file_name = ? OR substr(file_name, 1, ?) = ?",
+                                   (file_name, len(file_name) + 1, file_name + "@"))
+                connection.executemany("INSERT INTO files (file_name, state, updated) VALUES (?, ?, ?)",
+                                       [(queue_name, self.PENDING, now) for queue_name in queue_names])
+                connection.executemany("INSERT INTO reloads (file_name) VALUES (?)", [(queue_name,) for queue_name in queue_names])
+            for file_name, queue_names in new_files.items():
+                connection.executemany("INSERT OR IGNORE INTO files (file_name, state, updated) VALUES (?, ?, ?)",
+                                       [(queue_name, self.PENDING, now) for queue_name in queue_names])
+            connection.executemany("INSERT OR REPLACE INTO fingerprints (file_name, size, mtime, content_hash) VALUES (?, ?, ?, ?)",
+                                   fingerprints)
+
+    def has_pending(self):
+        row = self.get_connection().execute("SELECT 1 FROM files WHERE state = ? LIMIT 1", (self.PENDING,)).fetchone()
+        return(row is not None)
+
+    def claim_next(self):
+        ''' Atomically takes the next pending file and marks it as in flight, so concurrent workers
+        never get the same file. Returns None when there's nothing left to load. '''
+        connection = self.get_connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT file_name FROM files WHERE state = ? ORDER BY seq LIMIT 1",
+                                     (self.PENDING,)).fetchone()
+            if row is None:
+                return(None)
+            connection.execute("UPDATE files SET state = ?, attempts = attempts + 1, updated = ? WHERE file_name = ?",
+                               (self.IN_FLIGHT, time.time(), row[0]))
+        return(row[0])
+
+    def set_state(self, file_name, state):
+        self.get_connection().execute("UPDATE files SET state = ?, updated = ? WHERE file_name = ?",
+                                      (state, time.time(), file_name))
+
+    def is_reload(self, file_name):
+        ''' Checks whether a file is being loaded again from the start because it changed after it was
+        first queued, so records from it may already be in the database. '''
+        row = self.get_connection().execute("SELECT 1 FROM reloads WHERE file_name = ?", (file_name,)).fetchone()
+        return(row is not None)
+
+    def set_sink_states(self, file_name, sink_states):
+        ''' Records the state (LOADED or FAILED) of a file in each sink of a FanOutLoader, from a
+        dictionary of sink name -> state. '''
+        now = time.time()
+        self.get_connection().executemany("INSERT OR REPLACE INTO sink_loads (file_name, sink, state, updated) VALUES (?, ?, ?, ?)",
+                                          [(file_name, sink, state, now) for sink, state in sink_states.items()])
+
+    def get_loaded_sinks(self, file_name):
+        ''' Returns the set of sinks a file has already been loaded into. '''
+        rows = self.get_connection().execute("SELECT sink FROM sink_loads WHERE file_name = ? AND state = ?",
+                                             (file_name, self.LOADED))
+        return(set(row[0] for row in rows))
+
+    def get_files(self, state):
+        ''' Returns the names of all files in the given state, in the order they were added. '''
+        rows = self.get_connection().execute("SELECT file_name FROM files WHERE state = ? ORDER BY seq", (state,))
+        return([row[0] for row in rows])
+
+    def get_counts(self):
+        rows = self.get_connection().execute("SELECT state, COUNT(*) FROM files GROUP BY state")
+        return(dict(rows.fetchall()))
+
+    def recover(self):
+        ''' Puts any files that were in flight when a previous run crashed back into the pending state.
+        Only call this when no other run is using the same logs directory. '''
+        self.get_connection().execute("UPDATE files SET state = ?, updated = ? WHERE state = ?",
+                                      (self.PENDING, time.time(), self.IN_FLIGHT))
+
+    def retry_failed(self):
+        ''' Puts any files that failed to load back into the pending state. A file that was loaded into
+        some sinks of a FanOutLoader but not others is only loaded into the others the next time. '''
+        self.get_connection().execute("UPDATE files SET state = ?, updated = ? WHERE state = ?",
+                                      (self.PENDING, time.time(), self.FAILED))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+## Dead Letters
+
+class DeadLetterStore:
+    ''' Keeps the records a loader couldn't write, rather than just counting them, so they can be
+    replayed later without reloading the files they came from (see retry_dead_letters()). Each failed
+    record is appended as a JSON line, with the sink it was meant for and the class and message of
+    the error, to a segment file in logs_path/dead_letters/<sink>/. Once a segment reaches max_bytes a
+    new one is started, and every store writes its own segments, so load workers running in other
+    processes never write to the same file.
+
+    Like Metrics, a DeadLetterStore created with enabled=False (like NO_DEAD_LETTERS, the default for
+    the database loaders) does nothing. Loader.get_connection() gives each loader a store for its sink. '''
+
+    def __init__(self, logs_path=None, sink=None, max_bytes=64 * 1024 * 1024, enabled=True):
+        self.logs_path = logs_path
+        self.sink = sink
+        self.max_bytes = max_bytes
+        self.enabled = enabled and logs_path is not None
+        self.segment_path = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled; a copy in another process starts its own segment
+        state = self.__dict__.copy()
+        del state['lock']
+        state['segment_path'] = None
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def for_sink(self, sink):
+        return(DeadLetterStore(self.logs_path, sink, self.max_bytes, self.enabled))
+
+    def sink_path(self):
+        return(os.path.join(self.logs_path, "dead_letters", self.sink or "default"))
+
+    def add(self, records, error, error_class=None):
+        ''' Dead-letters records that failed with the same error: either the exception, or the error
+        message from the database together with its error_class. '''
+        if error_class is None:
+            error_class = type(error).__name__ if isinstance(error, BaseException) else "Error"
+        self.add_entries([(record, error_class, error) for record in records])
+
+    def add_entries(self, entries):
+        ''' Dead-letters a list of (record, error class, error) entries. '''
+        if not self.enabled or not entries:
+            return
+        now = time.time()
+        lines = []
+        for record, error_class, error in entries:
+            document = dict(as_document(record))
+            document.pop('_id', None) # added by pymongo; the document gets a new one when it's replayed
+            entry = dict()
+            entry['sink'] = self.sink
+            entry['error_class'] = error_class
+            entry['error'] = str(error)[:500]
+            entry['time'] = now
+            entry['record'] = document
+            lines.append(json.dumps(entry, default=str, separators=(',', ':')))
+        with self.lock:
+            if self.segment_path is None:
+                os.makedirs(self.sink_path(), exist_ok=True)
+                self.segment_path = os.path.join(self.sink_path(), str(time.time_ns() // 1000) + "-"
+                                                 + str(os.getpid()) + "-" + uuid.uuid4().hex[:8] + ".ndjson")
+            with open(self.segment_path, "a") as segment:
+                segment.write("\n".join(lines) + "\n")
+                segment_bytes = segment.tell()
+            if segment_bytes >= self.max_bytes:
+                self.segment_path = None # rotate: the next failure starts a new segment
+
+    def segments(self):
+        ''' The segment files for this store's sink, oldest first. '''
+        if not self.enabled or not os.path.isdir(self.sink_path()):
+            return([])
+        return(sorted(os.path.join(self.sink_path(), name) for name in os.listdir(self.sink_path()) if name.endswith(".ndjson")))
+
+    def read_segment(self, segment_path):
+        ''' Yields the entries in a segment, skipping a line left half-written by a crash. '''
+        with open(segment_path) as segment:
+            for line in segment:
+                try:
+                    yield(json.loads(line))
+                except ValueError:
+                    continue
+
+    def get_counts(self):
+        ''' The number of dead-lettered records for this store's sink, by error class. '''
+        counts = dict()
+        for segment_path in self.segments():
+            for entry in self.read_segment(segment_path):
+                counts[entry['error_class']] = counts.get(entry['error_class'], 0) + 1
+        return(counts)
+
+NO_DEAD_LETTERS = DeadLetterStore(enabled=False)
+
+def retry_dead_letters(logs_path, connection_args, chunk_size=5000, metrics=NO_METRICS):
+    ''' Replays the records dead-lettered in logs_path into the database(s) described by
+    connection_args (the keyword arguments for Loader.get_connection(), including db_type "multi",
+    where each target replays its own records). Only the dead-lettered records are sent, in bulk,
+    chunk_size at a time. Each segment is deleted once its records have been sent; any that fail
+    again are dead-lettered again, into a new segment, so don't run it while a load is still writing
+    to the same logs directory. Returns the number of records replayed and the number that failed
+    again per sink. '''
+    loader = Loader(None, None, logs_path, metrics=metrics)
+    loader.get_connection(**connection_args)
+    if isinstance(loader.db_connection, FanOutLoader):
+        sinks = loader.db_connection.sinks
+    else:
+        sinks = {connection_args['db_type']: loader.db_connection}
+
+    results = dict()
+    try:
+        for sink_name, sink in sinks.items():
+            replayed_count = 0
+            failed_count = 0
+            for segment_path in sink.dead_letters.segments():
+                records = [entry['record'] for entry in sink.dead_letters.read_segment(segment_path)]
+                for i in range(0, len(records), chunk_size):
+                    fail_log = sink.bulk_load_records(records[i:i + chunk_size])
+                    if getattr(sink, 'counts_failures', False):
+                        failed_count += sum(failure['count'] for failure in (fail_log or []))
+                if hasattr(sink, 'flush'): # write out what the sink is holding before we delete the segment
+                    failed_count += sum(failure['count'] for failure in (sink.flush() or []))
+                replayed_count += len(records)
+                os.remove(segment_path)
+            print("DeadLetterStore: Replayed " + str(replayed_count) + " records into " + sink_name + ", "
+                  + str(failed_count) + " failed again.")
+            results[sink_name] = {'replayed_count': replayed_count, 'fail_count': failed_count}
+    finally:
+        loader.close_connection()
+        ElasticSearchLoader.restore_all_indices()
+    return(results)
+
+
 ## Extractor
 
+# Large files can be split into shards of whole lines. A shard is tracked in the checkpoint store like any
+# other file, under the name "<file name>@<first line>-<end line>", e.g. "twitter_sample_2017.json@0-100000"
+SHARD_NAME_PATTERN = re.compile(r"^(?P<file_name>.+)@(?P<start>\d+)-(?P<end>\d+)$")
+
+# When an incremental scan finds that a file has only been appended to, just the new bytes are queued,
+# under the name "<file name>@bytes=<first byte>-<end byte>", e.g. "stream.json@bytes=1048576-1310720"
+APPENDED_NAME_PATTERN = re.compile(r"^(?P<file_name>.+)@bytes=(?P<start>\d+)-(?P<end>\d+)$")
+
+# Top-level tweet fields that the Cleaner and the loaders actually read; see get_json_decoder(projection=True)
+PROJECTED_FIELDS = ('id', 'id_str', 'timestamp_ms', 'created_at', 'text', 'lang', 'favorited', 'retweeted',
+                    'retweet_count', 'favorite_count', 'quote_count', 'reply_count', 'coordinates', 'place',
+                    'user', 'entities')
+
+def get_json_decoder(decoder="auto", projection=False):
+    ''' Returns a function that decodes one line of JSON into a dictionary. decoder can be "simdjson",
+    "orjson", "json" (the standard library), "auto" to use the fastest one that's installed, or a
+    function of your own.
+
+    With projection=True, only the PROJECTED_FIELDS are kept, which saves memory for every record we
+    hold on to. simdjson parses lazily, so with it we also skip the work of building Python objects
+    for all the fields we don't need. Note that MongoDB and Elasticsearch will then only store the
+    projected fields. '''
+    if callable(decoder):
+        decode = decoder
+    elif decoder == "auto":
+        if projection and simdjson is not None:
+            return(get_json_decoder("simdjson", projection))
+        elif orjson is not None:
+            return(get_json_decoder("orjson", projection))
+        else:
+            return(get_json_decoder("json", projection))
+    elif decoder == "simdjson":
+        # A simdjson Parser isn't thread-safe, and each parse() invalidates the objects returned by the
+        # one before, so every thread that decodes with this function gets a parser of its own
+        parsers = threading.local()
+        def decode_lazily(line):
+            parser = getattr(parsers, 'parser', None)
+            if parser is None:
+                parser = parsers.parser = simdjson.Parser()
+            document = parser.parse(line)
+            if not projection:
+                return(document.as_dict())
+            projected = dict()
+            for field in PROJECTED_FIELDS:
+                if field in document:
+                    value = document[field]
+                    if isinstance(value, simdjson.Object):
+                        value = value.as_dict()
+                    elif isinstance(value, simdjson.Array):
+                        value = value.as_list()
+                    projected[field] = value
+            return(projected)
+        return(decode_lazily)
+    elif decoder == "orjson":
+        decode = orjson.loads
+    elif decoder == "json":
+        decode = json.loads
+    else:
+        raise ValueError("Unknown JSON decoder: " + str(decoder))
+
+    if not projection:
+        return(decode)
+    def decode_and_project(line):
+        record = decode(line)
+        return({field: record[field] for field in PROJECTED_FIELDS if field in record})
+    return(decode_and_project)
+
+
+# Data files are newline-delimited JSON, optionally compressed
+DATA_FILE_TYPES = ("*.json", "*.json.gz", "*.json.bz2", "*.json.zst")
+
+# External decompressors, fastest first, for open_data_file(..., external_decompression=True)
+DECOMPRESSION_COMMANDS = {
+    ".gz": (["pigz", "-dc"], ["gzip", "-dc"]),
+    ".bz2": (["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]),
+    ".zst": (["zstd", "-dc"],)
+}
+
+@contextmanager
+def open_data_file(file_path, external_decompression=False):
+    ''' Opens a data file for reading as text, decompressing .gz, .bz2 and .zst files on the fly as
+    they're read, so they never have to be unpacked to disk. With external_decompression=True, a
+    compressed file is decompressed by a command-line tool (pigz, lbzip2, zstd, ...) in a separate
+    process, which runs in parallel with the parsing, instead of in this one. Falls back to
+    decompressing in this process if none of the tools is installed. '''
+    extension = os.path.splitext(file_path)[1]
+    command = None
+    if external_decompression and extension in DECOMPRESSION_COMMANDS:
+        for candidate in DECOMPRESSION_COMMANDS[extension]:
+            if shutil.which(candidate[0]) is not None:
+                command = candidate
+                break
+
+    if command is not None:
+        process = subprocess.Popen(command + [file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   bufsize=1 << 20)
+        # Drain stderr as it's written, so a tool that writes a lot of warnings can't fill the pipe
+        # and stall while we wait on its stdout
+        error_output = []
+        error_reader = threading.Thread(target=lambda: error_output.append(process.stderr.read()), daemon=True)
+        error_reader.start()
+        try:
+            yield io.TextIOWrapper(process.stdout, encoding="utf-8")
+        finally:
+            # If there's still output waiting, the reader stopped before the end of the file. Closing
+            # the pipe then kills the tool with SIGPIPE (or makes it exit with an error), which isn't
+            # a decompression failure
+            try:
+                read_to_end = process.stdout.peek(1) == b""
+            except ValueError:
+                read_to_end = False
+            process.stdout.close()
+            return_code = process.wait()
+            error_reader.join()
+            process.stderr.close()
+        if return_code != 0 and read_to_end:
+            raise IOError(command[0] + " couldn't decompress " + file_path + ": " + b"".join(error_output).decode(errors="replace").strip())
+        return
+
+    if extension == ".gz":
+        data_file = gzip.open(file_path, "rt", encoding="utf-8")
+    elif extension == ".bz2":
+        data_file = bz2.open(file_path, "rt", encoding="utf-8")
+    elif extension == ".zst":
+        if zstandard is None:
+            raise ImportError("Reading .json.zst files needs the zstandard package: pip install zstandard")
+        data_file = zstandard.open(file_path, "rt", encoding="utf-8")
+    else:
+        data_file = open(file_path, "r")
+    try:
+        yield data_file
+    finally:
+        data_file.close()
+
+def is_compressed(file_name):
+    return(os.path.splitext(file_name)[1] in DECOMPRESSION_COMMANDS)
+
+
 class Extractor:
-    ''' Takes a folder name and a logs directory path and initializes a log file containing the name of
-    every file in the target folder.  Contains methods for checking which files in the log have not yet
-    been loaded and getting and reading in the next available file. '''
+    ''' Takes a folder name and a logs directory path and initializes a checkpoint store containing the name of
+    every file in the target folder.  Contains methods for checking which files in the store have not yet
+    been loaded and getting and reading in the next available file. Lines are decoded with the
+    decoder chosen by get_json_decoder(decoder, projection).
+
+    Data files can be compressed (.json.gz, .json.bz2 or .json.zst); they're decompressed as they're
+    read (see open_data_file()). Compressed files are always loaded whole, since sharding needs to
+    jump to a line in the middle of the file.
+
+    With incremental=True, the checkpoints and logs from earlier runs are kept, and only files that are
+    new or have changed since they were last queued are added (see scan()). Use watch() to keep
+    picking up files as they arrive. '''
 
-    def __init__(self, data_path, logs_path, initialize=True):
+    def __init__(self, data_path, logs_path, initialize=True, decoder="auto", projection=False,
+                 shard_size=None, lines_per_shard=100000, index_every=1000, incremental=False,
+                 hash_content=True, settle_time=5, external_decompression=False, metrics=NO_METRICS):
         self.data_path = data_path
         self.logs_path = logs_path
+        self.metrics = metrics
+        self.decoder = decoder
+        self.projection = projection
+        self.decode = get_json_decoder(decoder, projection)
+        self.shard_size = shard_size
+        self.lines_per_shard = lines_per_shard
+        self.index_every = index_every
+        self.hash_content = hash_content
+        self.settle_time = settle_time
+        self.external_decompression = external_decompression
 
         # Create a directory to store the log files, if necessary
         logs_dir = os.path.dirname(self.logs_path)
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
 
-        # If we're in the initialize state, create a 'files_to_load.txt' file,
-        # then write the name of every file in the directory to this file
-        if initialize:
-            files_to_load_log  = open(self.logs_path + "/files_to_load.txt", "w")
-            data_files_list = os.listdir(self.data_path)
-            file_type = "*.json"
-            for file in data_files_list:
-                if fnmatch.fnmatch(file, file_type):
-                    files_to_load_log.write(file)
-                    files_to_load_log.write("\n")
-            files_to_load_log.close()
+        self.checkpoints = CheckpointStore(self.logs_path)
+
+        if incremental:
+            # Keep what earlier runs did and queue only the files that are new or have changed since
+            self.checkpoints.recover()
+            self.scan()
+        # If we're in the initialize state, mark the name of every file in the directory as pending in
+        # the checkpoint store
+        elif initialize:
+            files_to_load = []
+            for entry in self.data_file_entries():
+                files_to_load.extend(self.plan_file(entry.name, entry.stat().st_size))
+            self.checkpoints.reset(files_to_load)
 
             # Also delete any existing logs that may still be lying around
             if os.path.exists(self.logs_path + "cleaning_log.txt"):
                 os.remove(self.logs_path + "cleaning_log.txt")
             if os.path.exists(self.logs_path + "loaded_files.txt"):
                 os.remove(self.logs_path + "loaded_files.txt")
+        else:
+            # Resuming: anything that was in flight when the last run stopped needs to be loaded again
+            self.checkpoints.recover()
+
+    def data_file_entries(self):
+        ''' Returns an os.DirEntry for every data file in the data directory. '''
+        with os.scandir(self.data_path) as entries:
+            return([entry for entry in entries
+                    if any(fnmatch.fnmatch(entry.name, file_type) for file_type in DATA_FILE_TYPES) and entry.is_file()])
+
+    def plan_file(self, file_name, file_size):
+        ''' Returns the names to queue for a data file: the file itself, or its shards. '''
+        # Files bigger than shard_size bytes are loaded as several shards instead of one file
+        if self.shard_size is not None and file_size > self.shard_size and not is_compressed(file_name):
+            return(self.plan_shards(file_name))
+        return([file_name])
+
+    def scan(self):
+        ''' Incremental counterpart to initializing the checkpoint store. Compares every data file with
+        the fingerprint (size, modification time and content hash) saved when it was last queued, and
+        queues the files that are new or have changed. Files whose size and modification time haven't
+        changed aren't read at all; if only the modification time changed and the content hash still
+        matches, the file isn't queued again.
+
+        A file that has grown, and whose first bytes (up to its old size) still hash to the saved
+        content hash, has only been appended to: just the new bytes are queued (see
+        APPENDED_NAME_PATTERN), leaving what was already loaded alone. Any other change replaces the
+        file's old entries in the checkpoint store, and the file is loaded again from the start, which
+        the Loader only does in idempotent mode (see Loader.force_idempotent_reload()).
+
+        Files modified in the last settle_time seconds are assumed to still be being written and are
+        left for a later scan. Files that have disappeared are left alone. Returns the names of the data
+        files that were queued. '''
+        known_fingerprints = self.checkpoints.get_fingerprints()
+        settled_before = time.time() - self.settle_time
+        new_files = dict()
+        appended_files = dict()
+        changed_files = dict()
+        fingerprints = []
+        # Oldest first, so files are loaded in the order they arrived
+        for entry in sorted(self.data_file_entries(), key=lambda entry: (entry.stat().st_mtime, entry.name)):
+            stat = entry.stat()
+            if stat.st_mtime > settled_before:
+                continue
+            known = known_fingerprints.get(entry.name)
+            if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+                continue
+            content_hash = None
+            appended = False
+            if self.hash_content and known is not None and known[2] is not None and stat.st_size > known[0] \
+                    and not is_compressed(entry.name):
+                prefix_hash, content_hash = self.hash_file(entry.name, prefix_size=known[0])
+                appended = prefix_hash == known[2] and self.ends_line(entry.name, known[0])
+            elif self.hash_content:
+                content_hash = self.hash_file(entry.name)
+            fingerprints.append((entry.name, stat.st_size, stat.st_mtime, content_hash))
+            if known is None:
+                new_files[entry.name] = self.plan_file(entry.name, stat.st_size)
+            elif appended:
+                appended_files[entry.name] = [entry.name + "@bytes=" + str(known[0]) + "-" + str(stat.st_size)]
+            elif content_hash is None or content_hash != known[2]:
+                # The saved line offset index only notices a change in size, so throw it away
+                index_path = self.logs_path + "/" + entry.name + ".idx"
+                if os.path.exists(index_path):
+                    os.remove(index_path)
+                changed_files[entry.name] = self.plan_file(entry.name, stat.st_size)
+
+        # Appended bytes are new entries of their own, so they're queued like new files
+        queued_files = dict(new_files)
+        queued_files.update(appended_files)
+        self.checkpoints.queue_changes(queued_files, changed_files, fingerprints)
+        if new_files or appended_files or changed_files:
+            print("Extractor: Queued " + str(len(new_files)) + " new, " + str(len(appended_files)) + " appended and "
+                  + str(len(changed_files)) + " changed files.")
+        return(list(new_files) + list(appended_files) + list(changed_files))
+
+    def hash_file(self, file_name, block_size=1 << 20, prefix_size=None):
+        ''' Returns the content hash of a data file. With prefix_size, returns the hash of its first
+        prefix_size bytes too, as (prefix hash, content hash), from the same read. '''
+        with self.metrics.timer("extract.fingerprint"):
+            content_hash = hashlib.blake2b(digest_size=16)
+            prefix_hash = None
+            position = 0
+            with open(self.data_path + file_name, "rb") as data_file:
+                for block in iter(lambda: data_file.read(block_size), b""):
+                    if prefix_size is not None and prefix_hash is None and position + len(block) >= prefix_size:
+                        content_hash.update(block[:prefix_size - position])
+                        prefix_hash = content_hash.hexdigest()
+                        content_hash.update(block[prefix_size - position:])
+                    else:
+                        content_hash.update(block)
+                    position += len(block)
+        if prefix_size is not None:
+            return(prefix_hash, content_hash.hexdigest())
+        return(content_hash.hexdigest())
+
+    def ends_line(self, file_name, position):
+        ''' Checks that the byte before position is a newline, so the bytes from position on start a new line. '''
+        with open(self.data_path + file_name, "rb") as data_file:
+            data_file.seek(position - 1)
+            return(data_file.read(1) == b"\n")
+
+    def watch(self, interval=60, max_scans=None):
+        ''' Generator for continuous ingestion. Runs scan() every interval seconds (up to max_scans
+        times, or forever) and yields the list of queued files whenever a scan finds any, e.g.
+
+            for queued_files in extractor.watch(interval=30):
+                while extractor.next_file_available():
+                    data, file_name = extractor.get_next_file()
+                    ...
+
+        With inotify_simple installed (Linux only), a scan also runs as soon as a file is written
+        and closed in, or moved into, the data directory, instead of waiting out the interval. '''
+        inotify = None
+        if inotify_simple is not None:
+            inotify = inotify_simple.INotify()
+            inotify.add_watch(self.data_path, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+        scan_count = 0
+        try:
+            while max_scans is None or scan_count < max_scans:
+                if scan_count > 0:
+                    if inotify is not None:
+                        if inotify.read(timeout=int(interval * 1000)):
+                            time.sleep(self.settle_time) # let the new file settle, or scan() will skip it
+                    else:
+                        time.sleep(interval)
+                queued_files = self.scan()
+                scan_count += 1
+                if queued_files:
+                    yield queued_files
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def __getstate__(self):
+        # The decoder may hold a parser that can't be sent to another process; rebuild it on the other side
+        state = self.__dict__.copy()
+        del state['decode']
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.decode = get_json_decoder(self.decoder, self.projection)
 
     def next_file_available(self):
-        ''' Checks if there's another file available in the files_to_load.txt log. If there's a
+        ''' Checks if there's another pending file in the checkpoint store. If there's a
         file available, returns True. If no files are remaining, returns False so we can stop
         reading in data. '''
-        files_to_load_log  = open(self.logs_path + "/files_to_load.txt", "r")
-        next_file_name = files_to_load_log.readline().rstrip("\n")
-        if next_file_name == '':
-            return(False)
-        else:
-            return(True)
+        return(self.checkpoints.has_pending())
+
+    def get_files_to_load(self):
+        ''' Returns the names of all files still pending in the checkpoint store, in order. '''
+        return(self.checkpoints.get_files(CheckpointStore.PENDING))
 
     def get_next_file(self):
-        ''' Reads from the files_to_load.txt file and gets the name of the next file in the list.
+        ''' Claims the next pending file from the checkpoint store (marking it as in flight).
         Calls read_file() to read in the target file in as list of dictionaries. Returns a tuple
         that includes the list of dictionaries representing the JSON data, along with the filename
         so we can keep track of this file in subsequent tasks. '''
-        files_to_load_log  = open(self.logs_path + "/files_to_load.txt", "r")
-        next_file_name = files_to_load_log.readline().rstrip("\n") # strip the newline character from the end of filename
+        next_file_name = self.checkpoints.claim_next()
         print("Extractor: Next file is: " + next_file_name)
+        if SHARD_NAME_PATTERN.match(next_file_name) or APPENDED_NAME_PATTERN.match(next_file_name):
+            shard_data = []
+            for chunk in self.stream_file(next_file_name):
+                shard_data.extend(chunk)
+            return(shard_data, next_file_name)
         next_file_path = self.data_path + next_file_name
         return(self.read_data_file(next_file_path), next_file_name)
 
     def read_data_file(self, file_to_read):
         ''' Reads the JSON-formatted file line by line and returns each line as a dictionary. '''
         print("Extractor: Reading file: " + file_to_read)
-        reading_file = open(file_to_read, "r") # open as read-only
+        with open_data_file(file_to_read, self.external_decompression) as reading_file:
+            with self.metrics.timer("extract.read"):
+                lines = reading_file.readlines()
         list_of_jsondicts = []
-        for line in reading_file.readlines():
-            list_of_jsondicts.append(json.loads(line))
+        with self.metrics.timer("extract.decode", len(lines), sum(len(line) for line in lines) if self.metrics.enabled else 0):
+            for line in lines:
+                list_of_jsondicts.append(self.decode(line))
         print("Extractor: Read " + str(len(list_of_jsondicts)) + " data rows.")
         return(list_of_jsondicts)
 
+    def get_next_file_stream(self, chunk_size=5000):
+        ''' Streaming counterpart to get_next_file(). Instead of reading the whole file into memory,
+        returns a generator that yields lists of at most chunk_size dictionaries, along with the
+        filename. Pass the generator to Cleaner.clean_stream() and on to Loader.load_stream_data()
+        so only one chunk of the file is held in memory at a time. '''
+        next_file_name = self.checkpoints.claim_next()
+        print("Extractor: Next file is: " + next_file_name)
+        return(self.stream_file(next_file_name, chunk_size), next_file_name)
+
+    def stream_file(self, file_name, chunk_size=5000):
+        ''' Streams either a whole data file or, if file_name is a shard name, just that shard, or the
+        bytes appended to a file if it's one of those. '''
+        if SHARD_NAME_PATTERN.match(file_name):
+            return(self.stream_shard(file_name, chunk_size))
+        if APPENDED_NAME_PATTERN.match(file_name):
+            return(self.stream_appended(file_name, chunk_size))
+        return(self.stream_data_file(self.data_path + file_name, chunk_size))
+
+    def stream_data_file(self, file_to_read, chunk_size=5000):
+        ''' Reads the JSON-formatted file one line at a time and yields the parsed dictionaries in
+        lists of at most chunk_size records. Blank lines are skipped. '''
+        print("Extractor: Streaming file: " + file_to_read)
+        row_count = 0
+        lines = []
+        with open_data_file(file_to_read, self.external_decompression) as reading_file:
+            read_begin = time.perf_counter()
+            for line in reading_file:
+                if not line.strip():
+                    continue
+                lines.append(line)
+                if len(lines) >= chunk_size:
+                    self.metrics.record("extract.read", time.perf_counter() - read_begin)
+                    row_count += len(lines)
+                    yield self.decode_chunk(lines)
+                    lines = []
+                    read_begin = time.perf_counter()
+            self.metrics.record("extract.read", time.perf_counter() - read_begin)
+        if lines:
+            row_count += len(lines)
+            yield self.decode_chunk(lines)
+        print("Extractor: Streamed " + str(row_count) + " data rows.")
+
+    def decode_chunk(self, lines):
+        with self.metrics.timer("extract.decode", len(lines), sum(len(line) for line in lines) if self.metrics.enabled else 0):
+            return([self.decode(line) for line in lines])
+
+    def build_offset_index(self, file_name):
+        ''' Memory-maps a newline-delimited data file and records the byte offset of every
+        index_every-th line, so we can jump straight to any line without reading what comes before it.
+        The index is saved next to the logs as "<file name>.idx" (an array of unsigned 64-bit integers:
+        the file size, index_every and the line count, followed by the offsets) and reused as long as
+        the file size and index_every haven't changed. Returns (offsets, line_count). '''
+        file_path = self.data_path + file_name
+        index_path = self.logs_path + "/" + file_name + ".idx"
+        file_size = os.path.getsize(file_path)
+
+        if os.path.exists(index_path):
+            saved_index = array('Q')
+            with open(index_path, "rb") as index_file:
+                saved_index.frombytes(index_file.read())
+            if len(saved_index) >= 3 and saved_index[0] == file_size and saved_index[1] == self.index_every:
+                return(saved_index[3:], saved_index[2])
+
+        print("Extractor: Building line offset index for: " + file_path)
+        offsets = array('Q', [0])
+        line_count = 0
+        if file_size > 0:
+            with open(file_path, "rb") as data_file, mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                position = 0
+                while position < file_size:
+                    newline = mapped_file.find(b"\n", position)
+                    position = file_size if newline == -1 else newline + 1
+                    line_count += 1
+                    if line_count % self.index_every == 0 and position < file_size:
+                        offsets.append(position)
+
+        saved_index = array('Q', [file_size, self.index_every, line_count])
+        saved_index.extend(offsets)
+        with open(index_path, "wb") as index_file:
+            index_file.write(saved_index.tobytes())
+        return(offsets, line_count)
+
+    def plan_shards(self, file_name):
+        ''' Splits a data file into shards of lines_per_shard lines (rounded up to a multiple of
+        index_every, so every shard starts on an indexed line) and returns their shard names. '''
+        offsets, line_count = self.build_offset_index(file_name)
+        lines_per_shard = -(-self.lines_per_shard // self.index_every) * self.index_every
+        shard_names = []
+        for start in range(0, line_count, lines_per_shard):
+            end = min(start + lines_per_shard, line_count)
+            shard_names.append(file_name + "@" + str(start) + "-" + str(end))
+        print("Extractor: Split " + file_name + " into " + str(len(shard_names)) + " shards.")
+        return(shard_names)
+
+    def stream_shard(self, shard_name, chunk_size=5000):
+        ''' Like stream_data_file(), but only for the lines in one shard. Uses the offset index to find
+        the shard's byte range and reads it straight out of the memory-mapped file, so any number of
+        workers can read different shards of the same file at once. '''
+        shard = SHARD_NAME_PATTERN.match(shard_name)
+        file_name = shard.group('file_name')
+        start_line, end_line = int(shard.group('start')), int(shard.group('end'))
+        offsets, line_count = self.build_offset_index(file_name)
+        file_path = self.data_path + file_name
+        file_size = os.path.getsize(file_path)
+        start_byte = offsets[start_line // self.index_every]
+        # Every shard but the last ends on an indexed line and the last one runs to the end of the file,
+        # unless lines have been appended to the file since it was split
+        if end_line >= line_count:
+            end_byte = file_size
+        else:
+            end_byte = self.line_offset(file_path, offsets, end_line)
+        print("Extractor: Streaming shard: " + shard_name)
+        yield from self.stream_byte_range(file_path, start_byte, end_byte, chunk_size)
+
+    def line_offset(self, file_path, offsets, line_number):
+        ''' Returns the byte offset of a line, from the nearest indexed line before it. '''
+        position = offsets[line_number // self.index_every]
+        with open(file_path, "rb") as data_file, mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            for i in range(line_number % self.index_every):
+                position = mapped_file.find(b"\n", position) + 1
+        return(position)
+
+    def stream_appended(self, appended_name, chunk_size=5000):
+        ''' Like stream_data_file(), but only for the bytes appended to a file (see scan()). '''
+        appended = APPENDED_NAME_PATTERN.match(appended_name)
+        print("Extractor: Streaming appended lines: " + appended_name)
+        yield from self.stream_byte_range(self.data_path + appended.group('file_name'), int(appended.group('start')),
+                                          int(appended.group('end')), chunk_size)
+
+    def stream_byte_range(self, file_path, start_byte, end_byte, chunk_size=5000):
+        ''' Reads the lines between two byte offsets straight out of the memory-mapped file and yields
+        the parsed dictionaries in lists of at most chunk_size records. '''
+        row_count = 0
+        lines = []
+        with open(file_path, "rb") as data_file, mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            position = start_byte
+            read_begin = time.perf_counter()
+            while position < end_byte:
+                newline = mapped_file.find(b"\n", position, end_byte)
+                line_end = end_byte if newline == -1 else newline
+                line = mapped_file[position:line_end]
+                position = line_end + 1
+                if not line.strip():
+                    continue
+                lines.append(line)
+                if len(lines) >= chunk_size:
+                    self.metrics.record("extract.read", time.perf_counter() - read_begin)
+                    row_count += len(lines)
+                    yield self.decode_chunk(lines)
+                    lines = []
+                    read_begin = time.perf_counter()
+            self.metrics.record("extract.read", time.perf_counter() - read_begin)
+        if lines:
+            row_count += len(lines)
+            yield self.decode_chunk(lines)
+        print("Extractor: Streamed " + str(row_count) + " data rows.")
+
+
+## Dimension Cache
+
+class LRUCache:
+    ''' A dictionary that holds at most max_size entries, dropping the least recently used entry when
+    it's full. Used to remember places and users we've already cleaned or written, since thousands of
+    tweets share the same few. A max_size of 0 turns the cache off. '''
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return(self.entries[key])
+        self.misses += 1
+        return(default)
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return(len(self.entries))
+
+
+## Field Mapping
+
+class FieldMapping:
+    '''
+    A declarative list of the fields to pull out of a cleaned record, compiled once into plain Python
+    functions instead of being looked up field by field for every record. Each field is a (name, path)
+    pair, where the path is a dotted list of keys and list indices into the record, e.g.
+    "place.better_bounding_box.coordinates.0.2.1". Two markers are allowed in a path:
+
+        key?   looks the key up with get(), and if the value is None (or the key is missing), the rest
+               of the path isn't followed and the field is None, e.g. "coordinates?.coordinates.0"
+        *      applies the rest of the path to every item of a list, e.g. "entities.hashtags.*.text?"
+
+    The generated code looks up every shared part of the paths once per record (so "place" and
+    "place.better_bounding_box.coordinates.0" aren't repeated for each place field) and builds the row
+    with a single dictionary (or tuple) display. extract() returns a dictionary and extract_values() a
+    tuple in field order. For a list of records, extract_batch() returns a list of dictionaries and
+    extract_columns() a tuple with a list of values per field, with the loop inside the generated
+    function. The source is kept in self.source for inspection. Loaders take their columns from one
+    shared mapping with select() (see TWEET_FIELDS). '''
+
+    def __init__(self, fields):
+        self.paths = dict(fields)
+        self.fields = [(name, self.parse_path(path)) for name, path in fields]
+        self.names = tuple(name for name, path in fields)
+        self.source = self.generate_source()
+        namespace = dict()
+        exec(compile(self.source, "<FieldMapping>", "exec"), namespace)
+        self.extract = namespace['extract']
+        self.extract_values = namespace['extract_values']
+        self.extract_batch = namespace['extract_batch']
+        self.extract_columns = namespace['extract_columns']
+
+    def select(self, names, paths=None):
+        ''' Compiles a FieldMapping of just the named fields, in the given order. paths is an optional
+        dictionary of name -> path, for fields that are read differently (or that this mapping doesn't
+        have). '''
+        if paths is None:
+            paths = dict()
+        return(FieldMapping([(name, paths[name] if name in paths else self.paths[name]) for name in names]))
+
+    def fields_under(self, parent=None):
+        ''' (name, key) for every field whose path is a single key of the record's parent dictionary,
+        or of the record itself if parent is None, in field order. '''
+        depth = 1 if parent is None else 2
+        fields = []
+        for name, segments in self.fields:
+            if len(segments) == depth and (parent is None or segments[0][0] == parent):
+                fields.append((name, segments[-1][0]))
+        return(fields)
+
+    @staticmethod
+    def parse_path(path):
+        segments = []
+        for part in path.split("."):
+            optional = part.endswith("?")
+            key = part[:-1] if optional else part
+            if key.isdigit():
+                key = int(key)
+            segments.append((key, optional))
+        return(tuple(segments))
+
+    @staticmethod
+    def access(variable, segment):
+        key, optional = segment
+        if optional:
+            return(variable + ".get(" + repr(key) + ")")
+        return(variable + "[" + repr(key) + "]")
+
+    def generate_bindings(self):
+        ''' Works out a local variable for every path prefix where the paths of several fields part
+        ways (and for every prefix that can be None, so it can be checked). Returns the assignment
+        statements, in dependency order, and an expression for each field. '''
+        uses = dict()
+        for name, segments in self.fields:
+            for length in range(1, len(segments)):
+                uses[segments[:length]] = uses.get(segments[:length], 0) + 1
+        # A prefix that every one of its fields continues through to the same next key needn't be kept
+        passed_through = set()
+        for prefix, count in uses.items():
+            if len(prefix) > 1 and count == uses[prefix[:-1]]:
+                passed_through.add(prefix[:-1])
+
+        variables = {(): ('record', False)} # path prefix -> (variable name or expression, whether it can be None)
+        statements = []
+
+        def bind(prefix):
+            if prefix not in variables:
+                parent, nullable = bind(prefix[:-1])
+                expression = self.access(parent, prefix[-1])
+                if nullable:
+                    expression = "(" + expression + " if " + parent + " is not None else None)"
+                if nullable or prefix[-1][1] or (uses.get(prefix, 0) > 1 and prefix not in passed_through):
+                    variable = "v" + str(len(statements))
+                    statements.append(variable + " = " + expression)
+                    expression = variable
+                variables[prefix] = (expression, nullable or prefix[-1][1])
+            return(variables[prefix])
+
+        expressions = []
+        for name, segments in self.fields:
+            keys = [key for key, optional in segments]
+            if '*' in keys:
+                star = keys.index('*')
+                parent, nullable = bind(segments[:star])
+                item_expression = "item"
+                for i, segment in enumerate(segments[star + 1:]):
+                    if segment[1] and star + 1 + i != len(segments) - 1:
+                        raise ValueError("FieldMapping: Only the last key after a * can be optional: " + name)
+                    item_expression = self.access(item_expression, segment)
+                expression = "[" + item_expression + " for item in " + parent + "]"
+            else:
+                parent, nullable = bind(segments[:-1])
+                expression = self.access(parent, segments[-1])
+            if nullable:
+                expression = "(" + expression + " if " + parent + " is not None else None)"
+            expressions.append(expression)
+        return(statements, expressions)
+
+    def generate_source(self):
+        statements, expressions = self.generate_bindings()
+        row_dict = "{" + ", ".join(repr(name) + ": " + expression for name, expression in zip(self.names, expressions)) + "}"
+        row_tuple = "(" + "".join(expression + ", " for expression in expressions) + ")"
+        lines = ["def extract(record):"]
+        lines += ["    " + statement for statement in statements]
+        lines += ["    return(" + row_dict + ")", "", "def extract_values(record):"]
+        lines += ["    " + statement for statement in statements]
+        lines += ["    return(" + row_tuple + ")", "", "def extract_batch(records):", "    rows = []",
+                  "    append = rows.append", "    for record in records:"]
+        lines += ["        " + statement for statement in statements]
+        lines += ["        append(" + row_dict + ")", "    return(rows)", "", "def extract_columns(records):"]
+        lines += ["    c" + str(i) + " = []" for i in range(len(expressions))]
+        lines += ["    for record in records:"]
+        lines += ["        " + statement for statement in statements]
+        lines += ["        c" + str(i) + ".append(" + expression + ")" for i, expression in enumerate(expressions)]
+        lines += ["    return((" + "".join("c" + str(i) + ", " for i in range(len(expressions))) + "))", ""]
+        return("\n".join(lines))
+
+
+# Every flat column the loaders write, and where it comes from in a cleaned record. Neo4jLoader's query
+# parameters, ParquetLoader's columns, CompactTweet's user and place fields and CompactTweet.flatten()
+# are all taken from here, so a field is only ever declared once. The ids the graph MERGEs on (tweet,
+# user and place) are required, so a malformed tweet fails its batch (and is dead-lettered) instead
+# of being written with a null id; the other fields are None if the tweet doesn't have them.
+TWEET_FIELDS = FieldMapping([
+    ('geo_id', 'geo_id'),
+    ('tweet_id', 'id_str'),
+    ('text', 'text?'),
+    ('lang', 'lang?'),
+    ('timestamp_ms', 'timestamp_ms'),
+    ('favorited', 'favorited?'),
+    ('retweeted', 'retweeted?'),
+    ('retweet_count', 'retweet_count?'),
+    ('favorite_count', 'favorite_count?'),
+    ('quote_count', 'quote_count?'),
+    ('reply_count', 'reply_count?'),
+    ('tweet_coordinates_long', 'coordinates?.coordinates.0'),
+    ('tweet_coordinates_lat', 'coordinates?.coordinates.1'),
+    ('user_id', 'user.id'),
+    ('user_name', 'user.name?'),
+    ('user_screen_name', 'user.screen_name?'),
+    ('user_description', 'user.description?'),
+    ('user_location', 'user.location?'),
+    ('user_lang', 'user.lang?'),
+    ('user_time_zone', 'user.time_zone?'),
+    ('user_verified', 'user.verified?'),
+    ('user_utc_offset', 'user.utc_offset?'),
+    ('user_created_at', 'user.created_at?'),
+    ('user_listed_count', 'user.listed_count?'),
+    ('user_friends_count', 'user.friends_count?'),
+    ('user_followers_count', 'user.followers_count?'),
+    ('user_favourites_count', 'user.favourites_count?'),
+    ('user_is_translator', 'user.is_translator?'),
+    ('user_statuses_count', 'user.statuses_count?'),
+    ('place_id', 'place.id'),
+    ('place_name', 'place.name'),
+    ('place_full_name', 'place.full_name'),
+    ('place_country', 'place.country'),
+    ('place_country_code', 'place.country_code'),
+    ('place_type', 'place.place_type'),
+    ('place_bounding_box_LL_long', 'place.better_bounding_box.coordinates.0.0.0'),
+    ('place_bounding_box_LL_lat', 'place.better_bounding_box.coordinates.0.0.1'),
+    ('place_bounding_box_UR_long', 'place.better_bounding_box.coordinates.0.2.0'),
+    ('place_bounding_box_UR_lat', 'place.better_bounding_box.coordinates.0.2.1'),
+    ('place_centroid_long', 'place.centroid.coordinates.0'),
+    ('place_centroid_lat', 'place.centroid.coordinates.1'),
+    ('place_centroid_geohash', 'place.centroid_geohash'),
+    ('entities_user_mentions', 'entities.user_mentions'),
+    ('entities_hashtags', 'entities.hashtags')
+])
+
 
 ## Cleaner
 
+GEOHASH_BASE32 = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype=np.uint8)
+
+# Older pygeohash releases send a value that sits exactly on an interval midpoint to the lower half,
+# newer ones send it to the upper half. Match whichever one is installed.
+GEOHASH_UPPER_INCLUDES_MID = pgh.encode(0.0, 0.0, precision=1) == "s"
+
+# Offsets applied to the four corners of a 'poi' bounding box to turn the point into a small rectangle
+POI_BUFFER = np.array([[-0.0001, -0.0001], [-0.0001, 0.0001], [0.0001, 0.0001], [0.0001, -0.0001]])
+
+def encode_geohashes(latitudes, longitudes, precision=12):
+    ''' Vectorized version of pgh.encode(). Takes arrays of latitudes and longitudes and returns a
+    list of geohash strings. Runs the same interval-halving comparisons as pygeohash, one bit at a
+    time for the whole array, so the output is identical to calling pgh.encode() on each pair. '''
+    in_upper_half = np.greater_equal if GEOHASH_UPPER_INCLUDES_MID else np.greater
+    record_count = len(latitudes)
+    values = (np.asarray(longitudes, dtype=np.float64), np.asarray(latitudes, dtype=np.float64))
+    lows = (np.full(record_count, -180.0), np.full(record_count, -90.0))
+    highs = (np.full(record_count, 180.0), np.full(record_count, 90.0))
+    mid = np.empty(record_count)
+    upper = np.empty(record_count, dtype=bool)
+    bits = np.zeros(record_count, dtype=np.uint64)
+
+    # Geohash bits alternate between longitude and latitude, starting with longitude
+    for bit_number in range(precision * 5):
+        axis = bit_number % 2
+        np.add(lows[axis], highs[axis], out=mid)
+        mid /= 2
+        in_upper_half(values[axis], mid, out=upper)
+        np.copyto(lows[axis], mid, where=upper)
+        np.copyto(highs[axis], mid, where=~upper)
+        bits <<= np.uint64(1)
+        bits |= upper
+
+    # Split the bits back up into 5-bit base32 characters
+    shifts = np.arange(precision - 1, -1, -1, dtype=np.uint64) * np.uint64(5)
+    characters = GEOHASH_BASE32[(bits[:, None] >> shifts) & np.uint64(31)]
+    encoded = characters.tobytes().decode("ascii")
+    return([encoded[i:i + precision] for i in range(0, len(encoded), precision)])
+
+
 class Cleaner:
     ''' Takes a batch of data that's been extracted as a list of dictionaries.  Contains methods to
     iterate over each record in the list, running it through a series of cleaning steps. Logs the
     ids of the records that are affected by the various cleaning steps. Returns the cleaned data back
     as a list. '''
 
-    def __init__(self, data_list, file_name, logs_path):
+    # Cleaned geometry (better bounding box, centroid and geohash) of the places we've seen, by place id.
+    # Shared by every Cleaner in the process, so it carries over from one file to the next.
+    place_cache = LRUCache(100000)
+
+    # What the cleaning steps read from each record to clean its place's geometry: the place type from
+    # TWEET_FIELDS, and the original (still open) bounding box
+    place_geometry_fields = TWEET_FIELDS.select(['place_type', 'bounding_box'],
+                                                {'bounding_box': 'place.bounding_box.coordinates.0'})
+
+    def __init__(self, data_list, file_name, logs_path, metrics=NO_METRICS, use_place_cache=True, compact=False):
         self.data_list = data_list
         self.logs_path = logs_path
         self.file_name = file_name
+        self.metrics = metrics
+        self.use_place_cache = use_place_cache
+        self.compact = compact
 
     def set_data_types(self, record):
         record['id_str'] = str(record['id_str'])
@@ -162,11 +1411,12 @@ class Cleaner:
         the point.  We can recognize these by looking for place.place_type == 'poi'. '''
 
         #print(record['id_str'])
-        original_bounding_box = record['place']['bounding_box']['coordinates'][0].copy()
+        place_type, bounding_box = self.place_geometry_fields.extract_values(record)
+        original_bounding_box = bounding_box.copy()
         #print(original_bounding_box)
-        #print(record['place']['place_type'])
+        #print(place_type)
 
-        if (record['place']['place_type'] == 'poi' or record['place']['place_type'] == 'NA'):
+        if (place_type == 'poi' or place_type == 'NA'):
             point_bounding_box = [[None for x in range(2)] for y in range(5)]
             point_bounding_box[0][0] = original_bounding_box[0][0] - 0.0001
             point_bounding_box[0][1] = original_bounding_box[0][1] - 0.0001
@@ -198,6 +1448,10 @@ class Cleaner:
             #print(record['place']['better_bounding_box']['coordinates'])
 
     def get_centroid(self, record):
+        self.set_centroid(record)
+        self.set_geohash(record)
+
+    def set_centroid(self, record):
         bounding_box = record['place']['better_bounding_box']['coordinates'][0];
         lower_left = bounding_box[0];
         upper_right = bounding_box[2];
@@ -207,8 +1461,46 @@ class Cleaner:
         record['place']['centroid']['type'] = "Point"
         record['place']['centroid']['coordinates'] = [centroid_long, centroid_lat]
 
+    def set_geohash(self, record):
+        centroid_long, centroid_lat = record['place']['centroid']['coordinates']
         record['place']['centroid_geohash'] = pgh.encode(centroid_lat, centroid_long, precision=12)
 
+    def apply_cached_place(self, record, log_array):
+        ''' If we've already cleaned this place, copies its cleaned geometry onto the record instead of
+        working it out again, and returns True. Twitter can change a place's bounding box, so the
+        cached geometry is only used if the place type and bounding box are the same as last time.
+
+        Records of the same place share the cached coordinate lists (copying them costs about as much
+        as cleaning the place again), so treat a cleaned record's geometry as read-only. '''
+        if not self.use_place_cache:
+            return(False)
+        place = record['place']
+        cached = Cleaner.place_cache.get(place['id'])
+        if cached is None:
+            return(False)
+        place_type, bounding_box, better_bounding_box, centroid, geohash = cached
+        if self.place_geometry_fields.extract_values(record) != (place_type, bounding_box):
+            return(False)
+        place['better_bounding_box'] = {'type': "Polygon", 'coordinates': better_bounding_box}
+        place['centroid'] = {'type': "Point", 'coordinates': centroid}
+        place['centroid_geohash'] = geohash
+        if place_type == 'poi' or place_type == 'NA':
+            log_array.append(record["id_str"]) # fix_bounding_box() would have logged it
+        return(True)
+
+    def cache_place(self, record):
+        if not self.use_place_cache:
+            return
+        place = record['place']
+        place_type, bounding_box = self.place_geometry_fields.extract_values(record)
+        Cleaner.place_cache.put(place['id'], (
+            place_type,
+            [list(point) for point in bounding_box],
+            place['better_bounding_box']['coordinates'],
+            place['centroid']['coordinates'],
+            place['centroid_geohash']
+        ))
+
     def set_id(self, record):
         ''' Set an id that is a concatenation of the tweet's geohash, plus its unique
         tweet_id value.  This gives us the opportunity to shard or index based on geohash,
@@ -221,25 +1513,166 @@ class Cleaner:
         on the dictionary object representing the record for any values that need to be changed or corrected.
         Logs the ids of data elements that contain nulls and/or errors to arrays as we go. At the end
         of cleaning, invokes the log_cleaning() method to record a log of which records needed to have
-        their geodata cleaned. '''
+        their geodata cleaned. With compact=True, the cleaned records are returned as CompactTweets. '''
 
         step1_log = []
         step2_log = []
 
-        #i = 0
-        for record in self.data_list:
-            #print(i)
-            self.set_data_types(record)
-            self.fix_null_places(record, step1_log)
+        self.clean_records(self.data_list, step1_log, step2_log)
+        if self.compact:
+            self.compact_records(self.data_list)
+
+        print("Cleaner: Finished cleaning records.")
+        self.log_cleaning(step1_log, step2_log)
+        return(self.data_list)
+
+    def clean_record(self, record, step1_log, step2_log):
+        ''' Runs a single record through every cleaning step, in order. '''
+        self.set_data_types(record)
+        self.fix_null_places(record, step1_log)
+        if not self.apply_cached_place(record, step2_log):
             self.fix_bounding_box(record, step2_log)
             self.get_centroid(record)
+            self.cache_place(record)
+        self.set_id(record)
+
+    def clean_records(self, records, step1_log, step2_log):
+        ''' Runs clean_record() over a list of records. When metrics are enabled, times each cleaning
+        step separately instead, and records the totals for the list as one call of each stage. '''
+        if not self.metrics.enabled:
+            for record in records:
+                self.clean_record(record, step1_log, step2_log)
+            return
+
+        clock = time.perf_counter
+        step_names = ('set_data_types', 'fix_null_places', 'place_cache', 'fix_bounding_box', 'get_centroid', 'geohash', 'set_id')
+        step_times = [0.0] * len(step_names)
+        cache_hits = 0
+        for record in records:
+            t0 = clock()
+            self.set_data_types(record)
+            t1 = clock()
+            self.fix_null_places(record, step1_log)
+            t2 = clock()
+            if self.apply_cached_place(record, step2_log):
+                cache_hits += 1
+                t3 = t4 = t5 = t6 = clock()
+            else:
+                t3 = clock()
+                self.fix_bounding_box(record, step2_log)
+                t4 = clock()
+                self.set_centroid(record)
+                t5 = clock()
+                self.set_geohash(record)
+                self.cache_place(record)
+                t6 = clock()
             self.set_id(record)
-            #i += 1
+            t7 = clock()
+            step_times[0] += t1 - t0
+            step_times[1] += t2 - t1
+            step_times[2] += t3 - t2
+            step_times[3] += t4 - t3
+            step_times[4] += t5 - t4
+            step_times[5] += t6 - t5
+            step_times[6] += t7 - t6
+        for step_name, step_time in zip(step_names, step_times):
+            self.metrics.record("clean." + step_name, step_time, len(records))
+        self.metrics.increment("clean.place_cache_hits", cache_hits)
+
+    def clean_data_vectorized(self):
+        ''' Same as clean_data(), but cleans the geodata for the whole batch at once with NumPy
+        (see clean_batch()) instead of one record at a time. Produces identical records. '''
+
+        step1_log = []
+        step2_log = []
+
+        self.clean_batch(self.data_list, step1_log, step2_log)
+        if self.compact:
+            self.compact_records(self.data_list)
 
         print("Cleaner: Finished cleaning records.")
         self.log_cleaning(step1_log, step2_log)
         return(self.data_list)
 
+    def clean_batch(self, records, step1_log, step2_log):
+        ''' Cleans a list of records in place. Data types and null places are still fixed record by
+        record (they're simple dictionary updates), but the bounding box corners for the whole batch
+        are then pulled into a single NumPy array so the POI buffer, the centroids and the geohashes
+        can be computed with array operations. Falls back to clean_record() if any bounding box isn't
+        the usual four-point Twitter box. '''
+
+        with self.metrics.timer("clean.set_data_types_and_fix_null_places", len(records)):
+            for record in records:
+                self.set_data_types(record)
+                self.fix_null_places(record, step1_log)
+
+        place_types, original_bounding_boxes = self.place_geometry_fields.extract_columns(records)
+        if not records or any(len(bounding_box) != 4 for bounding_box in original_bounding_boxes):
+            for record in records:
+                self.fix_bounding_box(record, step2_log)
+                self.get_centroid(record)
+                self.set_id(record)
+            return
+
+        with self.metrics.timer("clean.bounding_boxes_and_centroids", len(records)):
+            corners = np.array(original_bounding_boxes, dtype=np.float64) # shape: (records, 4 corners, long/lat)
+            is_point = np.array([place_type in ('poi', 'NA') for place_type in place_types])
+
+            # Buffer the 'poi' boxes, then take the lower left and upper right corners for the centroid
+            corners[is_point] += POI_BUFFER
+            lower_left = corners[:, 0]
+            upper_right = corners[:, 2]
+            centroids = lower_left + ((upper_right - lower_left) / 2)
+        with self.metrics.timer("clean.geohash", len(records)):
+            geohashes = encode_geohashes(centroids[:, 1], centroids[:, 0], precision=12)
+
+        buffered_boxes = iter(corners[is_point].tolist()) # only the 'poi' boxes changed, so only convert those back
+        centroid_list = centroids.tolist()
+        for i, record in enumerate(records):
+            if is_point[i]:
+                better_bounding_box = next(buffered_boxes)
+                better_bounding_box.append(list(better_bounding_box[0]))
+                step2_log.append(record["id_str"])
+            else:
+                # Keep the original coordinate values and just close off the polygon
+                better_bounding_box = original_bounding_boxes[i].copy()
+                better_bounding_box.append(better_bounding_box[0])
+            place = record['place']
+            place['better_bounding_box'] = {'type': "Polygon", 'coordinates': [better_bounding_box]}
+            place['centroid'] = {'type': "Point", 'coordinates': centroid_list[i]}
+            place['centroid_geohash'] = geohashes[i]
+            self.set_id(record)
+
+    def compact_records(self, records):
+        ''' Replaces each cleaned record in the list with a CompactTweet, in place, so each original
+        dictionary can be freed as soon as it has been converted. '''
+        with self.metrics.timer("clean.compact", len(records)):
+            for i, record in enumerate(records):
+                records[i] = CompactTweet.from_record(record)
+
+    def clean_stream(self, vectorized=False):
+        ''' Streaming counterpart to clean_data(). Expects self.data_list to be an iterable of chunks
+        (lists of dictionaries), such as the generator returned by Extractor.get_next_file_stream().
+        Cleans each chunk in place and yields it as soon as it's done, so cleaning and loading can start
+        before the whole file has been parsed. The cleaning log is written once, after the last chunk.
+        With vectorized=True, each chunk is cleaned with clean_batch(). With compact=True, each chunk is
+        yielded as a list of CompactTweets. '''
+
+        step1_log = []
+        step2_log = []
+
+        for chunk in self.data_list:
+            if vectorized:
+                self.clean_batch(chunk, step1_log, step2_log)
+            else:
+                self.clean_records(chunk, step1_log, step2_log)
+            if self.compact:
+                self.compact_records(chunk)
+            yield chunk
+
+        print("Cleaner: Finished cleaning records.")
+        self.log_cleaning(step1_log, step2_log)
+
     def log_cleaning(self, step1_log, step2_log):
         ''' When cleaning is done, put the cleaning log arrays into a dictionary and write the result
         to the cleaning log file. '''
@@ -258,114 +1691,904 @@ class Cleaner:
         cleaning_log.close()
 
 
-## Loader
+## Compact Records
 
-class Loader:
+class CompactTweet:
     '''
-    Contains general methods for initializing a database connection, loading data by interating over
-    records and writing them one by one to the database, and logging data about the number of successful
-    and failed loads to a log file. When setting up the database connection, this class invokes other
-    database-specific loader classes that contain all required methods to "plug and play" with this
-    generic loader class (ex: initialize_connection(), load_record(), etc.). '''
+    A cleaned tweet reduced to the fields the loaders actually store, held in __slots__ instead of the
+    nested dictionaries Twitter sends. The original record carries the whole user profile, every entity
+    and a list-of-lists for each bounding box; a CompactTweet keeps the tweet's scalar fields, tuples for
+    the user and place fields, tuples for mentions and hashtags, and the place bounding box as a flat
+    array of doubles. The better bounding box is rebuilt from it when needed rather than stored.
 
-    def __init__(self, data_list, file_name, logs_path):
-        self.data_list = data_list
-        self.logs_path = logs_path
-        self.file_name = file_name
-        self.db_connection = None
+    Build them with Cleaner(..., compact=True). Loaders serialize from them directly: Neo4j and Parquet
+    rows come from flatten(), and MongoDB and Elasticsearch documents from to_document(), one chunk at
+    a time. Fields that aren't listed below are dropped, so only use compact records when the fields
+    the loaders write are all you need to keep. '''
 
-    def get_connection(self, db_type, db_host, db_port, username=None, pwd=None, db_name=None, collection_name=None):
-        if db_type == "mongodb":
-            self.db_connection = MongoDBLoader(db_host, db_port, username, pwd, db_name, collection_name)
-            self.db_connection.initialize_connection()
-        if db_type == "neo4j":
-            self.db_connection = Neo4jLoader(db_host, db_port, username, pwd)
-            self.db_connection.initialize_connection()
-        if db_type == "elasticsearch":
-            self.db_connection = ElasticSearchLoader(db_host, db_port, db_name)
-            self.db_connection.initialize_connection()
+    tweet_fields = ('id', 'id_str', 'timestamp_ms', 'created_at', 'text', 'lang', 'favorited', 'retweeted',
+                    'retweet_count', 'favorite_count', 'quote_count', 'reply_count')
+    mention_fields = ('id', 'id_str', 'name', 'screen_name')
 
-    def load_data(self):
-        # Initialize variables we want to count so we can output them to the log file at the end of load
-        begin = time.time()
-        i = 0
-        success_count = 0
-        fail_count = 0
-        fail_log = []
+    # The user and place fields are the ones in TWEET_FIELDS (the geohash has its own slot below), plus
+    # the place's url for to_document(). flatten() fills the matching columns straight from the tuples.
+    tweet_columns = TWEET_FIELDS.fields_under()
+    user_columns = TWEET_FIELDS.fields_under('user')
+    place_columns = [(name, key) for name, key in TWEET_FIELDS.fields_under('place') if key != 'centroid_geohash']
+    user_fields = tuple(key for name, key in user_columns)
+    place_fields = tuple(key for name, key in place_columns) + ('url',)
+    user_mapping = TWEET_FIELDS.select([name for name, key in user_columns])
+    place_mapping = TWEET_FIELDS.select([name for name, key in place_columns] + ['place_url'], {'place_url': 'place.url?'})
+    place_type_index = place_fields.index('place_type')
+    tweet_names = tuple(name for name, key in tweet_columns)
+    tweet_values = attrgetter(*[key for name, key in tweet_columns])
+    user_names = tuple(name for name, key in user_columns)
+    place_names = tuple(name for name, key in place_columns)
 
-        print("Loader: Loading records...")
-        for record in self.data_list:
-            try:
-                self.db_connection.load_record(record)
-                success_count += 1
-            except Exception as e:
-                print("Couldn't load record with id: " + record['id_str'])
-                #print(e)
-                fail_count += 1
-                fail_dict = dict()
-                fail_dict['id'] = record['id_str']
-                fail_dict['error'] = str(e)
-                fail_log.append(fail_dict)
-            #i += 1
+    __slots__ = tweet_fields + ('geo_id', 'coordinates', 'user', 'place', 'bounding_box', 'centroid_long',
+                                'centroid_lat', 'centroid_geohash', 'user_mentions', 'hashtags')
 
-        print("Loader: Finished loading records.")
-        end = time.time()
-        load_time = end - begin # compute time elapsed for load
-        self.db_connection.close_connection() # close database connection
-        self.log_load(load_time, success_count, fail_count, fail_log) # write load results to log
+    @classmethod
+    def from_record(cls, record):
+        ''' Builds a CompactTweet from a record that has been through Cleaner.clean_record(). '''
+        tweet = cls()
+        for field in cls.tweet_fields:
+            setattr(tweet, field, record.get(field))
+        tweet.geo_id = record['geo_id']
+        coordinates = record.get('coordinates')
+        tweet.coordinates = tuple(coordinates['coordinates']) if coordinates is not None else None
+        user = record.get('user')
+        # A tweet without a user id is kept, but can't be flattened, like the record it came from
+        tweet.user = cls.user_mapping.extract_values(record) if user is not None and 'id' in user else None
+        tweet.place = cls.place_mapping.extract_values(record)
+        place = record['place']
+        tweet.bounding_box = array('d', [value for corner in place['bounding_box']['coordinates'][0] for value in corner])
+        tweet.centroid_long, tweet.centroid_lat = place['centroid']['coordinates']
+        tweet.centroid_geohash = place['centroid_geohash']
+        entities = record.get('entities') or dict()
+        tweet.user_mentions = tuple(tuple(mention.get(field) for field in cls.mention_fields)
+                                    for mention in entities.get('user_mentions', ()))
+        tweet.hashtags = tuple(hashtag.get('text') for hashtag in entities.get('hashtags', ()))
+        return(tweet)
 
-    def load_batch_data(self):
-        print("Loader: Loading batch data!")
-        begin = time.time()
+    def __getitem__(self, key):
+        # Lets code that only reads the tweet's top-level scalars (ids, timestamps, geo_id) treat a
+        # CompactTweet like the record it came from.
+        if key in CompactTweet.tweet_fields or key == 'geo_id':
+            return(getattr(self, key))
+        raise KeyError(key)
 
+    def get(self, key, default=None):
         try:
-            fail_log = self.db_connection.bulk_load_records(self.data_list)
-        except Exception as e:
-            print("Couldn't bulk load records because: ")
-            print(str(e))
-            fail_log = str(e)
-            raise
+            return(self[key])
+        except KeyError:
+            return(default)
 
-        print("Loader: Finished loading records.")
-        end = time.time()
-        load_time = end - begin # compute time elapsed for load
-        self.db_connection.close_connection() # close database connection
-        self.log_load(load_time, 'NA', 'NA', fail_log) # write load results to log
+    def better_bounding_box(self):
+        ''' The closed (or, for points, buffered) polygon that Cleaner.fix_bounding_box() builds. '''
+        box = self.bounding_box
+        corners = [[box[i], box[i + 1]] for i in range(0, len(box), 2)]
+        place_type = self.place[CompactTweet.place_type_index]
+        if place_type == 'poi' or place_type == 'NA':
+            return([[corners[0][0] - 0.0001, corners[0][1] - 0.0001],
+                    [corners[1][0] - 0.0001, corners[1][1] + 0.0001],
+                    [corners[2][0] + 0.0001, corners[2][1] + 0.0001],
+                    [corners[3][0] + 0.0001, corners[3][1] - 0.0001],
+                    [corners[0][0] - 0.0001, corners[0][1] - 0.0001]])
+        corners.append(corners[0])
+        return(corners)
 
-    def log_load(self, load_time, success_count, fail_count, fail_log):
-        ''' When load is done, record the time it took to run, number of successes, and number of failures.
-        Write this info, along with file_name, as a JSON string to a log file. Then remove the name of the
-        successfully loaded file from files_to_load.txt so we don't try to re-load it on the next iteration. '''
+    def mention_dicts(self):
+        return([dict(zip(CompactTweet.mention_fields, mention)) for mention in self.user_mentions])
 
-        log_dict = dict()
-        log_dict['file_name'] = self.file_name
-        log_dict['load_time'] = load_time
-        log_dict['success_count'] = success_count
-        log_dict['fail_count'] = fail_count
-        #log_dict['fail_log'] = fail_log    # The fail log can get long! Only comment this out if you want full details into why certain tweets are failing to load.
-        loaded_files_log  = open(self.logs_path + "/loaded_files.txt", "a+") # open file in append mode
-        loaded_files_log.write(json.dumps(log_dict))
-        loaded_files_log.write("\n")
-        loaded_files_log.close()
+    def hashtag_dicts(self):
+        return([{'text': text} for text in self.hashtags])
 
-        # https://www.reddit.com/r/learnpython/comments/3xuych/least_resource_intensive_way_to_delete_first_line/
-        files_to_load_log  = open(self.logs_path + "/files_to_load.txt", "r+") # open in read/write mode
-        files_to_load_log.readline() # read the first line and throw it out
-        remaining_files = files_to_load_log.read() # read the rest
-        files_to_load_log.seek(0) # set the cursor to the top of the file
-        files_to_load_log.write(remaining_files) # write the data back
-        files_to_load_log.truncate() # set the file size to the current size
+    def to_document(self):
+        ''' Rebuilds the cleaned record (restricted to the fields kept above) as a dictionary, for the
+        document stores. '''
+        document = dict()
+        for field in CompactTweet.tweet_fields:
+            document[field] = getattr(self, field)
+        if self.coordinates is not None:
+            document['coordinates'] = {'type': "Point", 'coordinates': list(self.coordinates)}
+        else:
+            document['coordinates'] = None
+        place = dict(zip(CompactTweet.place_fields, self.place))
+        box = self.bounding_box
+        place['bounding_box'] = {'type': "Polygon", 'coordinates': [[[box[i], box[i + 1]] for i in range(0, len(box), 2)]]}
+        place['better_bounding_box'] = {'type': "Polygon", 'coordinates': [self.better_bounding_box()]}
+        place['centroid'] = {'type': "Point", 'coordinates': [self.centroid_long, self.centroid_lat]}
+        place['centroid_geohash'] = self.centroid_geohash
+        document['place'] = place
+        if self.user is not None:
+            document['user'] = dict(zip(CompactTweet.user_fields, self.user))
+        document['entities'] = {'user_mentions': self.mention_dicts(), 'hashtags': self.hashtag_dicts()}
+        document['geo_id'] = self.geo_id
+        return(document)
 
-    def close_connection(self):
-        self.db_connection.close_connection()
+    def flatten(self):
+        ''' The row that TWEET_FIELDS.extract() makes from the cleaned record. Loaders drop the columns
+        they don't store (their unused_columns). '''
+        if self.user is None:
+            raise KeyError('user')
+        row = dict(zip(CompactTweet.tweet_names, CompactTweet.tweet_values(self)))
+        row['tweet_coordinates_long'] = self.coordinates[0] if self.coordinates is not None else None
+        row['tweet_coordinates_lat'] = self.coordinates[1] if self.coordinates is not None else None
+        row.update(zip(CompactTweet.user_names, self.user))
+        row.update(zip(CompactTweet.place_names, self.place)) # stops before the url, which isn't a column
+        better_bounding_box = self.better_bounding_box()
+        row['place_bounding_box_LL_long'] = better_bounding_box[0][0]
+        row['place_bounding_box_LL_lat'] = better_bounding_box[0][1]
+        row['place_bounding_box_UR_long'] = better_bounding_box[2][0]
+        row['place_bounding_box_UR_lat'] = better_bounding_box[2][1]
+        row['place_centroid_long'] = self.centroid_long
+        row['place_centroid_lat'] = self.centroid_lat
+        row['place_centroid_geohash'] = self.centroid_geohash
+        row['entities_user_mentions'] = self.mention_dicts()
+        row['entities_hashtags'] = self.hashtag_dicts()
+        return(row)
 
-### MongoDBLoader
+def as_document(record):
+    ''' Returns record as a dictionary, converting it if it's a CompactTweet. '''
+    if isinstance(record, CompactTweet):
+        return(record.to_document())
+    return(record)
 
-# http://api.mongodb.com/python/current/examples/bulk.html
+def centroid_geohash(record):
+    if isinstance(record, CompactTweet):
+        return(record.centroid_geohash)
+    return(record['place']['centroid_geohash'])
+
+## Partitioning
+
+class GeohashPartitioner:
+    '''
+    Groups cleaned records by the first precision characters of their place centroid's geohash (the
+    same geohash that starts every geo_id), so loaders can spread writes over several collections,
+    indices or shards instead of piling every region onto one. Nearby places share a prefix, so a
+    spatial query only needs the partitions returned by prefixes_for_bounding_box().
+
+    A precision of 1 makes 32 partitions, 2 makes 1,024, and so on. Pass a partitioner to the MongoDB
+    or Elasticsearch loader through Loader.get_connection(..., partitioner=GeohashPartitioner(2)). '''
+
+    def __init__(self, precision=2):
+        if precision < 1 or precision > 12:
+            raise ValueError("precision must be between 1 and 12 (the length of the centroid geohash)")
+        self.precision = precision
+
+    def partition_key(self, record):
+        return(centroid_geohash(record)[:self.precision])
+
+    def group(self, record_list):
+        ''' Returns a dictionary of partition key -> records, keeping the records' order within each
+        partition. '''
+        partitions = dict()
+        for record in record_list:
+            partitions.setdefault(self.partition_key(record), []).append(record)
+        return(partitions)
+
+    def target_name(self, base_name, partition):
+        ''' Name of the collection or index that holds a partition, e.g. tweets_9q. '''
+        return(base_name + "_" + partition)
+
+    def all_prefixes(self):
+        ''' Every partition key at this precision, in sorted (geohash) order. '''
+        alphabet = GEOHASH_BASE32.tobytes().decode()
+        return(["".join(characters) for characters in itertools.product(alphabet, repeat=self.precision)])
+
+    def prefixes_for_bounding_box(self, west, south, east, north):
+        ''' Returns the partition keys of every geohash cell that overlaps the bounding box, so a query
+        can be sent to just those collections or indices (or Elasticsearch routing values). '''
+        return(sorted(set(prefix for prefix, cell_bounds in self.cells_for_bounding_box(west, south, east, north))))
+
+    def cells_for_bounding_box(self, west, south, east, north):
+        ''' Returns a (geohash prefix, (west, south, east, north)) pair for every geohash cell at this
+        precision that overlaps the bounding box. '''
+        # A geohash of n characters alternates 5 * n bits between longitude and latitude, starting with longitude
+        lon_bits = (5 * self.precision + 1) // 2
+        lat_bits = 5 * self.precision // 2
+        cell_width = 360.0 / 2 ** lon_bits
+        cell_height = 180.0 / 2 ** lat_bits
+        first_column = max(int((west + 180.0) // cell_width), 0)
+        last_column = min(int((east + 180.0) // cell_width), 2 ** lon_bits - 1)
+        first_row = max(int((south + 90.0) // cell_height), 0)
+        last_row = min(int((north + 90.0) // cell_height), 2 ** lat_bits - 1)
+
+        cells = []
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                cell_west = -180.0 + column * cell_width
+                cell_south = -90.0 + row * cell_height
+                # encode the middle of each cell, which is never on a cell edge
+                prefix = pgh.encode(cell_south + 0.5 * cell_height, cell_west + 0.5 * cell_width, precision=self.precision)
+                cells.append((prefix, (cell_west, cell_south, cell_west + cell_width, cell_south + cell_height)))
+        return(cells)
+
+## Spatial Filtering
+
+class Region:
+    ''' A polygon (or multipolygon) that records can be tested against, stored as flat NumPy arrays of
+    its edges. Holes are handled with the even-odd rule: a point is inside if a ray from it crosses the
+    region's rings an odd number of times. '''
+
+    def __init__(self, name, geometry):
+        self.name = name
+        rings = Region.geometry_rings(geometry)
+        starts = []
+        ends = []
+        for ring in rings:
+            ring = [(float(point[0]), float(point[1])) for point in ring]
+            if ring[0] != ring[-1]:
+                ring.append(ring[0])
+            starts.extend(ring[:-1])
+            ends.extend(ring[1:])
+        starts = np.array(starts, dtype=np.float64)
+        ends = np.array(ends, dtype=np.float64)
+        self.x1, self.y1 = starts[:, 0], starts[:, 1]
+        self.x2, self.y2 = ends[:, 0], ends[:, 1]
+        self.bounds = (float(starts[:, 0].min()), float(starts[:, 1].min()), float(starts[:, 0].max()), float(starts[:, 1].max()))
+
+    @staticmethod
+    def geometry_rings(geometry):
+        ''' Takes a GeoJSON Polygon or MultiPolygon geometry, a GeoJSON Feature, a list of rings (the
+        coordinates of a Polygon), or a single ring of [long, lat] points, and returns a list of rings. '''
+        if isinstance(geometry, dict):
+            if geometry.get('type') == "Feature":
+                return(Region.geometry_rings(geometry['geometry']))
+            if geometry.get('type') == "Polygon":
+                return(geometry['coordinates'])
+            if geometry.get('type') == "MultiPolygon":
+                return([ring for polygon in geometry['coordinates'] for ring in polygon])
+            raise ValueError("Regions must be Polygon or MultiPolygon geometries, not: " + str(geometry.get('type')))
+        if isinstance(geometry[0][0], (int, float)):
+            return([geometry])
+        return(geometry)
+
+    def contains_points(self, x, y):
+        ''' Vectorized point-in-polygon test. Takes arrays of longitudes and latitudes and returns a
+        boolean array. Works through the points in blocks so the points x edges arrays stay small. '''
+        inside = np.zeros(len(x), dtype=bool)
+        block_size = max(1, (1 << 20) // len(self.x1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for begin in range(0, len(x), block_size):
+                px = x[begin:begin + block_size, None]
+                py = y[begin:begin + block_size, None]
+                straddles = (self.y1 > py) != (self.y2 > py)
+                crossing_x = self.x1 + (py - self.y1) * (self.x2 - self.x1) / (self.y2 - self.y1)
+                crossings = np.count_nonzero(straddles & (px < crossing_x), axis=1)
+                inside[begin:begin + block_size] = (crossings & 1).astype(bool)
+        return(inside)
+
+    def rectangle_relation(self, west, south, east, north):
+        ''' Returns 'inside' if the rectangle is entirely within the region, 'outside' if they don't
+        overlap, and 'boundary' if the region's edge passes through the rectangle. '''
+        if west > self.bounds[2] or east < self.bounds[0] or south > self.bounds[3] or north < self.bounds[1]:
+            return("outside")
+        # Liang-Barsky: clip every edge against the rectangle and see if anything is left of any of them
+        dx = self.x2 - self.x1
+        dy = self.y2 - self.y1
+        t0 = np.zeros(len(dx))
+        t1 = np.ones(len(dx))
+        clipped = np.zeros(len(dx), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for p, q in ((-dx, self.x1 - west), (dx, east - self.x1), (-dy, self.y1 - south), (dy, north - self.y1)):
+                clipped |= (p == 0) & (q < 0)
+                ratio = q / p
+                t0 = np.where(p < 0, np.maximum(t0, ratio), t0)
+                t1 = np.where(p > 0, np.minimum(t1, ratio), t1)
+        if np.any(~clipped & (t0 <= t1)):
+            return("boundary")
+        # No edge touches the rectangle, so it's either wholly inside or wholly outside
+        center_inside = self.contains_points(np.array([(west + east) / 2]), np.array([(south + north) / 2]))[0]
+        return("inside" if center_inside else "outside")
+
+class SpatialFilter:
+    '''
+    Matches cleaned records against a set of named regions before they're loaded, so a region can be
+    loaded on its own, or records outside a study area dropped, without loading everything and running
+    $geoWithin or geo_shape queries afterwards. No database is involved.
+
+    regions is a dictionary of region name -> GeoJSON Polygon/MultiPolygon geometry (or a list of
+    rings). A record goes to the first region (in the dictionary's order) that it matches.
+
+    predicate='centroid' matches a record when its place centroid is inside the region. The regions
+    are indexed on a grid of geohash cells (grid_precision characters): records in a cell that lies
+    entirely inside a region match with just a dictionary lookup, records in a cell that no region
+    touches are dropped the same way, and only records in cells the region's edge passes through get
+    a (vectorized) point-in-polygon test.
+
+    predicate='bounding_box' matches a record when its place's better bounding box overlaps the region.
+    Places repeat a lot, so the result for each bounding box is cached. '''
+
+    def __init__(self, regions, predicate="centroid", grid_precision=4, metrics=NO_METRICS, cache_size=100000):
+        if predicate not in ("centroid", "bounding_box"):
+            raise ValueError("predicate must be 'centroid' or 'bounding_box', not: " + str(predicate))
+        self.regions = [Region(name, geometry) for name, geometry in regions.items()]
+        self.predicate = predicate
+        self.metrics = metrics
+        self.grid = GeohashPartitioner(grid_precision)
+        self.region_cells = [self.index_region(region) for region in self.regions]
+        self.bounding_box_cache = LRUCache(cache_size)
+
+    @classmethod
+    def from_geojson(cls, geojson_path, name_property="name", **filter_options):
+        ''' Builds a SpatialFilter from a GeoJSON FeatureCollection file, naming each region after one of
+        its features' properties. '''
+        with open(geojson_path, "r") as geojson_file:
+            collection = json.load(geojson_file)
+        regions = dict()
+        for number, feature in enumerate(collection['features']):
+            regions[str((feature.get('properties') or dict()).get(name_property, number))] = feature['geometry']
+        return(cls(regions, **filter_options))
+
+    def index_region(self, region):
+        ''' Returns a dictionary of geohash cell -> True if the cell is entirely inside the region, or
+        False if the region's edge passes through it. Cells outside the region are left out. '''
+        cells = dict()
+        for prefix, cell_bounds in self.grid.cells_for_bounding_box(*region.bounds):
+            relation = region.rectangle_relation(*cell_bounds)
+            if relation != "outside":
+                cells[prefix] = (relation == "inside")
+        return(cells)
+
+    def match(self, record_list):
+        ''' Returns the name of the region each record falls in, or None if it isn't in any of them. '''
+        with self.metrics.timer("spatial_filter", len(record_list)):
+            if not record_list:
+                return([])
+            if self.predicate == "centroid":
+                region_numbers = self.match_centroids(record_list)
+            else:
+                region_numbers = self.match_bounding_boxes(record_list)
+        return([self.regions[number].name if number >= 0 else None for number in region_numbers])
+
+    def match_centroids(self, record_list):
+        precision = self.grid.precision
+        cells, cell_numbers = np.unique([centroid_geohash(record)[:precision] for record in record_list], return_inverse=True)
+        points = np.array([centroid_point(record) for record in record_list], dtype=np.float64)
+        region_numbers = np.full(len(record_list), -1)
+        for number, region_cells in enumerate(self.region_cells):
+            # 1 for cells inside the region, 0 for cells on its edge, -1 for cells it doesn't touch
+            cell_status = np.array([int(region_cells[cell]) if cell in region_cells else -1 for cell in cells])
+            status = cell_status[cell_numbers]
+            unmatched = region_numbers < 0
+            region_numbers[unmatched & (status == 1)] = number
+            to_test = np.flatnonzero(unmatched & (status == 0))
+            if len(to_test):
+                inside = self.regions[number].contains_points(points[to_test, 0], points[to_test, 1])
+                region_numbers[to_test[inside]] = number
+        return(region_numbers)
+
+    def match_bounding_boxes(self, record_list):
+        region_numbers = np.full(len(record_list), -1)
+        for i, record in enumerate(record_list):
+            bounding_box = place_bounds(record)
+            number = self.bounding_box_cache.get(bounding_box)
+            if number is None:
+                number = -1
+                for region_number, region in enumerate(self.regions):
+                    if region.rectangle_relation(*bounding_box) != "outside":
+                        number = region_number
+                        break
+                self.bounding_box_cache.put(bounding_box, number)
+            region_numbers[i] = number
+        return(region_numbers)
+
+    def route(self, record_list):
+        ''' Groups the records by region name, keeping their order. Records outside every region are
+        grouped under None. '''
+        routes = dict()
+        for record, name in zip(record_list, self.match(record_list)):
+            routes.setdefault(name, []).append(record)
+        return(routes)
+
+    def filter(self, record_list):
+        ''' Returns just the records that fall in one of the regions. '''
+        kept = [record for record, name in zip(record_list, self.match(record_list)) if name is not None]
+        self.metrics.increment("spatial_filter.dropped", len(record_list) - len(kept))
+        return(kept)
+
+    def filter_stream(self, chunks):
+        ''' Streaming counterpart to filter(). Takes an iterable of chunks, such as the generator from
+        Cleaner.clean_stream(), and yields each chunk's records that fall in one of the regions,
+        skipping chunks that end up empty. '''
+        record_count = 0
+        kept_count = 0
+        for chunk in chunks:
+            kept = self.filter(chunk)
+            record_count += len(chunk)
+            kept_count += len(kept)
+            if kept:
+                yield kept
+        print("SpatialFilter: Kept " + str(kept_count) + " of " + str(record_count) + " records.")
+
+def centroid_point(record):
+    if isinstance(record, CompactTweet):
+        return((record.centroid_long, record.centroid_lat))
+    return(record['place']['centroid']['coordinates'])
+
+def place_bounds(record):
+    ''' The (west, south, east, north) corners of a record's better bounding box. '''
+    if isinstance(record, CompactTweet):
+        bounding_box = record.better_bounding_box()
+    else:
+        bounding_box = record['place']['better_bounding_box']['coordinates'][0]
+    return((bounding_box[0][0], bounding_box[0][1], bounding_box[2][0], bounding_box[2][1]))
+
+
+## Batch Control
+
+class AdaptiveBatchController:
+    '''
+    Picks the size of each bulk request from how the previous ones went, so a load runs at what the
+    database can take rather than at however many records happen to be in a file. Works like TCP
+    congestion control (additive increase, multiplicative decrease):
+
+    - A full-size request that took less than target_latency seconds grows the size by increase_step.
+    - A request that took longer shrinks it to about the size that would have taken target_latency.
+    - A request with rejections (Elasticsearch 429s, MongoDB write concern timeouts, Neo4j transient
+      errors) cuts it by decrease_factor.
+    - With max_bytes, the size is also capped so requests stay under max_bytes, judging by the
+      average size of the records sent so far.
+
+    Pass one to the MongoDB, Elasticsearch or Neo4j loader with
+    Loader.get_connection(..., batch_controller=AdaptiveBatchController()). It's safe to share between
+    the writer threads of one loader, and keeps what it has learned from one file to the next. '''
+
+    def __init__(self, initial_size=1000, min_size=50, max_size=20000, target_latency=2.0, max_bytes=None,
+                 increase_step=None, decrease_factor=0.5):
+        self.size = float(initial_size)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.increase_step = increase_step if increase_step is not None else max(min_size, initial_size // 10)
+        self.decrease_factor = decrease_factor
+        self.bytes_per_record = None
+        self.increases = 0
+        self.decreases = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled; each process that gets a copy (e.g. a Pipeline load worker) makes its own
+        state = self.__dict__.copy()
+        del state['lock']
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def next_size(self):
+        ''' The number of records to put in the next request. '''
+        with self.lock:
+            size = int(self.size)
+            if self.max_bytes is not None and self.bytes_per_record:
+                size = min(size, int(self.max_bytes / self.bytes_per_record))
+        return(max(1, size))
+
+    def record(self, record_count, seconds, rejected=0, payload_bytes=None):
+        ''' Reports how a request of record_count records went: how long it took, how many of its
+        records (or the request itself) were rejected because the database was overloaded, and how big
+        it was, if known. '''
+        if record_count == 0:
+            return
+        with self.lock:
+            if payload_bytes:
+                per_record = payload_bytes / record_count
+                # a moving average, so one batch of unusually long tweets doesn't swing the cap
+                self.bytes_per_record = per_record if self.bytes_per_record is None else 0.8 * self.bytes_per_record + 0.2 * per_record
+            if rejected:
+                self.size = max(self.min_size, self.size * self.decrease_factor)
+                self.decreases += 1
+            elif seconds > self.target_latency:
+                self.size = max(self.min_size, self.size * max(self.decrease_factor, self.target_latency / seconds))
+                self.decreases += 1
+            elif record_count >= 0.9 * self.size:
+                # only full-size requests tell us the current size is fine (not the short one at the end of a file)
+                self.size = min(self.max_size, self.size + self.increase_step)
+                self.increases += 1
+
+    def summary(self):
+        return("batch size " + str(self.next_size()) + " after " + str(self.increases) + " increases and "
+               + str(self.decreases) + " decreases")
+
+def submit_adaptive_chunks(executor, max_in_flight, batch_controller, groups, send_chunk):
+    ''' Cuts each list of records in groups into chunks and submits send_chunk(target, chunk) to the
+    executor for each, keeping at most max_in_flight chunks in flight. Each chunk is cut just before
+    it's sent, at the batch controller's size at that moment, so the size reacts to the chunks that
+    have just finished. groups is a list of (target, records) pairs. Returns the chunks' results. '''
+    results = []
+    in_flight = set()
+    for target, records in groups:
+        start = 0
+        while start < len(records):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+            size = batch_controller.next_size()
+            in_flight.add(executor.submit(send_chunk, target, records[start:start + size]))
+            start += size
+    results.extend(future.result() for future in in_flight)
+    return(results)
+
+
+## Loader
+
+def close_after_failure(connection):
+    ''' Closes a database-specific loader after a failed load, with its close_after_failure() if it has
+    one (e.g. to put back settings it holds for the whole run) and close_connection() otherwise. '''
+    if hasattr(connection, 'close_after_failure'):
+        connection.close_after_failure()
+    else:
+        connection.close_connection()
+
+class Loader:
+    '''
+    Contains general methods for initializing a database connection, loading data by interating over
+    records and writing them one by one to the database, and logging data about the number of successful
+    and failed loads to a log file. When setting up the database connection, this class invokes other
+    database-specific loader classes that contain all required methods to "plug and play" with this
+    generic loader class (ex: initialize_connection(), load_record(), etc.).
+
+    Records that fail to load are kept in a DeadLetterStore in the logs directory (unless you pass
+    dead_letters=NO_DEAD_LETTERS), so they can be replayed with retry_dead_letters(). '''
+
+    def __init__(self, data_list, file_name, logs_path, metrics=NO_METRICS, dead_letters=None):
+        self.data_list = data_list
+        self.logs_path = logs_path
+        self.file_name = file_name
+        self.db_connection = None
+        self.metrics = metrics
+        if dead_letters is None:
+            dead_letters = DeadLetterStore(logs_path) if logs_path is not None else NO_DEAD_LETTERS
+        self.dead_letters = dead_letters
+
+    def get_connection(self, db_type, db_host, db_port, username=None, pwd=None, db_name=None, collection_name=None, **loader_options):
+        ''' Any extra keyword arguments (loader_options) are passed through to the database-specific loader,
+        e.g. get_connection("neo4j", ..., batch_size=1000). For the "parquet" export, db_host and db_port
+        aren't used and db_name is the output directory, e.g. get_connection("parquet", None, None,
+        db_name="/data/tweets_parquet/", geohash_precision=4).
+
+        With async_io=True, MongoDB, Neo4j and Elasticsearch use the asyncio loaders instead, which keep
+        up to max_in_flight requests going at once, e.g. get_connection("mongodb", ..., async_io=True,
+        max_in_flight=16). They send fixed-size chunks, so they can't be given a batch_controller.
+
+        db_type "multi" loads into several databases at once (see FanOutLoader); the targets option is
+        a list of get_connection() arguments for each one, e.g. get_connection("multi", None, None,
+        targets=[{"db_type": "mongodb", ...}, {"db_type": "neo4j", ...}, {"db_type": "elasticsearch", ...}]). '''
+        async_io = loader_options.pop('async_io', False)
+        if async_io and loader_options.get('batch_controller') is not None:
+            raise ValueError("Loader: The async loaders (async_io=True) don't support a batch_controller; "
+                             "use max_in_flight and their chunk size options instead.")
+        if db_type == "multi":
+            self.db_connection = FanOutLoader(loader_options['targets'], metrics=self.metrics, dead_letters=self.dead_letters)
+            self.db_connection.initialize_connection()
+        if db_type == "mongodb":
+            loader_class = AsyncMongoDBLoader if async_io else MongoDBLoader
+            self.db_connection = loader_class(db_host, db_port, username, pwd, db_name, collection_name, **loader_options)
+            self.db_connection.initialize_connection()
+        if db_type == "neo4j":
+            loader_class = AsyncNeo4jLoader if async_io else Neo4jLoader
+            self.db_connection = loader_class(db_host, db_port, username, pwd, **loader_options)
+            self.db_connection.initialize_connection()
+        if db_type == "elasticsearch":
+            loader_class = AsyncElasticSearchLoader if async_io else ElasticSearchLoader
+            self.db_connection = loader_class(db_host, db_port, db_name, **loader_options)
+            self.db_connection.initialize_connection()
+        if db_type == "parquet":
+            # Not a database: db_name is the directory the partitioned dataset is written to
+            self.db_connection = ParquetLoader(db_name, **loader_options)
+            self.db_connection.initialize_connection()
+        if self.db_connection is not None:
+            self.db_connection.metrics = self.metrics # so the database loaders can count driver retries
+            if not isinstance(self.db_connection, FanOutLoader): # which has a store per sink
+                self.db_connection.dead_letters = self.dead_letters.for_sink(db_type)
+
+    def load_data(self):
+        # Initialize variables we want to count so we can output them to the log file at the end of load
+        begin = time.time()
+        i = 0
+        success_count = 0
+        fail_count = 0
+        fail_log = []
+
+        print("Loader: Loading records...")
+        self.prepare_reload()
+        if isinstance(self.db_connection, FanOutLoader):
+            sink_results = self.db_connection.flush_sinks(self.db_connection.load_records(self.data_list, self.pending_sinks()))
+            print("Loader: Finished loading records.")
+            self.metrics.record("load", time.time() - begin, len(self.data_list))
+            self.db_connection.close_connection()
+            self.log_sink_loads(sink_results)
+            return
+        if hasattr(self.db_connection, 'load_records'):
+            # The async loaders write the records one at a time too, but with several writes in flight
+            fail_log = self.db_connection.load_records(self.data_list)
+            fail_count = len(fail_log)
+            success_count = len(self.data_list) - fail_count
+        else:
+            for record in self.data_list:
+                try:
+                    self.db_connection.load_record(record)
+                    success_count += 1
+                except Exception as e:
+                    print("Couldn't load record with id: " + record['id_str'])
+                    #print(e)
+                    fail_count += 1
+                    fail_log.append(failure_for_record(record, e))
+                    self.db_connection.dead_letters.add([record], e)
+                #i += 1
+        flush_fail_count = sum(failure['count'] for failure in self.flush())
+        success_count -= flush_fail_count
+        fail_count += flush_fail_count
+
+        print("Loader: Finished loading records.")
+        end = time.time()
+        load_time = end - begin # compute time elapsed for load
+        self.metrics.record("load", load_time, success_count + fail_count)
+        self.db_connection.close_connection() # close database connection
+        self.log_load(load_time, success_count, fail_count, fail_log) # write load results to log
+
+    def load_batch_data(self):
+        print("Loader: Loading batch data!")
+        begin = time.time()
+        self.prepare_reload()
+
+        if isinstance(self.db_connection, FanOutLoader):
+            sink_results = self.db_connection.flush_sinks(self.db_connection.bulk_load_records(self.data_list, self.pending_sinks()))
+            print("Loader: Finished loading records.")
+            self.metrics.record("load", time.time() - begin, len(self.data_list))
+            self.db_connection.close_connection()
+            self.log_sink_loads(sink_results)
+            return
+
+        try:
+            fail_log = self.db_connection.bulk_load_records(self.data_list)
+            flush_fail_log = self.flush()
+            if flush_fail_log:
+                fail_log = (fail_log or []) + flush_fail_log
+        except Exception as e:
+            print("Couldn't bulk load records because: ")
+            print(str(e))
+            fail_log = str(e)
+            self.close_after_failure()
+            self.log_failure()
+            raise
+
+        print("Loader: Finished loading records.")
+        end = time.time()
+        load_time = end - begin # compute time elapsed for load
+        self.metrics.record("load", load_time, len(self.data_list))
+        self.db_connection.close_connection() # close database connection
+        success_count, fail_count = self.count_batch_results(len(self.data_list), fail_log)
+        self.log_load(load_time, success_count, fail_count, fail_log) # write load results to log
+
+    def load_stream_data(self):
+        ''' Streaming counterpart to load_batch_data(). Expects self.data_list to be an iterable of
+        cleaned chunks, such as the generator returned by Cleaner.clean_stream(), and bulk loads each
+        chunk as it arrives. The file is only logged as loaded once every chunk has been written. '''
+        print("Loader: Loading streamed batch data!")
+        begin = time.time()
+        record_count = 0
+        fail_log = []
+        self.prepare_reload()
+
+        if isinstance(self.db_connection, FanOutLoader):
+            try:
+                sink_results = self.db_connection.flush_sinks(self.db_connection.load_stream(self.data_list, self.pending_sinks()))
+            except Exception as e:
+                # The sinks catch their own errors, so the next chunk couldn't be read and cleaned
+                print("Couldn't bulk load records because: ")
+                print(str(e))
+                self.close_after_failure()
+                self.log_failure()
+                raise
+            print("Loader: Finished loading streamed records.")
+            self.db_connection.close_connection()
+            self.log_sink_loads(sink_results)
+            return
+
+        try:
+            for chunk in self.data_list:
+                with self.metrics.timer("load", len(chunk)):
+                    chunk_fail_log = self.db_connection.bulk_load_records(chunk)
+                record_count += len(chunk)
+                if isinstance(chunk_fail_log, list):
+                    fail_log.extend(chunk_fail_log)
+                elif chunk_fail_log is not None:
+                    fail_log.append(chunk_fail_log)
+            fail_log.extend(self.flush())
+        except Exception as e:
+            # Either a chunk couldn't be loaded or the next one couldn't be read and cleaned
+            print("Couldn't bulk load records because: ")
+            print(str(e))
+            self.close_after_failure()
+            self.log_failure()
+            raise
+
+        print("Loader: Finished loading " + str(record_count) + " records.")
+        end = time.time()
+        load_time = end - begin # compute time elapsed for load
+        self.db_connection.close_connection() # close database connection
+        success_count, fail_count = self.count_batch_results(record_count, fail_log)
+        self.log_load(load_time, success_count, fail_count, fail_log) # write load results to log
+
+    def flush(self):
+        ''' Has loaders that hold on to records (like ParquetLoader, which writes them in row groups)
+        write them now, so the records are counted as loaded or failed with the file they came from.
+        Returns the loader's failures (a list of dictionaries with a 'count'). '''
+        if not hasattr(self.db_connection, 'flush'):
+            return([])
+        return(self.db_connection.flush() or [])
+
+    def count_batch_results(self, record_count, fail_log):
+        ''' Bulk loaders that set counts_failures return a list of dictionaries with a 'count' of the
+        records in each failed batch (or None). For those we can work out success and failure counts
+        for the log; for anything else we fall back to 'NA'. '''
+        if not getattr(self.db_connection, 'counts_failures', False):
+            return('NA', 'NA')
+        fail_count = sum(failure['count'] for failure in (fail_log or []))
+        return(record_count - fail_count, fail_count)
+
+    def log_load(self, load_time, success_count, fail_count, fail_log):
+        ''' When load is done, record the time it took to run, number of successes, and number of failures.
+        Write this info, along with file_name, as a JSON string to a log file. Then mark the successfully
+        loaded file as loaded in the checkpoint store so we don't try to re-load it on the next iteration. '''
+
+        log_dict = dict()
+        log_dict['file_name'] = self.file_name
+        log_dict['load_time'] = load_time
+        log_dict['success_count'] = success_count
+        log_dict['fail_count'] = fail_count
+        #log_dict['fail_log'] = fail_log    # The fail log can get long! Only comment this out if you want full details into why certain tweets are failing to load.
+        loaded_files_log  = open(self.logs_path + "/loaded_files.txt", "a+") # open file in append mode
+        loaded_files_log.write(json.dumps(log_dict))
+        loaded_files_log.write("\n")
+        loaded_files_log.close()
+
+        checkpoints = CheckpointStore(self.logs_path)
+        checkpoints.set_state(self.file_name, CheckpointStore.LOADED)
+        checkpoints.close()
+
+        self.metrics.write(self.file_name)
+
+    def prepare_reload(self):
+        ''' Runs force_idempotent_reload() before a load, marking the file as failed if it can't be
+        reloaded safely. '''
+        try:
+            self.force_idempotent_reload()
+        except ValueError as e:
+            print(str(e))
+            self.close_after_failure()
+            self.log_failure()
+            raise
+
+    def force_idempotent_reload(self):
+        ''' A file that changed after it was loaded, other than by having lines appended, is loaded
+        again from the start (see Extractor.scan()), so the records that were already loaded would be
+        written twice. For such a reload, loaders with an idempotent mode are switched into it, and
+        loaders without one (e.g. ParquetLoader) raise a ValueError rather than write duplicates. '''
+        if self.logs_path is None or self.file_name is None:
+            return
+        checkpoints = CheckpointStore(self.logs_path)
+        reload = checkpoints.is_reload(self.file_name)
+        checkpoints.close()
+        if not reload:
+            return
+        if isinstance(self.db_connection, FanOutLoader):
+            sinks = self.db_connection.sinks.values()
+        else:
+            sinks = [self.db_connection]
+        for sink in sinks:
+            if not hasattr(sink, 'idempotent'):
+                raise ValueError("Loader: " + self.file_name + " changed after it was loaded, and " + type(sink).__name__
+                                 + " can't load it again without duplicating records.")
+        for sink in sinks:
+            if not sink.idempotent:
+                print("Loader: " + self.file_name + " changed after it was loaded, so " + type(sink).__name__
+                      + " loads it again in idempotent mode.")
+                sink.idempotent = True
+
+    def pending_sinks(self):
+        ''' Returns the names of the FanOutLoader's sinks this file hasn't been loaded into yet, so that
+        retrying a file that failed in one sink doesn't load it into the others a second time. '''
+        checkpoints = CheckpointStore(self.logs_path)
+        loaded_sinks = checkpoints.get_loaded_sinks(self.file_name)
+        checkpoints.close()
+        if loaded_sinks:
+            print("Loader: " + str(self.file_name) + " is already loaded into: " + ", ".join(sorted(loaded_sinks)))
+        return([name for name in self.db_connection.sinks if name not in loaded_sinks])
+
+    def log_sink_loads(self, sink_results):
+        ''' log_load() for a FanOutLoader: writes an entry per sink to loaded_files.txt, with the sink's
+        name, its own load time, success and failure counts, and the error that stopped it, if any. The
+        state of the file in each sink is saved in the checkpoint store. The file is only marked as
+        loaded once every sink has loaded it; otherwise it's marked as failed, so that it's picked up
+        again by CheckpointStore.retry_failed() and loaded into just the sinks that failed. '''
+        loaded_files_log  = open(self.logs_path + "/loaded_files.txt", "a+") # open file in append mode
+        for name, result in sink_results.items():
+            log_dict = dict()
+            log_dict['file_name'] = self.file_name
+            log_dict['sink'] = name
+            log_dict['load_time'] = result['load_time']
+            if result['fail_count'] == 'NA':
+                log_dict['success_count'] = 'NA'
+            else:
+                log_dict['success_count'] = result['record_count'] - result['fail_count']
+            log_dict['fail_count'] = result['fail_count']
+            if result['error'] is not None:
+                log_dict['error'] = result['error']
+            loaded_files_log.write(json.dumps(log_dict))
+            loaded_files_log.write("\n")
+        loaded_files_log.close()
+
+        sink_states = dict()
+        for name, result in sink_results.items():
+            sink_states[name] = CheckpointStore.LOADED if result['error'] is None else CheckpointStore.FAILED
+        checkpoints = CheckpointStore(self.logs_path)
+        checkpoints.set_sink_states(self.file_name, sink_states)
+        checkpoints.close()
+
+        failed_sinks = [name for name, state in sink_states.items() if state == CheckpointStore.FAILED]
+        if failed_sinks:
+            print("Loader: Couldn't load " + str(self.file_name) + " into: " + ", ".join(failed_sinks))
+            self.log_failure()
+        else:
+            checkpoints = CheckpointStore(self.logs_path)
+            checkpoints.set_state(self.file_name, CheckpointStore.LOADED)
+            checkpoints.close()
+
+        self.metrics.write(self.file_name)
+
+    def close_after_failure(self):
+        ''' Closes the database connection after a load failed part way through, so loaders that change
+        the database for the duration of a load put it back (e.g. ElasticSearchLoader restores the
+        indices' refresh interval and replicas). An error while closing is only printed, so that it
+        doesn't hide the error that stopped the load. '''
+        try:
+            close_after_failure(self.db_connection)
+        except Exception as e:
+            print("Loader: Couldn't close the connection after the failed load because: " + str(e))
+
+    def log_failure(self):
+        ''' Mark a file that couldn't be loaded as failed in the checkpoint store, so it's skipped for the
+        rest of this run and can be picked up again with CheckpointStore.retry_failed(). '''
+        checkpoints = CheckpointStore(self.logs_path)
+        checkpoints.set_state(self.file_name, CheckpointStore.FAILED)
+        checkpoints.close()
+
+    def close_connection(self):
+        self.db_connection.close_connection()
+
+### MongoDBLoader
+
+# http://api.mongodb.com/python/current/examples/bulk.html
 
 class MongoDBLoader:
 
-    def __init__(self, db_host, db_port, username, pwd, db_name, collection_name):
+    metrics = NO_METRICS # replaced by the Loader's Metrics in Loader.get_connection()
+    dead_letters = NO_DEAD_LETTERS # likewise, replaced by a DeadLetterStore for the sink
+
+    # bulk_load_records() returns compact failure counts, so the Loader can log success/fail counts
+    counts_failures = True
+
+    # MongoClients are thread-safe and keep their own connection pool, so we share one client per
+    # connection string across every loader in the process instead of reconnecting for every file.
+    # They aren't fork-safe, though, so clients are keyed on the process id too (see client_key()).
+    # Likewise, indexes only need to be created once per collection.
+    clients = dict()
+    indexed_collections = set()
+    sharded_collections = set()
+
+    # Write errors that mean the server is overloaded rather than that the documents are bad:
+    # MaxTimeMSExpired, WriteConcernFailed (wtimeout), ExceededTimeLimit and Cosmos DB's RequestRateTooLarge
+    overload_error_codes = {50, 64, 262, 16500}
+
+    def __init__(self, db_host, db_port, username, pwd, db_name, collection_name, chunk_size=1000, writer_threads=4,
+                 write_concern=1, journal=False, build_indexes_after_load=False, max_pool_size=100, idempotent=False,
+                 partitioner=None, partition_mode="collections", batch_controller=None, copy_documents=False):
         self.connection = None
         self.client = None
         self.username = username
@@ -374,35 +2597,253 @@ class MongoDBLoader:
         self.db_port = db_port
         self.db_name = db_name
         self.collection_name = collection_name
+        self.chunk_size = chunk_size
+        self.writer_threads = writer_threads
+        self.write_concern = write_concern
+        self.journal = journal
+        self.build_indexes_after_load = build_indexes_after_load
+        self.max_pool_size = max_pool_size
+        self.idempotent = idempotent
+        # With a GeohashPartitioner, partition_mode "collections" writes each partition to its own
+        # collection (collection_name_<prefix>), and "shard_key" writes to one collection sharded on geo_id
+        if partition_mode not in ("collections", "shard_key"):
+            raise ValueError("partition_mode must be 'collections' or 'shard_key', not: " + str(partition_mode))
+        self.partitioner = partitioner
+        self.partition_mode = partition_mode
+        self.partition_collections = dict()
+        # An AdaptiveBatchController to pick chunk sizes with, instead of the fixed chunk_size
+        self.batch_controller = batch_controller
+        # pymongo adds an _id to every dictionary it inserts; with copy_documents it inserts shallow
+        # copies instead, for records that are also being written elsewhere (see FanOutLoader)
+        self.copy_documents = copy_documents
 
-    def initialize_connection(self):
+    def document(self, record):
+        document = as_document(record)
+        if self.copy_documents and document is record:
+            return(dict(record))
+        return(document)
+
+    def replacement(self, record):
+        # The document for an idempotent upsert, without any _id the record picked up when it was
+        # inserted before (e.g. a replayed dead letter): Mongo won't replace a document's _id
+        return({key: value for key, value in as_document(record).items() if key != '_id'})
+
+    def get_connection_string(self):
         if self.username is None:
-            print("Connecting without a username")
-            self.client = pymongo.MongoClient('mongodb://' + self.db_host + ':' + self.db_port)
-        else:
-            print("Connecting with username: " + self.username)
-            self.client = pymongo.MongoClient('mongodb://' + self.username + ':' + self.pwd + '@' + self.db_host + ':' + self.db_port)
-        target_db = self.client[self.db_name]
-        target_collection = target_db[self.collection_name]
+            return('mongodb://' + self.db_host + ':' + self.db_port)
+        return('mongodb://' + self.username + ':' + self.pwd + '@' + self.db_host + ':' + self.db_port)
 
-        # Initialize index on tweet 'id' field so we throw an error when trying to load duplicates of the same tweet
-        #target_collection.create_index([("id", pymongo.ASCENDING)], name='id_index', unique=True)
-        target_collection.create_index([("geo_id", pymongo.ASCENDING)], name='geo_id_index', unique=True)
+    @staticmethod
+    def client_key(connection_string):
+        # A process forked from one that already had a client (e.g. a Pipeline load worker) inherits
+        # the cache, but has to open its own client rather than use the copy of its parent's
+        return((os.getpid(), connection_string))
+
+    def initialize_connection(self):
+        client_key = MongoDBLoader.client_key(self.get_connection_string())
+        if client_key not in MongoDBLoader.clients:
+            if self.username is None:
+                print("Connecting without a username")
+            else:
+                print("Connecting with username: " + self.username)
+            MongoDBLoader.clients[client_key] = pymongo.MongoClient(self.get_connection_string(), maxPoolSize=self.max_pool_size)
+        self.client = MongoDBLoader.clients[client_key]
+        target_collection = self.client[self.db_name].get_collection(self.collection_name, write_concern=self.get_write_concern())
         self.connection = target_collection
 
+        if self.partitioner is not None and self.partition_mode == "shard_key":
+            self.shard_collection()
+
+        # With build_indexes_after_load, call create_indexes() yourself once the load is finished;
+        # building the index once is cheaper than maintaining it on every insert.
+        if not self.build_indexes_after_load:
+            self.create_indexes()
+
+    def get_write_concern(self):
+        return(WriteConcern(w=self.write_concern, j=self.journal))
+
+    def get_collection(self, partition=None):
+        ''' Returns the collection a partition's records go to: its own collection in "collections"
+        mode, otherwise the one collection we're loading. '''
+        if partition is None or self.partition_mode != "collections":
+            return(self.connection)
+        if partition not in self.partition_collections:
+            collection_name = self.partitioner.target_name(self.collection_name, partition)
+            collection = self.client[self.db_name].get_collection(collection_name, write_concern=self.get_write_concern())
+            self.partition_collections[partition] = collection
+            if not self.build_indexes_after_load:
+                self.create_collection_indexes(collection)
+        return(self.partition_collections[partition])
+
+    def create_indexes(self):
+        self.create_collection_indexes(self.connection)
+        for collection in self.partition_collections.values():
+            self.create_collection_indexes(collection)
+
+    def create_collection_indexes(self, collection):
+        index_key = (self.db_host, self.db_port, self.db_name, collection.name)
+        if index_key in MongoDBLoader.indexed_collections:
+            return
+        # Initialize index on tweet 'id' field so we throw an error when trying to load duplicates of the same tweet
+        #collection.create_index([("id", pymongo.ASCENDING)], name='id_index', unique=True)
+        collection.create_index([("geo_id", pymongo.ASCENDING)], name='geo_id_index', unique=True)
+        MongoDBLoader.indexed_collections.add(index_key)
+
+    def shard_collection(self):
+        ''' Shards the collection on geo_id (through a mongos router) and pre-splits it into one chunk
+        per geohash prefix, so the balancer can spread the regions over the shards before the load
+        starts instead of every write landing in one ever-growing chunk. geo_id starts with the
+        centroid geohash, so each region stays together in a range of chunks. '''
+        namespace = self.db_name + "." + self.collection_name
+        shard_key = (self.db_host, self.db_port, namespace)
+        if shard_key in MongoDBLoader.sharded_collections:
+            return
+        try:
+            self.client.admin.command('enableSharding', self.db_name)
+            self.client.admin.command('shardCollection', namespace, key={'geo_id': 1})
+            for prefix in self.partitioner.all_prefixes()[1:]:
+                self.client.admin.command('split', namespace, middle={'geo_id': prefix})
+            print("MongoDBLoader: Sharded " + namespace + " into " + str(32 ** self.partitioner.precision) + " chunks.")
+        except pymongo.errors.OperationFailure as e:
+            # e.g. the collection is already sharded, or we're not connected to a sharded cluster
+            print("MongoDBLoader: Couldn't shard " + namespace + " because: " + str(e))
+        MongoDBLoader.sharded_collections.add(shard_key)
+
     def load_record(self, record):
-        self.connection.insert_one(record)
+        partition = self.partitioner.partition_key(record) if self.partitioner is not None else None
+        if self.idempotent:
+            self.get_collection(partition).replace_one({'geo_id': record['geo_id']}, self.replacement(record), upsert=True)
+        else:
+            self.get_collection(partition).insert_one(self.document(record))
 
     def bulk_load_records(self, record_list):
+        ''' Splits the records into chunks of chunk_size and writes them with unordered insert_many
+        calls from writer_threads threads at once, all sharing the client's connection pool. In
+        idempotent mode, each chunk is written as unordered upserts keyed on geo_id instead, so
+        reloading a file after a crash just overwrites what's already there. With a partitioner, the
+        records are grouped by partition first, so every chunk goes to a single partition. With a
+        batch_controller, the chunk sizes come from it instead of chunk_size.
+
+        Returns None if every record loaded, otherwise a list with one entry per error code. '''
+        begin = time.time()
+        with ThreadPoolExecutor(max_workers=self.writer_threads) as executor:
+            if self.batch_controller is None:
+                collections, chunks = self.plan_chunks(record_list)
+                results = list(executor.map(self.insert_chunk, collections, chunks))
+            else:
+                partitions = self.partitioner.group(record_list) if self.partitioner is not None else {None: record_list}
+                groups = [(self.get_collection(partition), records) for partition, records in partitions.items()]
+                results = submit_adaptive_chunks(executor, self.writer_threads, self.batch_controller, groups,
+                                                 self.insert_chunk_adaptively)
+                print("MongoDBLoader: " + self.batch_controller.summary() + ".")
+        return(self.report_results(results, begin))
+
+    def plan_chunks(self, record_list):
+        ''' Splits the records into chunks of at most chunk_size, none of which spans two partitions.
+        Returns a list of the collection each chunk goes to, and a list of the chunks. '''
+        if self.partitioner is not None:
+            partitions = self.partitioner.group(record_list)
+        else:
+            partitions = {None: record_list}
+        collections = []
+        chunks = []
+        for partition, records in partitions.items():
+            collection = self.get_collection(partition)
+            for i in range(0, len(records), self.chunk_size):
+                collections.append(collection)
+                chunks.append(records[i:i + self.chunk_size])
+        return(collections, chunks)
+
+    def report_results(self, results, begin):
+        ''' Takes the (written, error details) pair from each chunk, prints the write rate and returns
+        the failures grouped by error code, or None if every record loaded. '''
+        written_count = sum(written for written, details in results)
+        load_time = time.time() - begin
+        if load_time > 0:
+            print("MongoDBLoader: Wrote " + str(written_count) + " documents at "
+                  + str(int(written_count / load_time)) + " docs/sec.")
+
+        failures = dict()
+        for written, details in results:
+            if details is not None:
+                self.summarize_write_errors(failures, details)
+        if failures:
+            return(list(failures.values()))
+
+    def insert_chunk(self, collection, chunk):
+        ''' Returns the number of documents written and the BulkWriteError details, if there were any. '''
         try:
-            self.connection.insert_many(record_list, ordered = False)
+            if self.idempotent:
+                result = collection.bulk_write(self.upsert_requests(chunk), ordered = False)
+                return(result.upserted_count + result.matched_count, None)
+            collection.insert_many([self.document(record) for record in chunk], ordered = False)
+            return(len(chunk), None)
         except pymongo.errors.BulkWriteError as bwe:
-            fail_log = dumps(bwe.details)
-            return(fail_log)
+            self.dead_letter_write_errors(chunk, bwe.details)
+            return(self.count_written(bwe.details), bwe.details)
+        except pymongo.errors.PyMongoError as e:
+            # e.g. the primary went away mid-load: keep the chunk to replay rather than failing the whole file
+            return(0, self.chunk_error_details(chunk, e))
+
+    def insert_chunk_adaptively(self, collection, chunk):
+        ''' insert_chunk(), reporting how the write went to the batch controller. '''
+        begin = time.perf_counter()
+        written, details = self.insert_chunk(collection, chunk)
+        seconds = time.perf_counter() - begin
+        self.batch_controller.record(len(chunk), seconds, rejected=self.count_overloaded(details))
+        self.metrics.record("mongodb.bulk_write", seconds, len(chunk))
+        return(written, details)
+
+    def count_overloaded(self, details):
+        if details is None:
+            return(0)
+        overloaded = sum(1 for write_error in details.get('writeErrors', []) if write_error['code'] in self.overload_error_codes)
+        return(overloaded + len(details.get('writeConcernErrors', [])))
+
+    def upsert_requests(self, chunk):
+        return([pymongo.ReplaceOne({'geo_id': record['geo_id']}, self.replacement(record), upsert=True) for record in chunk])
+
+    def count_written(self, details):
+        return(details.get('nInserted', 0) + details.get('nUpserted', 0) + details.get('nMatched', 0))
+
+    def dead_letter_write_errors(self, chunk, details):
+        # Each write error has the index of the failed document in the chunk
+        self.dead_letters.add_entries([(chunk[write_error['index']], "WriteError",
+                                        "code " + str(write_error['code']) + ": " + write_error['errmsg'])
+                                       for write_error in details['writeErrors']])
 
+    def chunk_error_details(self, chunk, error):
+        ''' Dead-letters a chunk that failed as a whole, and describes the failure the way a
+        BulkWriteError would, with a write error per document, so it's counted like one. '''
+        print("MongoDBLoader: Couldn't write a chunk of " + str(len(chunk)) + " documents because: " + str(error))
+        self.dead_letters.add(chunk, error)
+        error_class = type(error).__name__
+        write_errors = [{'index': index, 'code': error_class, 'errmsg': str(error)} for index in range(len(chunk))]
+        return({'nInserted': 0, 'writeErrors': write_errors})
+
+    def summarize_write_errors(self, failures, details):
+        ''' Tallies the write errors from a BulkWriteError by error code, keeping just the first error
+        message for each code, instead of logging the driver's full error report (which includes a
+        copy of every failed document). '''
+        for write_error in details['writeErrors']:
+            code = write_error['code']
+            if code not in failures:
+                failures[code] = {'code': code, 'count': 0, 'error': write_error['errmsg'][:200]}
+            failures[code]['count'] += 1
+        if details.get('writeConcernErrors'):
+            failures.setdefault('write_concern', {'code': 'write_concern', 'count': 0,
+                                                  'error': details['writeConcernErrors'][0]['errmsg'][:200]})
+            failures['write_concern']['count'] += len(details['writeConcernErrors'])
 
     def close_connection(self):
-        self.client.close()
+        pass # the client is shared; use MongoDBLoader.close_all_clients() once the whole run is done
+
+    @staticmethod
+    def close_all_clients():
+        for (pid, connection_string), client in MongoDBLoader.clients.items():
+            if pid == os.getpid(): # the others belong to the process we were forked from
+                client.close()
+        MongoDBLoader.clients.clear()
 
 
 ### Neo4jLoader
@@ -412,12 +2853,66 @@ class MongoDBLoader:
 
 class Neo4jLoader:
 
-    def __init__(self, db_host, db_port, username, pwd):
+    metrics = NO_METRICS # replaced by the Loader's Metrics in Loader.get_connection()
+    dead_letters = NO_DEAD_LETTERS # likewise, replaced by a DeadLetterStore for the sink
+
+    # bulk_load_records() reports failures per batch, so the Loader can log success/fail counts
+    counts_failures = True
+
+    # Constraints and indexes backing the MERGEs in the load queries. Users and Places can't be unique
+    # constraints: mentioned users are MERGEd on name and screen_name too, and Places on their centroid.
+    # This is the syntax of Neo4j 4.4 and later; see schema_statements_for() for older servers.
+    schema_statements = [
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (t:Tweet) REQUIRE t.tweet_id IS UNIQUE",
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (h:Hashtag) REQUIRE h.hashtag_id IS UNIQUE",
+        "CREATE INDEX IF NOT EXISTS FOR (u:User) ON (u.user_id)",
+        "CREATE INDEX IF NOT EXISTS FOR (p:Place) ON (p.place_id)"
+    ]
+
+    # The same for servers before 4.4 (this syntax was removed in 5.0)
+    legacy_schema_statements = [
+        "CREATE CONSTRAINT ON (t:Tweet) ASSERT t.tweet_id IS UNIQUE",
+        "CREATE CONSTRAINT ON (h:Hashtag) ASSERT h.hashtag_id IS UNIQUE",
+        "CREATE INDEX ON :User(user_id)",
+        "CREATE INDEX ON :Place(place_id)"
+    ]
+
+    # Point properties get a native spatial index, for distance/bounding box queries on Places: a point
+    # index in 5.x, and the default (B-tree) index, which covers points, in 3.4 to 4.4
+    spatial_index_statements = {
+        'point': "CREATE POINT INDEX IF NOT EXISTS FOR (p:Place) ON (p.centroid)",
+        'modern': "CREATE INDEX IF NOT EXISTS FOR (p:Place) ON (p.centroid)",
+        'legacy': "CREATE INDEX ON :Place(centroid)"
+    }
+
+    server_version_query = "CALL dbms.components() YIELD versions RETURN versions[0] AS version"
+
+    # The query parameters for a tweet: every column in TWEET_FIELDS but the ones the graph doesn't store
+    row_fields = TWEET_FIELDS.select([name for name in TWEET_FIELDS.names if name not in ('geo_id', 'place_centroid_geohash')])
+    unused_columns = tuple(set(TWEET_FIELDS.names) - set(row_fields.names)) # dropped from CompactTweet.flatten()
+
+    # The Place and User properties we last wrote to each database, by (host, port); see split_dimensions()
+    dimension_caches = dict()
+
+    def __init__(self, db_host, db_port, username, pwd, batch_size=1000, max_retries=3, retry_backoff=0.5,
+                 create_schema=True, spatial_index=False, idempotent=True, dedupe_dimensions=True,
+                 dimension_cache_size=100000, batch_controller=None):
         self.connection = None
+        self.session = None
         self.username = username
         self.pwd = pwd
         self.db_host = db_host
         self.db_port = db_port
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.create_schema = create_schema
+        self.spatial_index = spatial_index
+        self.idempotent = idempotent # the load queries only MERGE, so loads are always idempotent
+        self.dedupe_dimensions = dedupe_dimensions
+        self.dimension_cache_size = dimension_cache_size
+        # An AdaptiveBatchController to pick batch sizes with, instead of the fixed batch_size
+        self.batch_controller = batch_controller
 
         self.neo4j_query_string = """
             MERGE (t:Tweet {tweet_id: toInteger($tweet_id)})
@@ -488,84 +2983,440 @@ class Neo4jLoader:
                 MERGE (t)-[:HASHTAGS]->(h)
             """
 
-    def initialize_connection(self):
-        # Initialize Neo4j driver and start a session
-        uri = 'bolt://' + self.db_host + ':' + self.db_port
-        driver = GraphDatabase.driver(uri, auth=(self.username, self.pwd))
-        self.connection = driver
-
-    def load_record(self, record):
-        try:
-            with self.connection.session() as session:
-                tx = session.begin_transaction()
-                self.structure_data_for_load(tx, record)
-                tx.commit()
-        except Exception as e:
-            print(e)
+        # Same graph as neo4j_query_string, but for a whole batch of flattened records at once. Mentions
+        # and hashtags use FOREACH so a tweet with no mentions still gets its hashtags.
+        self.neo4j_bulk_query_string = """
+            UNWIND $rows AS row
+            MERGE (t:Tweet {tweet_id: toInteger(row.tweet_id)})
+            ON CREATE SET t.text = row.text,
+                t.lang = row.lang,
+                t.timestamp_ms = toInteger(row.timestamp_ms),
+                t.favorited = row.favorited,
+                t.retweeted = row.retweeted,
+                t.retweet_count = toInteger(row.retweet_count),
+                t.favorite_count = toInteger(row.favorite_count),
+                t.quote_count = toInteger(row.quote_count),
+                t.reply_count = toInteger(row.reply_count),
+                t.coordinates = point({
+                    longitude: toFloat(row.tweet_coordinates_long),
+                    latitude: toFloat(row.tweet_coordinates_lat)
+                })
 
-    #@staticmethod
-    def structure_data_for_load(self, tx, data_element):
-        tx.run(self.neo4j_query_string, parameters={
-            'tweet_id': data_element['id_str'],
-            'text': data_element['text'],
-            'lang': data_element['lang'],
-            'timestamp_ms': data_element['timestamp_ms'],
-            'favorited': data_element['favorited'],
-            'retweeted': data_element['retweeted'],
-            'retweet_count': data_element['retweet_count'],
-            'favorite_count': data_element['favorite_count'],
-            'quote_count': data_element['quote_count'],
-            'reply_count': data_element['reply_count'],
-            'tweet_coordinates_long': data_element['coordinates']['coordinates'][0] if data_element['coordinates'] != None else None,
-            'tweet_coordinates_lat': data_element['coordinates']['coordinates'][1] if data_element['coordinates'] != None else None,
-            'user_id': data_element['user']['id'],
-            'user_name': data_element['user']['name'],
-            'user_screen_name': data_element['user']['screen_name'],
-            'user_description': data_element['user']['description'],
-            'user_location': data_element['user']['location'],
-            'user_lang': data_element['user']['lang'],
-            'user_time_zone': data_element['user']['time_zone'],
-            'user_verified': data_element['user']['verified'],
-            'user_utc_offset': data_element['user']['utc_offset'],
-            'user_created_at': data_element['user']['created_at'],
-            'user_listed_count': data_element['user']['listed_count'],
-            'user_friends_count': data_element['user']['friends_count'],
-            'user_followers_count': data_element['user']['followers_count'],
-            'user_favourites_count': data_element['user']['favourites_count'],
-            'user_is_translator': data_element['user']['is_translator'],
-            'user_statuses_count': data_element['user']['statuses_count'],
-            'place_id': data_element['place']['id'],
-            'place_name': data_element['place']['name'],
-            'place_full_name': data_element['place']['full_name'],
-            'place_country': data_element['place']['country'],
-            'place_country_code': data_element['place']['country_code'],
-            'place_type': data_element['place']['place_type'],
-            'place_bounding_box_LL_long': data_element['place']['better_bounding_box']['coordinates'][0][0][0],
-            'place_bounding_box_LL_lat': data_element['place']['better_bounding_box']['coordinates'][0][0][1],
-            'place_bounding_box_UR_long': data_element['place']['better_bounding_box']['coordinates'][0][2][0],
-            'place_bounding_box_UR_lat': data_element['place']['better_bounding_box']['coordinates'][0][2][1],
-            'place_centroid_long': data_element['place']['centroid']['coordinates'][0],
-            'place_centroid_lat': data_element['place']['centroid']['coordinates'][1],
-            'entities_user_mentions': data_element['entities']['user_mentions'],
-            'entities_hashtags': data_element['entities']['hashtags']
-        })
+            MERGE (u:User {user_id: toInteger(row.user_id)})
+            SET	u.name = row.user_name,
+                u.screen_name = row.user_screen_name,
+                u.description = row.user_description,
+                u.location = row.user_location,
+                u.lang = row.user_lang,
+                u.time_zone = row.user_time_zone,
+                u.verified = row.user_verified,
+                u.utc_offset = row.user_utc_offset,
+                u.created_at = row.user_created_at,
+                u.listed_count = row.user_listed_count,
+                u.friends_count = row.user_friends_count,
+                u.followers_count = row.user_followers_count,
+                u.favourites_count = row.user_favourites_count,
+                u.is_translator = row.user_is_translator,
+                u.statuses_count = row.user_statuses_count
 
-    def close_connection(self):
-        self.connection.close()
+            MERGE (t)-[:TWEETED_BY]->(u)
+            MERGE (u)-[:TWEETED]->(t)
 
+            MERGE (p:Place {place_id: toString(row.place_id), latitude: toFloat(row.place_centroid_lat), longitude: toFloat(row.place_centroid_long)})
+            SET	p.name = row.place_name,
+                p.full_name = row.place_full_name,
+                p.country = row.place_country,
+                p.country_code = row.place_country_code,
+                p.place_type = row.place_type,
+                p.bounding_box_LL = point({
+                    longitude: toFloat(row.place_bounding_box_LL_long),
+                    latitude: toFloat(row.place_bounding_box_LL_lat)
+                }),
+                p.bounding_box_UR = point({
+                    longitude: toFloat(row.place_bounding_box_UR_long),
+                    latitude: toFloat(row.place_bounding_box_UR_lat)
+                }),
+                p.centroid = point({
+                    longitude: toFloat(row.place_centroid_long),
+                    latitude: toFloat(row.place_centroid_lat)
+                })
 
-### ElasticSearchLoader
+            MERGE (t)-[:LOCATED_AT]->(p)
 
-# https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
+            FOREACH (mention IN row.entities_user_mentions |
+                MERGE (mentioned_user:User {user_id: toInteger(mention.id), name: mention.name, screen_name: mention.screen_name})
+                MERGE (t)-[:MENTIONS]->(mentioned_user))
 
-class ElasticSearchLoader:
+            FOREACH (hashtag IN row.entities_hashtags |
+                MERGE (h:Hashtag {hashtag_id: hashtag.text})
+                MERGE (t)-[:HASHTAGS]->(h))
+            """
 
-    def __init__(self, db_host, db_port, db_name):
-        self.connection = None
-        self.client = None
-        self.db_host = db_host
-        self.db_port = db_port
+        # With dedupe_dimensions, a batch is written as three statements in one transaction: each distinct
+        # Place and User that changed since we last wrote it, then the tweets, which only link to them.
+        self.neo4j_bulk_place_query_string = """
+            UNWIND $places AS place
+            MERGE (p:Place {place_id: toString(place.place_id), latitude: toFloat(place.place_centroid_lat), longitude: toFloat(place.place_centroid_long)})
+            SET	p.name = place.place_name,
+                p.full_name = place.place_full_name,
+                p.country = place.place_country,
+                p.country_code = place.place_country_code,
+                p.place_type = place.place_type,
+                p.bounding_box_LL = point({
+                    longitude: toFloat(place.place_bounding_box_LL_long),
+                    latitude: toFloat(place.place_bounding_box_LL_lat)
+                }),
+                p.bounding_box_UR = point({
+                    longitude: toFloat(place.place_bounding_box_UR_long),
+                    latitude: toFloat(place.place_bounding_box_UR_lat)
+                }),
+                p.centroid = point({
+                    longitude: toFloat(place.place_centroid_long),
+                    latitude: toFloat(place.place_centroid_lat)
+                })
+            """
+
+        self.neo4j_bulk_user_query_string = """
+            UNWIND $users AS user
+            MERGE (u:User {user_id: toInteger(user.user_id)})
+            SET	u.name = user.user_name,
+                u.screen_name = user.user_screen_name,
+                u.description = user.user_description,
+                u.location = user.user_location,
+                u.lang = user.user_lang,
+                u.time_zone = user.user_time_zone,
+                u.verified = user.user_verified,
+                u.utc_offset = user.user_utc_offset,
+                u.created_at = user.user_created_at,
+                u.listed_count = user.user_listed_count,
+                u.friends_count = user.user_friends_count,
+                u.followers_count = user.user_followers_count,
+                u.favourites_count = user.user_favourites_count,
+                u.is_translator = user.user_is_translator,
+                u.statuses_count = user.user_statuses_count
+            """
+
+        self.neo4j_bulk_tweet_query_string = """
+            UNWIND $rows AS row
+            MERGE (t:Tweet {tweet_id: toInteger(row.tweet_id)})
+            ON CREATE SET t.text = row.text,
+                t.lang = row.lang,
+                t.timestamp_ms = toInteger(row.timestamp_ms),
+                t.favorited = row.favorited,
+                t.retweeted = row.retweeted,
+                t.retweet_count = toInteger(row.retweet_count),
+                t.favorite_count = toInteger(row.favorite_count),
+                t.quote_count = toInteger(row.quote_count),
+                t.reply_count = toInteger(row.reply_count),
+                t.coordinates = point({
+                    longitude: toFloat(row.tweet_coordinates_long),
+                    latitude: toFloat(row.tweet_coordinates_lat)
+                })
+
+            MERGE (u:User {user_id: toInteger(row.user_id)})
+            MERGE (t)-[:TWEETED_BY]->(u)
+            MERGE (u)-[:TWEETED]->(t)
+
+            MERGE (p:Place {place_id: toString(row.place_id), latitude: toFloat(row.place_centroid_lat), longitude: toFloat(row.place_centroid_long)})
+            MERGE (t)-[:LOCATED_AT]->(p)
+
+            FOREACH (mention IN row.entities_user_mentions |
+                MERGE (mentioned_user:User {user_id: toInteger(mention.id), name: mention.name, screen_name: mention.screen_name})
+                MERGE (t)-[:MENTIONS]->(mentioned_user))
+
+            FOREACH (hashtag IN row.entities_hashtags |
+                MERGE (h:Hashtag {hashtag_id: hashtag.text})
+                MERGE (t)-[:HASHTAGS]->(h))
+            """
+
+    def initialize_connection(self):
+        # Initialize Neo4j driver and start a session
+        uri = 'bolt://' + self.db_host + ':' + self.db_port
+        driver = GraphDatabase.driver(uri, auth=(self.username, self.pwd))
+        self.connection = driver
+        self.initialize_dimension_cache()
+
+        if self.create_schema:
+            self.initialize_schema()
+
+    def initialize_dimension_cache(self):
+        cache_key = (self.db_host, self.db_port)
+        if cache_key not in Neo4jLoader.dimension_caches:
+            Neo4jLoader.dimension_caches[cache_key] = {'place': LRUCache(self.dimension_cache_size),
+                                                       'user': LRUCache(self.dimension_cache_size)}
+        self.dimension_cache = Neo4jLoader.dimension_caches[cache_key]
+
+    def initialize_schema(self):
+        ''' Creates the constraints and indexes the load queries MERGE on, so each MERGE is an index
+        lookup instead of a label scan. Safe to run on every connection: indexes and constraints that
+        already exist are left alone. The statements are written in the syntax of the server's version
+        (see schema_statements_for()), and an error from any of them is raised rather than loading
+        without the index. Waits for the indexes to come online before returning so the first batches
+        don't fall back to scans. '''
+        with self.connection.session() as session:
+            server_version = session.run(self.server_version_query).single()['version']
+            for statement in self.schema_statements_for(server_version):
+                try:
+                    session.run(statement).consume()
+                except Exception:
+                    # Without these, every MERGE is a label scan, so don't carry on without them
+                    print("Neo4jLoader: Couldn't run schema statement: " + statement)
+                    raise
+            session.run("CALL db.awaitIndexes(300)").consume()
+        print("Neo4jLoader: Schema is ready.")
+
+    def schema_statements_for(self, server_version):
+        ''' The schema statements (see initialize_schema()) in the syntax of a Neo4j server of the given
+        version string, e.g. "5.12.0". '''
+        version = tuple(int(part) for part in re.findall(r"\d+", server_version)[:2])
+        if version >= (4, 4):
+            statements = list(self.schema_statements)
+            spatial_index_statement = self.spatial_index_statements['point' if version >= (5, 0) else 'modern']
+        else:
+            statements = list(self.legacy_schema_statements)
+            spatial_index_statement = self.spatial_index_statements['legacy']
+        if self.spatial_index:
+            statements.append(spatial_index_statement)
+        return(statements)
+
+    def benchmark_load(self, record_list, step_size=1000):
+        ''' Bulk loads record_list in steps of step_size records, timing each step and counting the
+        nodes in the graph before it. If the MERGEs are index-backed, the per-record latency should
+        stay roughly flat as the node count grows. Returns a list with one dictionary per step. '''
+        results = []
+        for start in range(0, len(record_list), step_size):
+            step = record_list[start:start + step_size]
+            with self.connection.session() as session:
+                node_count = session.run("MATCH (n) RETURN count(n) AS node_count").single()['node_count']
+            begin = time.time()
+            fail_log = self.bulk_load_records(step)
+            step_time = time.time() - begin
+            result = dict()
+            result['node_count'] = node_count
+            result['records'] = len(step)
+            result['failed_batches'] = len(fail_log) if fail_log else 0
+            result['load_time'] = step_time
+            result['ms_per_record'] = 1000 * step_time / len(step)
+            print("Neo4jLoader: " + json.dumps(result))
+            results.append(result)
+        return(results)
+
+    def load_record(self, record):
+        # Errors are left to the caller (Loader.load_data() counts and dead-letters the record)
+        with self.connection.session() as session:
+            tx = session.begin_transaction()
+            self.structure_data_for_load(tx, record)
+            tx.commit()
+
+    def bulk_load_records(self, record_list):
+        ''' Loads the records in batches of batch_size, sending each batch as a list of flattened
+        parameter maps to neo4j_bulk_query_string in a single transaction. Reuses one session for every
+        batch and retries batches that fail with a transient error (e.g. a deadlock). With
+        dedupe_dimensions, each distinct Place and User is written once per batch, and not at all if
+        it's unchanged since we last wrote it (see split_dimensions()). With a batch_controller, the
+        batch sizes come from it instead of batch_size, and transient errors count as rejections.
+        Returns None if every batch loaded, otherwise a list with one entry per failed batch. '''
+        fail_log = []
+        start = 0
+        while start < len(record_list):
+            batch_size = self.batch_controller.next_size() if self.batch_controller is not None else self.batch_size
+            batch = record_list[start:start + batch_size]
+            try:
+                begin = time.perf_counter()
+                rows = self.flatten_records(batch)
+                if self.dedupe_dimensions:
+                    tweet_rows, places, users = self.split_dimensions(rows)
+                    retries = self.write_batch(tweet_rows, places, users)
+                    self.remember_dimensions(places, users)
+                else:
+                    retries = self.write_batch(rows)
+                if self.batch_controller is not None:
+                    self.batch_controller.record(len(batch), time.perf_counter() - begin, rejected=retries)
+            except Exception as e:
+                print("Neo4jLoader: Couldn't load batch starting at record " + str(start) + " because: " + str(e))
+                fail_dict = dict()
+                fail_dict['first_id'] = batch[0].get('id_str')
+                fail_dict['count'] = len(batch)
+                fail_dict['error'] = str(e)
+                fail_log.append(fail_dict)
+                self.dead_letters.add(batch, e)
+            start += len(batch)
+        if self.batch_controller is not None:
+            print("Neo4jLoader: " + self.batch_controller.summary() + ".")
+        if fail_log:
+            return(fail_log)
+
+    def split_dimensions(self, rows):
+        ''' Splits flattened rows into tweet rows that only carry the ids of their User and Place, plus
+        the distinct Places and Users in the batch (the last row wins, as it would with the SETs in
+        neo4j_bulk_query_string). Places and Users whose properties are the same as the last time we
+        wrote them to this database are dropped. '''
+        places = dict()
+        users = dict()
+        tweet_rows = []
+        for row in rows:
+            tweet_row = dict()
+            place = dict()
+            user = dict()
+            for key, value in row.items():
+                if key.startswith('place_'):
+                    place[key] = value
+                elif key.startswith('user_'):
+                    user[key] = value
+                else:
+                    tweet_row[key] = value
+            place_key = (place['place_id'], place['place_centroid_lat'], place['place_centroid_long'])
+            tweet_row['user_id'] = user['user_id']
+            tweet_row['place_id'], tweet_row['place_centroid_lat'], tweet_row['place_centroid_long'] = place_key
+            tweet_rows.append(tweet_row)
+            places[place_key] = place
+            users[user['user_id']] = user
+
+        place_cache = self.dimension_cache['place']
+        user_cache = self.dimension_cache['user']
+        changed_places = [place for place_key, place in places.items() if place_cache.get(place_key) != place]
+        changed_users = [user for user_id, user in users.items() if user_cache.get(user_id) != user]
+        self.metrics.increment("neo4j.place_writes_skipped", len(rows) - len(changed_places))
+        self.metrics.increment("neo4j.user_writes_skipped", len(rows) - len(changed_users))
+        return(tweet_rows, changed_places, changed_users)
+
+    def remember_dimensions(self, places, users):
+        ''' Called once a batch has committed, so a failed batch's Places and Users are written again. '''
+        for place in places:
+            self.dimension_cache['place'].put((place['place_id'], place['place_centroid_lat'], place['place_centroid_long']), place)
+        for user in users:
+            self.dimension_cache['user'].put(user['user_id'], user)
+
+    @staticmethod
+    def clear_dimension_caches():
+        ''' Forget which Places and Users have been written, e.g. after emptying the database. '''
+        Neo4jLoader.dimension_caches.clear()
+
+    def batch_statements(self, rows, places=None, users=None):
+        ''' The (query, parameters) pairs to run in one transaction to write a batch; see write_batch(). '''
+        if places is None:
+            return([(self.neo4j_bulk_query_string, {'rows': rows})])
+        statements = []
+        if places:
+            statements.append((self.neo4j_bulk_place_query_string, {'places': places}))
+        if users:
+            statements.append((self.neo4j_bulk_user_query_string, {'users': users}))
+        statements.append((self.neo4j_bulk_tweet_query_string, {'rows': rows}))
+        return(statements)
+
+    def write_batch(self, rows, places=None, users=None):
+        ''' Runs one UNWIND transaction for a batch of rows, retrying with exponential backoff if
+        Neo4j reports a transient error such as a deadlock between concurrent writers. If places and
+        users are given, the rows are tweet rows from split_dimensions(), and the Places and Users are
+        written first in the same transaction. Returns the number of retries it took. '''
+        attempt = 0
+        while True:
+            session = self.get_session()
+            tx = session.begin_transaction()
+            try:
+                for query, parameters in self.batch_statements(rows, places, users):
+                    tx.run(query, parameters=parameters)
+                tx.commit()
+                return(attempt)
+            except TransientError:
+                if not tx.closed():
+                    tx.rollback()
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.metrics.increment("neo4j.transient_error_retries")
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            except Exception:
+                if not tx.closed():
+                    tx.rollback()
+                self.reset_session() # start the next batch on a clean session
+                raise
+
+    def get_session(self):
+        if self.session is None:
+            self.session = self.connection.session()
+        return(self.session)
+
+    def reset_session(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    #@staticmethod
+    def structure_data_for_load(self, tx, data_element):
+        tx.run(self.neo4j_query_string, parameters=self.flatten_record(data_element))
+
+    def flatten_record(self, data_element):
+        ''' Pulls the fields we store in the graph (row_fields) out of a cleaned record into a flat
+        dictionary of query parameters. '''
+        if isinstance(data_element, CompactTweet):
+            return(self.flatten_compact(data_element))
+        return(self.row_fields.extract(data_element))
+
+    def flatten_records(self, batch):
+        ''' flatten_record() for a whole batch, with the loop in row_fields' compiled code. '''
+        with self.metrics.timer("neo4j.flatten", len(batch)):
+            if batch and isinstance(batch[0], CompactTweet):
+                return([self.flatten_compact(tweet) for tweet in batch])
+            return(self.row_fields.extract_batch(batch))
+
+    def flatten_compact(self, tweet):
+        row = tweet.flatten()
+        for name in self.unused_columns:
+            del row[name]
+        return(row)
+
+    def close_connection(self):
+        self.reset_session()
+        self.connection.close()
+
+
+### ElasticSearchLoader
+
+# https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
+
+class ElasticSearchLoader:
+
+    metrics = NO_METRICS # replaced by the Loader's Metrics in Loader.get_connection()
+    dead_letters = NO_DEAD_LETTERS # likewise, replaced by a DeadLetterStore for the sink
+
+    # bulk_load_records() returns failures grouped by status with a 'count', so the Loader can log counts
+    counts_failures = True
+
+    # The indices we've switched to the load settings (see prepare_index_for_load()), by (process id,
+    # host, port, index name), with the client that did it and each index's original settings. Like
+    # MongoDBLoader.clients, they're shared by every loader in the process, so an index is tuned once
+    # and stays tuned from one file to the next; use ElasticSearchLoader.restore_all_indices() once
+    # the whole run is done.
+    tuned_indices = dict()
+
+    def __init__(self, db_host, db_port, db_name, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024, thread_count=4,
+                 max_retries=3, retry_backoff=2, tune_index_for_load=True, idempotent=False, partitioner=None,
+                 partition_mode="indices", number_of_shards=1, batch_controller=None):
+        self.connection = None
+        self.client = None
+        self.db_host = db_host
+        self.db_port = db_port
         self.db_name = db_name
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.tune_index_for_load = tune_index_for_load
+        self.loading = False # whether prepare_index_for_load() has run, so new indices are tuned as they're created
+        self.idempotent = idempotent
+        # With a GeohashPartitioner, partition_mode "indices" writes each partition to its own index
+        # (db_name_<prefix>), and "routing" writes to one index of number_of_shards shards, routing
+        # documents to a shard by partition
+        if partition_mode not in ("indices", "routing"):
+            raise ValueError("partition_mode must be 'indices' or 'routing', not: " + str(partition_mode))
+        self.partitioner = partitioner
+        self.partition_mode = partition_mode
+        self.number_of_shards = number_of_shards
+        self.created_indices = set()
+        # An AdaptiveBatchController to pick request sizes with, instead of chunk_size and max_chunk_bytes
+        self.batch_controller = batch_controller
 
     def initialize_connection(self):
         #self.client = Elasticsearch([{'host': self.db_host, 'port': self.db_port}])
@@ -574,84 +3425,1319 @@ class ElasticSearchLoader:
         # Check if we can connect successfully
         if self.client.ping():
             print("Connected to ElasticSearch instance.")
+            # Partitioned indices are created as their first documents come in; see create_partition_indices()
+            if not self.uses_partition_indices():
+                self.create_index(self.db_name)
+        else:
+            print("Couldn't connect to ElasticSearch instance.")
 
-            print("Checking for existence of index called: " + str(self.db_name))
-            # If we're successfully connected, then create a new index (aka database) in ElasticSearch to hold the data
-            if not self.client.indices.exists(self.db_name):
-                # Define settings for the new index
-                settings = {
-                    "settings": {
-                        "number_of_shards": 1,
-                        "number_of_replicas": 0
-                    },
-                    "mappings": {
-                        "tweet": {
-                            "properties": {
-                                "text": {
-                                    "type": "text"
-                                },
-                                "timestamp_ms": {
-                                    "type": "date"
-                                },
-                                "place": {
-                                    "properties": {
-#                                         "centroid": {
-#                                             "type": "geo_point"
-#                                         },
-                                        "better_bounding_box": {
-                                            "type": "geo_shape"
-                                        },
-                                        "centroid_geohash": {
-                                             "type": "geo_point"
-                                        }
+    def create_index(self, index_name):
+        print("Checking for existence of index called: " + str(index_name))
+        # If we're successfully connected, then create a new index (aka database) in ElasticSearch to hold the data
+        if not self.client.indices.exists(index_name):
+            # Define settings for the new index
+            settings = {
+                "settings": {
+                    "number_of_shards": self.number_of_shards,
+                    "number_of_replicas": 0
+                },
+                "mappings": {
+                    "tweet": {
+                        "properties": {
+                            "text": {
+                                "type": "text"
+                            },
+                            "timestamp_ms": {
+                                "type": "date"
+                            },
+                            "place": {
+                                "properties": {
+#                                     "centroid": {
+#                                         "type": "geo_point"
+#                                     },
+                                    "better_bounding_box": {
+                                        "type": "geo_shape"
+                                    },
+                                    "centroid_geohash": {
+                                         "type": "geo_point"
                                     }
                                 }
                             }
                         }
                     }
                 }
+            }
 
-                try:
-                    self.client.indices.create(index=self.db_name, body=settings)
-                    print("Created new ElasticSearch index named: " + self.db_name)
-                except Exception as e:
-                    print("Couldn't create new index because: ")
-                    print(e)
+            if self.loading:
+                # created in the middle of a load, so start it off with the load settings
+                settings["settings"]["refresh_interval"] = "-1"
+
+            try:
+                self.client.indices.create(index=index_name, body=settings)
+                print("Created new ElasticSearch index named: " + index_name)
+                if self.loading:
+                    # and give it the settings above back when the run is done
+                    ElasticSearchLoader.tuned_indices[self.index_key(index_name)] = (self.client, {"refresh_interval": "1s", "number_of_replicas": "0"})
+            except Exception as e:
+                print("Couldn't create new index because: ")
+                print(e)
+        elif self.loading and self.index_key(index_name) not in ElasticSearchLoader.tuned_indices:
+            self.tune_index(index_name)
+        self.created_indices.add(index_name)
+
+    def uses_partition_indices(self):
+        return(self.partitioner is not None and self.partition_mode == "indices")
+
+    def create_partition_indices(self, record_list):
+        for partition in set(self.partitioner.partition_key(record) for record in record_list):
+            index_name = self.partitioner.target_name(self.db_name, partition)
+            if index_name not in self.created_indices:
+                self.create_index(index_name)
+
+    def target_for(self, record):
+        ''' Returns the index a record goes to and its routing value (None for the default routing). '''
+        if self.partitioner is None:
+            return(self.db_name, None)
+        partition = self.partitioner.partition_key(record)
+        if self.partition_mode == "indices":
+            return(self.partitioner.target_name(self.db_name, partition), None)
+        return(self.db_name, partition)
+
+    def load_record(self, record):
+        # Errors are left to the caller (Loader.load_data() counts and dead-letters the record)
+        if self.uses_partition_indices():
+            self.create_partition_indices([record])
+        index_name, routing = self.target_for(record)
+        if self.idempotent:
+            self.client.index(index=index_name, doc_type='tweet', id=self.document_id(record), body=as_document(record), routing=routing)
         else:
-            print("Couldn't connect to ElasticSearch instance.")
+            self.client.index(index=index_name, doc_type='tweet', body=as_document(record), routing=routing)
+
+    def bulk_load_records(self, record_list):
+        ''' Streams the records to Elasticsearch's bulk API with the parallel_bulk helper, which splits
+        them into requests of at most chunk_size documents and max_chunk_bytes bytes and sends
+        thread_count requests at a time. Items the cluster rejects because it's overloaded (429) or
+        broken (5xx) are retried with exponential backoff, up to max_retries times; everything else that
+        fails is reported right away. No refresh is forced; see prepare_index_for_load().
+
+        With a batch_controller, the requests are built here instead, at sizes picked by the controller
+        from their latency, 429s and size in bytes (see send_chunk()).
+
+        Returns None if every record loaded, otherwise a list with one entry per failure status. '''
+        if self.tune_index_for_load and not self.loading:
+            self.prepare_index_for_load()
+        if self.uses_partition_indices():
+            self.create_partition_indices(record_list)
+
+        failures = dict()
+        if self.batch_controller is not None:
+            self.send_adaptive_chunks(record_list, failures)
+            pending_records = [] # sent already
+        else:
+            pending_records = record_list
+        attempt = 0
+        while pending_records:
+            retry_ids = set()
+            failed_items = dict() # document id -> (status, error)
+            results = elasticsearch.helpers.parallel_bulk(self.client, self.generate_actions(pending_records),
+                                                          thread_count=self.thread_count,
+                                                          chunk_size=self.chunk_size,
+                                                          max_chunk_bytes=self.max_chunk_bytes,
+                                                          raise_on_error=False,
+                                                          raise_on_exception=False)
+            for ok, item in results:
+                if ok:
+                    continue
+                op_type, info = item.popitem()
+                status = info.get('status')
+                if self.is_retryable(status) and attempt < self.max_retries:
+                    retry_ids.add(str(info.get('_id')))
+                else:
+                    self.add_failure(failures, status, info.get('error'))
+                    failed_items[str(info.get('_id'))] = (status, info.get('error'))
+            if failed_items:
+                self.dead_letter_items([(record, failed_items[str(self.document_id(record))]) for record in pending_records
+                                        if str(self.document_id(record)) in failed_items])
+
+            if not retry_ids:
+                break
+            attempt += 1
+            self.metrics.increment("elasticsearch.retried_records", len(retry_ids))
+            print("ElasticSearchLoader: Retrying " + str(len(retry_ids)) + " rejected records (attempt " + str(attempt) + ").")
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            pending_records = [record for record in pending_records if str(self.document_id(record)) in retry_ids]
+
+        if failures:
+            return(list(failures.values()))
+
+    def send_adaptive_chunks(self, record_list, failures):
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            chunk_failures = submit_adaptive_chunks(executor, self.thread_count, self.batch_controller,
+                                                    [(None, record_list)], lambda target, chunk: self.send_chunk(chunk))
+        print("ElasticSearchLoader: " + self.batch_controller.summary() + ".")
+        for chunk_failure in chunk_failures:
+            for status, error in chunk_failure:
+                self.add_failure(failures, status, error)
+
+    def send_chunk(self, chunk):
+        ''' Sends one bulk request, retrying the items that were rejected with a 429 or 5xx with
+        exponential backoff, and reports each request to the batch controller. Returns a (status,
+        error) pair for every item that failed for good. '''
+        failed = []
+        pending_records = chunk
+        attempt = 0
+        while pending_records:
+            body = self.bulk_body(pending_records, self.client.transport.serializer)
+            begin = time.perf_counter()
+            try:
+                response = self.client.bulk(body=body)
+                retry_records, rejected = self.sort_bulk_items(pending_records, response['items'], attempt, failed)
+            except elasticsearch.TransportError as e:
+                retry_records, rejected = self.sort_transport_error(pending_records, e, attempt, failed)
+            seconds = time.perf_counter() - begin
+            self.batch_controller.record(len(pending_records), seconds, rejected=rejected, payload_bytes=len(body))
+            self.metrics.record("elasticsearch.bulk_request", seconds, len(pending_records), len(body))
+
+            if not retry_records:
+                break
+            attempt += 1
+            self.metrics.increment("elasticsearch.retried_records", len(retry_records))
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            pending_records = retry_records
+        return(failed)
+
+    def bulk_body(self, record_list, serializer):
+        ''' The newline-delimited body of a bulk request that indexes the records. '''
+        lines = []
+        for action in self.generate_actions(record_list):
+            source = action.pop("_source")
+            lines.append(serializer.dumps({"index": action}))
+            lines.append(serializer.dumps(source))
+        return("\n".join(lines) + "\n")
+
+    def sort_bulk_items(self, record_list, items, attempt, failed):
+        ''' Goes through the items of a bulk response. Adds a (status, error) pair to failed for every
+        item that failed for good, and returns the records to retry and the number of 429s. '''
+        retry_records = []
+        failed_items = []
+        rejected = 0
+        for record, item in zip(record_list, items):
+            op_type, info = item.popitem()
+            status = info.get('status')
+            if isinstance(status, int) and status < 300:
+                continue
+            if status == 429:
+                rejected += 1
+            if self.is_retryable(status) and attempt < self.max_retries:
+                retry_records.append(record)
+            else:
+                failed.append((status, info.get('error')))
+                failed_items.append((record, (status, info.get('error'))))
+        self.dead_letter_items(failed_items)
+        return(retry_records, rejected)
+
+    def sort_transport_error(self, record_list, error, attempt, failed):
+        ''' Same as sort_bulk_items(), for a bulk request that failed as a whole. '''
+        rejected = len(record_list) if error.status_code == 429 else 0
+        if self.is_retryable(error.status_code) and attempt < self.max_retries:
+            return(record_list, rejected)
+        failed.extend([(error.status_code, error.error)] * len(record_list))
+        self.dead_letter_items([(record, (error.status_code, error.error)) for record in record_list])
+        return([], rejected)
+
+    def dead_letter_items(self, failed_items):
+        ''' Dead-letters (record, (status, error)) pairs, using Elasticsearch's error type as the error
+        class when there is one. '''
+        entries = []
+        for record, (status, error) in failed_items:
+            if isinstance(error, dict) and 'type' in error:
+                entries.append((record, error['type'], error.get('reason', error)))
+            else:
+                entries.append((record, "status " + str(status), error))
+        self.dead_letters.add_entries(entries)
+
+    def generate_actions(self, record_list):
+        for record in record_list:
+            index_name, routing = self.target_for(record)
+            action = {
+                "_index": index_name,
+                "_type": "tweet",
+                "_id": self.document_id(record),
+                "_source": as_document(record)
+            }
+            if routing is not None:
+                action["_routing"] = routing
+            yield action
+
+    def document_id(self, record):
+        ''' Setting an _id field automatically adds a uniqueness constraint in Elasticsearch, and indexing
+        a document with an existing _id overwrites it. In idempotent mode we key documents on geo_id,
+        like the other loaders. '''
+        if self.idempotent:
+            return(record['geo_id'])
+        return(record['id'])
+
+    def is_retryable(self, status):
+        return(isinstance(status, int) and (status == 429 or status >= 500))
+
+    def add_failure(self, failures, status, error):
+        ''' Tallies a failed item under its status code, keeping just the first error message as an example. '''
+        if status not in failures:
+            failures[status] = {'status': status, 'count': 0, 'error': str(error)}
+        failures[status]['count'] += 1
+
+    def prepare_index_for_load(self):
+        ''' Turns off periodic refreshes and replicas for the duration of the run, so Elasticsearch
+        doesn't build new segments or copy every document to a replica while we're writing. Only the
+        indices we've created or checked (created_indices) are touched, never other indices that
+        happen to share their name; partition indices that come up later in the load are tuned by
+        create_index(). An index that's already been tuned in this process (by this loader or one for
+        an earlier file) is left alone, so its settings aren't flipped back and forth from file to
+        file. Each index's original settings are saved in tuned_indices. '''
+        for index_name in sorted(self.created_indices):
+            if self.index_key(index_name) not in ElasticSearchLoader.tuned_indices:
+                self.tune_index(index_name)
+        self.loading = True
+
+    def index_key(self, index_name):
+        # A process forked from one that had tuned an index (e.g. a Pipeline load worker) inherits
+        # tuned_indices, but the parent is the one that puts those settings back
+        return((os.getpid(), self.db_host, self.db_port, index_name))
+
+    def tune_index(self, index_name):
+        ''' Saves one index's refresh interval and replica count and switches it to the load settings. '''
+        all_settings = self.client.indices.get_settings(index=index_name)
+        index_settings = list(all_settings.values())[0]['settings']['index'] # keyed on the concrete index, if index_name is an alias
+        ElasticSearchLoader.tuned_indices[self.index_key(index_name)] = (self.client, {
+            "refresh_interval": index_settings.get("refresh_interval", "1s"),
+            "number_of_replicas": index_settings.get("number_of_replicas", "1")
+        })
+        self.client.indices.put_settings(index=index_name, body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+        print("ElasticSearchLoader: Disabled refresh and replicas on " + index_name + " for the load.")
+
+    @staticmethod
+    def restore_index(client, index_name, index_settings):
+        ''' Puts back an index's original settings and refreshes it once, so the loaded documents are
+        searchable. '''
+        client.indices.put_settings(index=index_name, body={"index": index_settings})
+        client.indices.refresh(index=index_name)
+        print("ElasticSearchLoader: Restored the settings of " + index_name + ".")
+
+    def restore_index_settings(self):
+        ''' Puts back the settings of the indices this loader has written to, e.g. after a failed load.
+        They'll be tuned again if a later load writes to them. '''
+        for index_name in sorted(self.created_indices):
+            tuned_index = ElasticSearchLoader.tuned_indices.pop(self.index_key(index_name), None)
+            if tuned_index is not None:
+                client, index_settings = tuned_index
+                ElasticSearchLoader.restore_index(client, index_name, index_settings)
+        self.loading = False
+
+    @staticmethod
+    def restore_all_indices():
+        ''' Puts back the settings of every index tuned in this process. Call it once the whole run is
+        done, like MongoDBLoader.close_all_clients(). '''
+        for (pid, db_host, db_port, index_name), (client, index_settings) in list(ElasticSearchLoader.tuned_indices.items()):
+            if pid == os.getpid(): # the others belong to the process we were forked from
+                ElasticSearchLoader.restore_index(client, index_name, index_settings)
+        ElasticSearchLoader.tuned_indices.clear()
+
+    def close_connection(self):
+        # the Elasticsearch Python driver doesn't implement a connection close method, and the index
+        # settings are held until restore_all_indices()
+        pass
+
+    def close_after_failure(self):
+        ''' A failed load doesn't leave its indices with refreshes and replicas turned off. '''
+        try:
+            self.restore_index_settings()
+        finally:
+            self.close_connection()
+
+
+### ParquetLoader
+
+# https://arrow.apache.org/docs/python/parquet.html#partitioned-datasets-multiple-files
+
+class ParquetLoader:
+    '''
+    Writes cleaned records to a partitioned dataset of Parquet (or Arrow IPC) files instead of a
+    database, so they can be analysed without extracting them again. Records are flattened into the
+    columns in schema_fields and split into Hive-style partitions by the first geohash_precision
+    characters of the place centroid's geohash and the (UTC) day of the tweet, e.g.:
+
+        output_path/geohash_prefix=9q8/day=2018-01-01/part-<uuid>.parquet
+
+    Readers such as pyarrow.dataset (partitioning="hive") can then skip partitions by location or day
+    and read only the columns they need. Each loader keeps one file open per partition it has written
+    to, until close_connection(), and holds on to a partition's rows until there are row_group_size
+    of them to write as one row group, so a load doesn't leave behind a flood of small files and row
+    groups. Every loader writes its own files, so concurrent load workers don't collide. flush()
+    writes whatever is still held, and the Loader calls it before counting the records it loaded. '''
+
+    metrics = NO_METRICS # replaced by the Loader's Metrics in Loader.get_connection()
+    dead_letters = NO_DEAD_LETTERS # likewise, replaced by a DeadLetterStore for the sink
+
+    # bulk_load_records() returns a list of failures with a 'count', so the Loader can log counts
+    counts_failures = True
+
+    # (column name, Arrow type name) for every flattened column. The columns are read from cleaned records
+    # as TWEET_FIELDS reads them, except mentions and hashtags, which are stored as lists of screen names
+    # and hashtag texts.
+    schema_fields = [
+        ('geo_id', 'string'),
+        ('tweet_id', 'string'),
+        ('timestamp_ms', 'int64'),
+        ('text', 'string'),
+        ('lang', 'string'),
+        ('favorited', 'bool'),
+        ('retweeted', 'bool'),
+        ('retweet_count', 'int64'),
+        ('favorite_count', 'int64'),
+        ('quote_count', 'int64'),
+        ('reply_count', 'int64'),
+        ('tweet_coordinates_long', 'float64'),
+        ('tweet_coordinates_lat', 'float64'),
+        ('user_id', 'int64'),
+        ('user_name', 'string'),
+        ('user_screen_name', 'string'),
+        ('user_location', 'string'),
+        ('user_lang', 'string'),
+        ('user_verified', 'bool'),
+        ('user_followers_count', 'int64'),
+        ('user_friends_count', 'int64'),
+        ('user_statuses_count', 'int64'),
+        ('place_id', 'string'),
+        ('place_name', 'string'),
+        ('place_full_name', 'string'),
+        ('place_country', 'string'),
+        ('place_country_code', 'string'),
+        ('place_type', 'string'),
+        ('place_bounding_box_LL_long', 'float64'),
+        ('place_bounding_box_LL_lat', 'float64'),
+        ('place_bounding_box_UR_long', 'float64'),
+        ('place_bounding_box_UR_lat', 'float64'),
+        ('place_centroid_long', 'float64'),
+        ('place_centroid_lat', 'float64'),
+        ('place_centroid_geohash', 'string'),
+        ('entities_user_mentions', 'list<string>'),
+        ('entities_hashtags', 'list<string>')
+    ]
+    list_paths = {
+        'entities_user_mentions': 'entities.user_mentions.*.screen_name?',
+        'entities_hashtags': 'entities.hashtags.*.text?'
+    }
+    row_fields = TWEET_FIELDS.select([name for name, type_name in schema_fields], list_paths)
+    unused_columns = tuple(set(TWEET_FIELDS.names) - set(row_fields.names)) # dropped from CompactTweet.flatten()
+
+    def __init__(self, output_path, geohash_precision=3, file_format="parquet", compression="snappy",
+                 row_group_size=100000):
+        if pyarrow is None:
+            raise ImportError("ParquetLoader needs pyarrow: pip install pyarrow")
+        if file_format not in ("parquet", "arrow"):
+            raise ValueError("file_format must be 'parquet' or 'arrow', not: " + str(file_format))
+        self.output_path = output_path
+        self.geohash_precision = geohash_precision
+        self.file_format = file_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.connection = None
+        self.schema = None
+        self.buffered_records = [] # from load_record(), not yet sorted into partitions
+        self.partition_buffers = dict() # (geohash_prefix, day) -> (records, rows) held for the next row group
+        self.writers = dict() # (geohash_prefix, day) -> (writer, file) for the partition's open file
+
+    def initialize_connection(self):
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path)
+        arrow_types = {
+            'string': pyarrow.string(),
+            'int64': pyarrow.int64(),
+            'float64': pyarrow.float64(),
+            'bool': pyarrow.bool_(),
+            'list<string>': pyarrow.list_(pyarrow.string())
+        }
+        self.schema = pyarrow.schema([(name, arrow_types[type_name]) for name, type_name in self.schema_fields])
+        self.connection = self.output_path
+        print("ParquetLoader: Writing " + self.file_format + " files to: " + self.output_path)
+
+    def load_record(self, record):
+        # Writing a row group per record would make for tiny row groups, so hold on to records loaded
+        # one at a time until flush()
+        self.buffered_records.append(record)
+
+    def bulk_load_records(self, record_list):
+        ''' Sorts the records into partitions and writes a row group for each partition that now holds
+        at least row_group_size rows; the rest wait for more records or flush(). Returns None if
+        everything written so far was written, otherwise a list with one entry per partition that
+        failed (with the records held for it, which are dead-lettered). '''
+        partitions = dict()
+        for record in record_list:
+            partitions.setdefault(self.partition_key(record), []).append(record)
+
+        fail_log = []
+        for partition, records in partitions.items():
+            try:
+                rows = self.flatten_records(records)
+            except Exception as e:
+                self.add_failure(fail_log, partition, records, e)
+                continue
+            buffered_records, buffered_rows = self.partition_buffers.setdefault(partition, ([], []))
+            buffered_records.extend(records)
+            buffered_rows.extend(rows)
+            if len(buffered_rows) >= self.row_group_size:
+                self.write_buffered(partition, fail_log)
+        if fail_log:
+            return(fail_log)
+
+    def flush(self):
+        ''' Writes every record still held, however few there are for a partition. Returns None if
+        they were all written, otherwise a list with one entry per partition that failed. '''
+        buffered_records = self.buffered_records
+        self.buffered_records = []
+        fail_log = self.bulk_load_records(buffered_records) or []
+        for partition in list(self.partition_buffers):
+            self.write_buffered(partition, fail_log)
+        if fail_log:
+            return(fail_log)
+
+    def write_buffered(self, partition, fail_log):
+        records, rows = self.partition_buffers.pop(partition)
+        try:
+            self.write_partition(partition, rows)
+        except Exception as e:
+            self.add_failure(fail_log, partition, records, e)
+
+    def add_failure(self, fail_log, partition, records, error):
+        geohash_prefix, day = partition
+        print("ParquetLoader: Couldn't write partition " + geohash_prefix + "/" + day + " because: " + str(error))
+        fail_dict = dict()
+        fail_dict['partition'] = "geohash_prefix=" + geohash_prefix + "/day=" + day
+        fail_dict['count'] = len(records)
+        fail_dict['error'] = str(error)
+        fail_log.append(fail_dict)
+        self.dead_letters.add(records, error)
+
+    def partition_key(self, record):
+        geohash_prefix = centroid_geohash(record)[:self.geohash_precision]
+        day = time.strftime('%Y-%m-%d', time.gmtime(int(record['timestamp_ms']) / 1000))
+        return((geohash_prefix, day))
+
+    def write_partition(self, partition, rows):
+        ''' Appends rows to the partition's open file as a row group (or record batch), opening a new
+        file for the partition first if we don't have one. If the write fails, the file is closed, so
+        the row groups already in it stay readable, and the partition's next rows go to a new file. '''
+        table = pyarrow.Table.from_pylist(rows, schema=self.schema)
+        writer, sink = self.get_writer(partition)
+        try:
+            if self.file_format == "parquet":
+                writer.write_table(table, row_group_size=self.row_group_size)
+            else:
+                writer.write_table(table)
+        except Exception:
+            self.close_writer(partition)
+            raise
+
+    def get_writer(self, partition):
+        if partition not in self.writers:
+            geohash_prefix, day = partition
+            partition_path = os.path.join(self.output_path, "geohash_prefix=" + geohash_prefix, "day=" + day)
+            if not os.path.exists(partition_path):
+                os.makedirs(partition_path, exist_ok=True) # another load worker may have just made it
+            part_name = "part-" + uuid.uuid4().hex
+            if self.file_format == "parquet":
+                writer = pyarrow.parquet.ParquetWriter(os.path.join(partition_path, part_name + ".parquet"), self.schema,
+                                                       compression=self.compression)
+                self.writers[partition] = (writer, None)
+            else:
+                sink = pyarrow.OSFile(os.path.join(partition_path, part_name + ".arrow"), "wb")
+                self.writers[partition] = (pyarrow.ipc.new_file(sink, self.schema), sink)
+        return(self.writers[partition])
+
+    def close_writer(self, partition):
+        writer, sink = self.writers.pop(partition)
+        try:
+            writer.close()
+        finally:
+            if sink is not None:
+                sink.close()
+
+    def flatten_record(self, data_element):
+        ''' Pulls the columns in schema_fields out of a cleaned record. Mentions and hashtags are
+        stored as lists of screen names and hashtag texts. '''
+        if isinstance(data_element, CompactTweet):
+            return(self.flatten_compact(data_element))
+        return(self.row_fields.extract(data_element))
+
+    def flatten_records(self, records):
+        with self.metrics.timer("parquet.flatten", len(records)):
+            if records and isinstance(records[0], CompactTweet):
+                return([self.flatten_compact(tweet) for tweet in records])
+            return(self.row_fields.extract_batch(records))
+
+    def flatten_compact(self, tweet):
+        row = tweet.flatten()
+        for name in self.unused_columns:
+            del row[name]
+        row['entities_user_mentions'] = [mention[3] for mention in tweet.user_mentions]
+        row['entities_hashtags'] = list(tweet.hashtags)
+        return(row)
+
+    def close_connection(self):
+        ''' Writes anything still held and closes every open file, which writes the file footers. '''
+        fail_log = self.flush()
+        close_errors = []
+        for partition in list(self.writers):
+            try:
+                self.close_writer(partition)
+            except Exception as e:
+                close_errors.append(str(e))
+        if fail_log:
+            raise IOError("ParquetLoader: Couldn't write " + str(sum(failure['count'] for failure in fail_log))
+                          + " buffered records.")
+        if close_errors:
+            raise IOError("ParquetLoader: Couldn't close " + str(len(close_errors)) + " files: " + close_errors[0])
+
+### Async Loaders
+
+# Counterparts to MongoDBLoader, ElasticSearchLoader and Neo4jLoader built on asyncio drivers. They
+# have the same interface as the synchronous loaders, but keep up to max_in_flight requests going at
+# once, so a single process isn't left waiting on one network round-trip at a time. Each loader runs
+# its own event loop in a background thread, so they can be called from ordinary code (or from a
+# notebook, which already has an event loop running).
+
+class EventLoopThread:
+    ''' An asyncio event loop running in a daemon thread. run() blocks until a coroutine finishes on
+    it and returns the result. '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        return(asyncio.run_coroutine_threadsafe(coroutine, self.loop).result())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+async def run_limited(max_in_flight, coroutines):
+    ''' Awaits the coroutines with at most max_in_flight of them running at once. Returns their results
+    in order. '''
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def run_one(coroutine):
+        async with semaphore:
+            return(await coroutine)
+
+    return(await asyncio.gather(*[run_one(coroutine) for coroutine in coroutines]))
+
+def failure_for_record(record, error):
+    fail_dict = dict()
+    fail_dict['id'] = record['id_str']
+    fail_dict['error'] = str(error)
+    return(fail_dict)
+
+# https://motor.readthedocs.io/en/stable/tutorial-asyncio.html
+
+class AsyncMongoDBLoader(MongoDBLoader):
+    ''' MongoDBLoader on the motor driver. Bulk loads send up to max_in_flight insert_many (or
+    upsert) chunks at once instead of using writer threads. '''
+
+    def __init__(self, db_host, db_port, username, pwd, db_name, collection_name, max_in_flight=8, **loader_options):
+        if motor_asyncio is None:
+            raise ImportError("AsyncMongoDBLoader needs motor: pip install motor")
+        super().__init__(db_host, db_port, username, pwd, db_name, collection_name, **loader_options)
+        self.max_in_flight = max_in_flight
+        self.event_loop = None
+
+    def initialize_connection(self):
+        # motor clients belong to the event loop they're used on, so each loader has its own client
+        self.event_loop = EventLoopThread()
+        self.client = self.event_loop.run(self.connect())
+        self.connection = self.client[self.db_name].get_collection(self.collection_name, write_concern=self.get_write_concern())
+
+        if self.partitioner is not None and self.partition_mode == "shard_key":
+            self.shard_collection()
+        if not self.build_indexes_after_load:
+            self.create_indexes()
+
+    async def connect(self):
+        return(motor_asyncio.AsyncIOMotorClient(self.get_connection_string(), maxPoolSize=self.max_pool_size))
+
+    def create_collection_indexes(self, collection):
+        index_key = (self.db_host, self.db_port, self.db_name, collection.name)
+        if index_key in MongoDBLoader.indexed_collections:
+            return
+        self.event_loop.run(collection.create_index([("geo_id", pymongo.ASCENDING)], name='geo_id_index', unique=True))
+        MongoDBLoader.indexed_collections.add(index_key)
+
+    def shard_collection(self):
+        # The admin commands are a one-off, so let a synchronous loader run them
+        admin_loader = MongoDBLoader(self.db_host, self.db_port, self.username, self.pwd, self.db_name, self.collection_name,
+                                     build_indexes_after_load=True, partitioner=self.partitioner, partition_mode="shard_key")
+        admin_loader.initialize_connection()
 
     def load_record(self, record):
+        self.event_loop.run(self.write_record(record, self.get_collection(self.record_partition(record))))
+
+    def load_records(self, record_list):
+        ''' Writes the records one at a time, with up to max_in_flight writes outstanding. Returns a
+        list with the id and error of every record that failed. '''
+        collections = [self.get_collection(self.record_partition(record)) for record in record_list]
+        results = self.event_loop.run(run_limited(self.max_in_flight, [self.try_write_record(record, collection)
+                                                                       for record, collection in zip(record_list, collections)]))
+        return([failure for failure in results if failure is not None])
+
+    def record_partition(self, record):
+        return(self.partitioner.partition_key(record) if self.partitioner is not None else None)
+
+    async def write_record(self, record, collection):
+        if self.idempotent:
+            await collection.replace_one({'geo_id': record['geo_id']}, self.replacement(record), upsert=True)
+        else:
+            await collection.insert_one(self.document(record))
+
+    async def try_write_record(self, record, collection):
         try:
-            self.client.index(index=self.db_name, doc_type='tweet', body=record)
+            await self.write_record(record, collection)
         except Exception as e:
-            print(e)
+            print("Couldn't load record with id: " + record['id_str'])
+            self.dead_letters.add([record], e)
+            return(failure_for_record(record, e))
 
     def bulk_load_records(self, record_list):
-        ''' Elasticsearch's bulk API requires each row of data to be interpolated
-        with a separate options list that specifies the index to save the data to,
-        along with a unique id and the mapping type to use when loading the record.
-        So, we'll append a dictionary of options in front of every line of data
-        before loading the whole thing in bulk into the database. '''
-        bulk_data_formatted = []
-        for record in record_list:
-            op_dict = {
-                "index": {
-                    "_index": self.db_name,
-                    "_type": "tweet",
-                    "_id": record['id'] # Setting an _id field automatically adds a uniqueness constraint in Elasticsearch
-                }
-            }
-            bulk_data_formatted.append(op_dict)
-            bulk_data_formatted.append(record)
+        ''' Same chunks and failure report as MongoDBLoader.bulk_load_records(), but the chunks are
+        sent max_in_flight at a time from the event loop. '''
+        begin = time.time()
+        collections, chunks = self.plan_chunks(record_list)
+        results = self.event_loop.run(run_limited(self.max_in_flight, [self.insert_chunk_async(collection, chunk)
+                                                                       for collection, chunk in zip(collections, chunks)]))
+        return(self.report_results(results, begin))
+
+    async def insert_chunk_async(self, collection, chunk):
+        try:
+            if self.idempotent:
+                result = await collection.bulk_write(self.upsert_requests(chunk), ordered = False)
+                return(result.upserted_count + result.matched_count, None)
+            await collection.insert_many([self.document(record) for record in chunk], ordered = False)
+            return(len(chunk), None)
+        except pymongo.errors.BulkWriteError as bwe:
+            self.dead_letter_write_errors(chunk, bwe.details)
+            return(self.count_written(bwe.details), bwe.details)
+        except pymongo.errors.PyMongoError as e:
+            return(0, self.chunk_error_details(chunk, e))
+
+    def close_connection(self):
+        self.client.close()
+        self.event_loop.stop()
+
+# https://elasticsearch-py.readthedocs.io/en/v7.17.0/async.html
+
+class AsyncElasticSearchLoader(ElasticSearchLoader):
+    ''' ElasticSearchLoader on AsyncElasticsearch. Bulk loads are split into requests of chunk_size
+    documents, up to max_in_flight of which are sent at once; items rejected with a 429 or 5xx are
+    retried like in ElasticSearchLoader. Creating and tuning the index is left to a synchronous client. '''
+
+    def __init__(self, db_host, db_port, db_name, max_in_flight=8, **loader_options):
+        if AsyncElasticsearch is None:
+            raise ImportError("AsyncElasticSearchLoader needs AsyncElasticsearch: pip install 'elasticsearch[async]>=7.8' "
+                              "(or elasticsearch-async for elasticsearch-py 6)")
+        super().__init__(db_host, db_port, db_name, **loader_options)
+        self.max_in_flight = max_in_flight
+        self.async_client = None
+        self.event_loop = None
+
+    def initialize_connection(self):
+        super().initialize_connection()
+        self.event_loop = EventLoopThread()
+        self.async_client = self.event_loop.run(self.connect())
 
+    async def connect(self):
+        return(AsyncElasticsearch([self.db_host], port=self.db_port, timeout=2000))
+
+    def load_record(self, record):
+        if self.uses_partition_indices():
+            self.create_partition_indices([record])
+        self.event_loop.run(self.index_record(record))
+
+    def load_records(self, record_list):
+        ''' Indexes the records one at a time, with up to max_in_flight requests outstanding. Returns a
+        list with the id and error of every record that failed. '''
+        if self.uses_partition_indices():
+            self.create_partition_indices(record_list)
+        results = self.event_loop.run(run_limited(self.max_in_flight, [self.try_index_record(record) for record in record_list]))
+        return([failure for failure in results if failure is not None])
+
+    async def index_record(self, record):
+        index_name, routing = self.target_for(record)
+        if self.idempotent:
+            await self.async_client.index(index=index_name, doc_type='tweet', id=self.document_id(record), body=as_document(record), routing=routing)
+        else:
+            await self.async_client.index(index=index_name, doc_type='tweet', body=as_document(record), routing=routing)
+
+    async def try_index_record(self, record):
         try:
-            result = self.client.bulk(body = bulk_data_formatted, refresh=True)
-            #result = requests.put("http://" + self.db_host + ":" + self.db_port, data = bulk_data_formatted)
-            return(result)
-        except elasticsearch.ElasticsearchException as es_error:
-            print(es_error)
-            fail_log = dumps(es_error)
+            await self.index_record(record)
+        except Exception as e:
+            print("Couldn't load record with id: " + record['id_str'])
+            self.dead_letters.add([record], e)
+            return(failure_for_record(record, e))
+
+    def bulk_load_records(self, record_list):
+        ''' Returns None if every record loaded, otherwise a list with one entry per failure status. '''
+        if self.tune_index_for_load and not self.loading:
+            self.prepare_index_for_load()
+        if self.uses_partition_indices():
+            self.create_partition_indices(record_list)
+
+        chunks = [record_list[i:i + self.chunk_size] for i in range(0, len(record_list), self.chunk_size)]
+        chunk_failures = self.event_loop.run(run_limited(self.max_in_flight, [self.send_chunk(chunk) for chunk in chunks]))
+        failures = dict()
+        for chunk_failure in chunk_failures:
+            for status, error in chunk_failure:
+                self.add_failure(failures, status, error)
+        if failures:
+            return(list(failures.values()))
+
+    async def send_chunk(self, chunk):
+        ''' Sends one bulk request, retrying the items that were rejected with a 429 or 5xx with
+        exponential backoff. Returns a (status, error) pair for every item that failed for good. '''
+        serializer = self.async_client.transport.serializer
+        failed = []
+        pending_records = chunk
+        attempt = 0
+        while pending_records:
+            try:
+                response = await self.async_client.bulk(body=self.bulk_body(pending_records, serializer))
+                retry_records, rejected = self.sort_bulk_items(pending_records, response['items'], attempt, failed)
+            except elasticsearch.TransportError as e:
+                retry_records, rejected = self.sort_transport_error(pending_records, e, attempt, failed)
+
+            if not retry_records:
+                break
+            attempt += 1
+            self.metrics.increment("elasticsearch.retried_records", len(retry_records))
+            await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            pending_records = retry_records
+        return(failed)
+
+    def close_connection(self):
+        super().close_connection()
+        self.event_loop.run(self.async_client.close())
+        self.event_loop.stop()
+
+# https://neo4j.com/docs/api/python-driver/current/async_api.html
+
+class AsyncNeo4jLoader(Neo4jLoader):
+    ''' Neo4jLoader on the async API of the 5.x neo4j driver. Bulk loads run up to max_in_flight batch
+    transactions at once, each in its own session; the driver retries transient errors such as
+    deadlocks between them. With the 5.x driver installed, Neo4jLoader uses it too (GraphDatabase
+    comes from neo4j rather than the 1.x driver's neo4j.v1). '''
+
+    def __init__(self, db_host, db_port, username, pwd, max_in_flight=4, **loader_options):
+        if AsyncGraphDatabase is None:
+            raise ImportError("AsyncNeo4jLoader needs the 5.x neo4j driver: pip install 'neo4j>=5'")
+        super().__init__(db_host, db_port, username, pwd, **loader_options)
+        self.max_in_flight = max_in_flight
+        self.event_loop = None
+
+    def initialize_connection(self):
+        self.event_loop = EventLoopThread()
+        self.connection = self.event_loop.run(self.connect())
+        self.initialize_dimension_cache()
+        if self.create_schema:
+            self.event_loop.run(self.initialize_schema_async())
+
+    async def connect(self):
+        uri = 'bolt://' + self.db_host + ':' + self.db_port
+        return(AsyncGraphDatabase.driver(uri, auth=(self.username, self.pwd)))
+
+    async def initialize_schema_async(self):
+        async with self.connection.session() as session:
+            result = await session.run(self.server_version_query)
+            server_version = (await result.single())['version']
+            for statement in self.schema_statements_for(server_version):
+                try:
+                    result = await session.run(statement)
+                    await result.consume()
+                except Exception:
+                    print("AsyncNeo4jLoader: Couldn't run schema statement: " + statement)
+                    raise
+            result = await session.run("CALL db.awaitIndexes(300)")
+            await result.consume()
+        print("AsyncNeo4jLoader: Schema is ready.")
+
+    @staticmethod
+    async def run_statements(tx, statements):
+        for query, parameters in statements:
+            result = await tx.run(query, parameters)
+            await result.consume()
+
+    def load_record(self, record):
+        self.event_loop.run(self.write_record(record))
+
+    def load_records(self, record_list):
+        ''' Writes the records one at a time, with up to max_in_flight transactions outstanding.
+        Returns a list with the id and error of every record that failed. '''
+        results = self.event_loop.run(run_limited(self.max_in_flight, [self.try_write_record(record) for record in record_list]))
+        return([failure for failure in results if failure is not None])
+
+    async def write_record(self, record):
+        async with self.connection.session() as session:
+            await session.execute_write(self.run_statements, [(self.neo4j_query_string, self.flatten_record(record))])
+
+    async def try_write_record(self, record):
+        try:
+            await self.write_record(record)
+        except Exception as e:
+            print("Couldn't load record with id: " + record['id_str'])
+            self.dead_letters.add([record], e)
+            return(failure_for_record(record, e))
+
+    def bulk_load_records(self, record_list):
+        ''' Same batches and failure report as Neo4jLoader.bulk_load_records(), with max_in_flight
+        batches being written at once. '''
+        starts = range(0, len(record_list), self.batch_size)
+        results = self.event_loop.run(run_limited(self.max_in_flight, [self.write_batch_async(start, record_list[start:start + self.batch_size])
+                                                                       for start in starts]))
+        fail_log = [failure for failure in results if failure is not None]
+        if fail_log:
             return(fail_log)
 
+    async def write_batch_async(self, start, batch):
+        try:
+            rows = self.flatten_records(batch)
+            async with self.connection.session() as session:
+                if self.dedupe_dimensions:
+                    tweet_rows, places, users = self.split_dimensions(rows)
+                    await session.execute_write(self.run_statements, self.batch_statements(tweet_rows, places, users))
+                    self.remember_dimensions(places, users)
+                else:
+                    await session.execute_write(self.run_statements, self.batch_statements(rows))
+        except Exception as e:
+            print("AsyncNeo4jLoader: Couldn't load batch starting at record " + str(start) + " because: " + str(e))
+            fail_dict = dict()
+            fail_dict['first_id'] = batch[0].get('id_str')
+            fail_dict['count'] = len(batch)
+            fail_dict['error'] = str(e)
+            self.dead_letters.add(batch, e)
+            return(fail_dict)
+
+    def close_connection(self):
+        self.event_loop.run(self.connection.close())
+        self.event_loop.stop()
+
+### FanOutLoader
+
+class FanOutLoader:
+    ''' Writes the same cleaned records to several databases at once, so they only have to be parsed
+    and cleaned once. Each target is a dictionary of Loader.get_connection() arguments, plus an optional
+    'name' to tell two targets of the same db_type apart, e.g.
+    [{"db_type": "mongodb", "db_host": "localhost", "db_port": "27017", "db_name": "twitter", "collection_name": "tweets"},
+     {"db_type": "elasticsearch", "db_host": "localhost", "db_port": "9200", "db_name": "twitter"}].
+
+    Every sink gets its own writer thread. The records are shared between the sinks rather than copied,
+    which works because the loaders only read them (MongoDBLoader is told to insert copies, since pymongo
+    adds an _id to what it inserts). A sink that fails doesn't stop the others: the load methods return a
+    result per sink (records, load time, failures and the error, if any), which the Loader writes to
+    loaded_files.txt as one entry per sink. The load methods take an optional list of sink_names to
+    load into instead of all of them, which the Loader uses to retry only the sinks that failed. '''
+
+    def __init__(self, targets, metrics=NO_METRICS, dead_letters=NO_DEAD_LETTERS):
+        self.targets = targets
+        self.metrics = metrics
+        self.dead_letters = dead_letters
+        self.sinks = dict()
+        self.executor = None
+
+    def initialize_connection(self):
+        for target in self.targets:
+            target = dict(target)
+            name = target.pop('name', target['db_type'])
+            if name in self.sinks:
+                raise ValueError("FanOutLoader: There are two targets named " + name + ", give them each a 'name'.")
+            sink = self.connect_sink(target)
+            if sink is None:
+                raise ValueError("FanOutLoader: Unknown db_type: " + str(target['db_type']))
+            if isinstance(sink, MongoDBLoader):
+                sink.copy_documents = True
+            sink.dead_letters = self.dead_letters.for_sink(name)
+            self.sinks[name] = sink
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.sinks))
+
+    def connect_sink(self, target):
+        sink_loader = Loader(None, None, None, metrics=self.metrics, dead_letters=self.dead_letters)
+        sink_loader.get_connection(**target)
+        return(sink_loader.db_connection)
+
+    def load_records(self, record_list, sink_names=None):
+        ''' Writes the records to every sink one at a time (as Loader.load_data() does), with the sinks
+        running in parallel. Returns a result per sink. '''
+        futures = dict()
+        for name in (self.sinks if sink_names is None else sink_names):
+            futures[name] = self.executor.submit(self.write_to_sink, name, record_list, False)
+        return(dict((name, future.result()) for name, future in futures.items()))
+
+    def bulk_load_records(self, record_list, sink_names=None):
+        ''' Bulk loads the records into every sink in parallel and returns a result per sink once they
+        have all finished. '''
+        futures = dict()
+        for name in (self.sinks if sink_names is None else sink_names):
+            futures[name] = self.executor.submit(self.write_to_sink, name, record_list, True)
+        return(dict((name, future.result()) for name, future in futures.items()))
+
+    def load_stream(self, chunks, sink_names=None):
+        ''' Bulk loads an iterable of chunks into every sink and returns the combined result per sink.
+        Each sink writes its chunks in order, one at a time, but doesn't wait for the other sinks, so a
+        fast sink can get a chunk ahead of the slowest one while the next chunk is being cleaned. Once a
+        sink has failed, the rest of the chunks are counted as failures for it rather than sent. '''
+        totals = dict()
+        pending = dict()
+        for chunk in chunks:
+            for name in (self.sinks if sink_names is None else sink_names):
+                if name in pending:
+                    merge_sink_results(totals, {name: pending.pop(name).result()})
+                if name in totals and totals[name]['error'] is not None:
+                    merge_sink_results(totals, {name: sink_result(len(chunk), 0.0, len(chunk))})
+                else:
+                    pending[name] = self.executor.submit(self.write_to_sink, name, chunk, True)
+        for name, future in pending.items():
+            merge_sink_results(totals, {name: future.result()})
+        return(totals)
+
+    def flush_sinks(self, sink_results):
+        ''' Has the sinks in sink_results that hold on to records (see Loader.flush()) write them now,
+        and adds the records that fail, or the error, to their results. '''
+        for name, result in sink_results.items():
+            sink = self.sinks[name]
+            if not hasattr(sink, 'flush') or result['error'] is not None:
+                continue
+            begin = time.time()
+            try:
+                fail_count = sum(failure['count'] for failure in (sink.flush() or []))
+                merge_sink_results(sink_results, {name: sink_result(0, time.time() - begin, fail_count)})
+            except Exception as e:
+                print("FanOutLoader: Couldn't flush " + name + " because: " + str(e))
+                merge_sink_results(sink_results, {name: sink_result(0, time.time() - begin, 0, type(e).__name__ + ": " + str(e))})
+        return(sink_results)
+
+    def write_to_sink(self, name, record_list, bulk):
+        sink = self.sinks[name]
+        begin = time.time()
+        try:
+            if bulk:
+                fail_log = sink.bulk_load_records(record_list)
+                if getattr(sink, 'counts_failures', False):
+                    fail_count = sum(failure['count'] for failure in (fail_log or []))
+                else:
+                    fail_count = 'NA'
+            elif hasattr(sink, 'load_records'):
+                fail_count = len(sink.load_records(record_list))
+            else:
+                fail_count = 0
+                for record in record_list:
+                    try:
+                        sink.load_record(record)
+                    except Exception as e:
+                        fail_count += 1
+                        sink.dead_letters.add([record], e)
+            result = sink_result(len(record_list), time.time() - begin, fail_count)
+        except Exception as e:
+            print("FanOutLoader: Couldn't load records into " + name + " because: " + str(e))
+            result = sink_result(len(record_list), time.time() - begin, len(record_list), type(e).__name__ + ": " + str(e))
+        self.metrics.record("load." + name, result['load_time'], len(record_list))
+        return(result)
+
     def close_connection(self):
-        pass # the Elasticsearch Python driver doesn't implement a connection close method
+        for sink in self.sinks.values():
+            sink.close_connection()
+        self.executor.shutdown()
+
+    def close_after_failure(self):
+        try:
+            for sink in self.sinks.values():
+                close_after_failure(sink)
+        finally:
+            self.executor.shutdown()
+
+def sink_result(record_count, load_time, fail_count, error=None):
+    result = dict()
+    result['record_count'] = record_count
+    result['load_time'] = load_time
+    result['fail_count'] = fail_count
+    result['error'] = error
+    return(result)
+
+def merge_sink_results(totals, results):
+    ''' Adds a result per sink (from FanOutLoader) to running totals per sink, keeping the first error.
+    A fail_count of 'NA' from any chunk makes the total 'NA'. '''
+    for name, result in results.items():
+        if name not in totals:
+            totals[name] = sink_result(0, 0.0, 0)
+        total = totals[name]
+        total['record_count'] += result['record_count']
+        total['load_time'] += result['load_time']
+        if total['fail_count'] == 'NA' or result['fail_count'] == 'NA':
+            total['fail_count'] = 'NA'
+        else:
+            total['fail_count'] += result['fail_count']
+        if total['error'] is None:
+            total['error'] = result['error']
+    return(totals)
+
+def add_counts(file_progress, counts):
+    ''' Adds a chunk's (success count, fail count) from Loader.count_batch_results() to a file's totals.
+    An 'NA' from any chunk makes the totals 'NA'. '''
+    success_count, fail_count = counts
+    if file_progress['success_count'] == 'NA' or success_count == 'NA':
+        file_progress['success_count'] = 'NA'
+        file_progress['fail_count'] = 'NA'
+    else:
+        file_progress['success_count'] += success_count
+        file_progress['fail_count'] += fail_count
+
+
+## Pipeline
+
+def _parse_clean_worker(extractor, chunk_size, file_queue, batch_queue, compact=False, spatial_filter=None):
+    ''' Worker process: takes file names off the file queue, streams and cleans each file in chunks,
+    and puts the cleaned chunks (less any records the spatial filter drops) on the (bounded) batch queue. Blocks when the loaders fall behind. Ends
+    each file with a 'done' message carrying the number of chunks it produced. Each worker writes its
+    own metrics (if the extractor's are enabled) when it finishes. '''
+    if spatial_filter is not None:
+        spatial_filter.metrics = extractor.metrics
+    while True:
+        file_name = file_queue.get()
+        if file_name is None:
+            break
+        try:
+            chunks = extractor.stream_file(file_name, chunk_size)
+            cleaner = Cleaner(chunks, file_name, extractor.logs_path, metrics=extractor.metrics, compact=compact)
+            cleaned_chunks = cleaner.clean_stream()
+            if spatial_filter is not None:
+                cleaned_chunks = spatial_filter.filter_stream(cleaned_chunks)
+            chunk_count = 0
+            for chunk in cleaned_chunks:
+                batch_queue.put(('batch', file_name, chunk))
+                chunk_count += 1
+            batch_queue.put(('done', file_name, chunk_count))
+        except Exception as e:
+            batch_queue.put(('error', file_name, str(e)))
+    extractor.metrics.write("parse_clean_worker-" + str(os.getpid()))
+
+def _load_worker(logs_path, connection_args, batch_queue, result_queue, metrics_enabled=False):
+    ''' Worker process: opens one database connection for the whole run, then loads cleaned chunks
+    off the batch queue until it receives a None sentinel. Reports each loaded chunk (and forwards
+    'done'/'error' messages from the cleaners) to the result queue. '''
+    loader = Loader(None, None, logs_path, metrics=Metrics(logs_path, enabled=metrics_enabled))
+    loader.get_connection(**connection_args)
+    sink_names = dict() # for each file, the sinks of a FanOutLoader it still has to be loaded into (or None)
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            break
+        message_type, file_name, payload = item
+        if message_type != 'batch':
+            result_queue.put(item)
+            continue
+        begin = time.time()
+        try:
+            if file_name not in sink_names:
+                # The first chunk of a file this worker has seen
+                loader.file_name = file_name
+                loader.force_idempotent_reload()
+                sink_names[file_name] = loader.pending_sinks() if isinstance(loader.db_connection, FanOutLoader) else None
+            with loader.metrics.timer("load", len(payload)):
+                if isinstance(loader.db_connection, FanOutLoader):
+                    fail_log = loader.db_connection.bulk_load_records(payload, sink_names[file_name]) # a result per sink
+                elif hasattr(loader.db_connection, 'bulk_load_records'):
+                    fail_log = loader.db_connection.bulk_load_records(payload)
+                else:
+                    for record in payload:
+                        loader.db_connection.load_record(record)
+                    fail_log = None
+            if isinstance(loader.db_connection, FanOutLoader):
+                counts = None # each sink's result has its own
+            else:
+                counts = loader.count_batch_results(len(payload), fail_log)
+            result_queue.put(('loaded', file_name, (len(payload), time.time() - begin, fail_log, counts)))
+        except Exception as e:
+            result_queue.put(('error', file_name, str(e)))
+    loader.close_connection()
+    ElasticSearchLoader.restore_all_indices()
+    loader.metrics.write("load_worker-" + str(os.getpid()))
+
+class Pipeline:
+    ''' Runs Extract -> Clean -> Load over every pending file in an Extractor's checkpoint store using
+    several processes. A pool of parse/clean worker processes streams files in chunks and hands the
+    cleaned chunks to load worker processes over a bounded queue, so parsing blocks (backpressure)
+    when the database can't keep up. The main process collects results, updates the checkpoint store
+    and writes the per-file entries to loaded_files.txt in the same order the files were queued.
+
+    connection_args are the keyword arguments for Loader.get_connection(), e.g.
+    {"db_type": "mongodb", "db_host": "localhost", "db_port": "27017", "db_name": "twitter", "collection_name": "tweets"}.
+    With compact=True, the cleaned chunks are CompactTweets, which are also much cheaper to send
+    between processes. With a SpatialFilter, only the records inside its regions are loaded. With
+    db_type "multi" (a FanOutLoader), each file gets an entry per sink in loaded_files.txt. '''
+
+    # How long collect_results() waits for a result before it checks that the workers are still alive
+    poll_interval = 1.0
+
+    def __init__(self, extractor, connection_args, clean_workers=None, load_workers=2, chunk_size=5000, queue_size=8,
+                 compact=False, spatial_filter=None):
+        self.extractor = extractor
+        self.connection_args = connection_args
+        self.clean_workers = clean_workers if clean_workers is not None else max(1, multiprocessing.cpu_count() - load_workers)
+        self.load_workers = load_workers
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.compact = compact
+        self.spatial_filter = spatial_filter
+
+    def run(self):
+        checkpoints = self.extractor.checkpoints
+        files_to_load = []
+        next_file_name = checkpoints.claim_next()
+        while next_file_name is not None:
+            files_to_load.append(next_file_name)
+            next_file_name = checkpoints.claim_next()
+        if not files_to_load:
+            print("Pipeline: No files to load.")
+            return
+        print("Pipeline: Loading " + str(len(files_to_load)) + " files with " + str(self.clean_workers)
+              + " parse/clean workers and " + str(self.load_workers) + " load workers.")
+
+        file_queue = multiprocessing.Queue()
+        batch_queue = multiprocessing.Queue(maxsize=self.queue_size) # bounded, to apply backpressure
+        result_queue = multiprocessing.Queue()
+
+        for file_name in files_to_load:
+            file_queue.put(file_name)
+        for _ in range(self.clean_workers):
+            file_queue.put(None)
+
+        clean_processes = [multiprocessing.Process(target=_parse_clean_worker,
+                                                   args=(self.extractor, self.chunk_size, file_queue, batch_queue, self.compact,
+                                                         self.spatial_filter))
+                           for _ in range(self.clean_workers)]
+        load_processes = [multiprocessing.Process(target=_load_worker,
+                                                  args=(self.extractor.logs_path, self.connection_args, batch_queue, result_queue,
+                                                        self.extractor.metrics.enabled))
+                          for _ in range(self.load_workers)]
+        for process in clean_processes + load_processes:
+            process.start()
+
+        try:
+            self.collect_results(files_to_load, result_queue, clean_processes + load_processes)
+        except:
+            # Don't leave workers blocked on a full queue behind us
+            for process in clean_processes + load_processes:
+                process.terminate()
+            raise
+        else:
+            for process in clean_processes:
+                process.join()
+            for _ in range(self.load_workers):
+                batch_queue.put(None)
+            for process in load_processes:
+                process.join()
+
+        print("Pipeline: Finished. File states: " + json.dumps(checkpoints.get_counts()))
+
+    def collect_results(self, files_to_load, result_queue, processes):
+        ''' Tallies loaded chunks per file. A file is complete once its cleaner has reported how many
+        chunks it produced and that many chunks have been loaded, or as soon as any of its chunks fails.
+        Completed files are logged strictly in the order they were queued, with the success and failure
+        counts of their chunks added up. Failed files are marked as failed in the checkpoint store and
+        don't hold up the rest of the run.
+
+        While it waits for results, it checks every poll_interval seconds that none of the worker
+        processes has died (e.g. a load worker that couldn't connect, or one killed for running out
+        of memory); its chunks would never arrive, and the workers feeding the bounded batch queue
+        would block for good. If one has, the files that haven't finished are marked as failed and a
+        RuntimeError is raised, so run() can stop the rest of the workers. '''
+        progress = dict()
+        for file_name in files_to_load:
+            progress[file_name] = {'chunks': None, 'chunks_loaded': 0, 'load_time': 0.0, 'fail_log': [], 'sinks': dict(), 'error': None,
+                                   'success_count': 0, 'fail_count': 0}
+        fan_out = self.connection_args.get('db_type') == "multi"
+        next_to_log = 0
+
+        while next_to_log < len(files_to_load):
+            try:
+                message_type, file_name, payload = result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead_processes = [process for process in processes if process.exitcode not in (None, 0)]
+                if dead_processes:
+                    self.fail_unfinished(files_to_load[next_to_log:], progress, fan_out)
+                    raise RuntimeError("Pipeline: Worker process " + str(dead_processes[0].pid) + " exited with code "
+                                       + str(dead_processes[0].exitcode) + "; stopped the load.")
+                continue
+            file_progress = progress[file_name]
+            if message_type == 'error':
+                print("Pipeline: Couldn't load file " + file_name + " because: " + payload)
+                if file_progress['error'] is None:
+                    file_progress['error'] = payload
+            elif message_type == 'done':
+                file_progress['chunks'] = payload
+            elif message_type == 'loaded':
+                record_count, load_time, fail_log, counts = payload
+                file_progress['chunks_loaded'] += 1
+                file_progress['load_time'] += load_time
+                if fan_out:
+                    merge_sink_results(file_progress['sinks'], fail_log)
+                else:
+                    if fail_log is not None:
+                        file_progress['fail_log'].append(fail_log)
+                    add_counts(file_progress, counts)
+
+            # Log every file at the front of the list that has finished loading
+            while next_to_log < len(files_to_load):
+                if not self.log_file(files_to_load[next_to_log], progress[files_to_load[next_to_log]], fan_out):
+                    break
+                next_to_log += 1
+
+    def log_file(self, file_name, file_progress, fan_out):
+        ''' Logs a file that has failed or finished loading, and returns whether it had. '''
+        loader = Loader(None, file_name, self.extractor.logs_path)
+        if file_progress['error'] is not None:
+            loader.log_failure()
+        elif file_progress['chunks'] is not None and file_progress['chunks_loaded'] >= file_progress['chunks']:
+            print("Pipeline: Finished loading file: " + file_name)
+            if fan_out:
+                loader.log_sink_loads(file_progress['sinks'])
+            else:
+                loader.log_load(file_progress['load_time'], file_progress['success_count'], file_progress['fail_count'],
+                                file_progress['fail_log'])
+        else:
+            return(False)
+        return(True)
+
+    def fail_unfinished(self, file_names, progress, fan_out):
+        ''' After a worker has died: logs the files that did finish, and marks the rest as failed, so
+        they can be loaded again with CheckpointStore.retry_failed(). '''
+        for file_name in file_names:
+            if not self.log_file(file_name, progress[file_name], fan_out):
+                print("Pipeline: Marking unfinished file as failed: " + file_name)
+                Loader(None, file_name, self.extractor.logs_path).log_failure()
+
+
+if __name__ == "__main__":
+    # Replays dead-lettered records, e.g.
+    #     python Clean_Load_Scripts.py retry-dead-letters ./logs '{"db_type": "mongodb", "db_host": "localhost",
+    #         "db_port": "27017", "db_name": "twitter", "collection_name": "tweets"}'
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract, clean and load scripts.")
+    subparsers = parser.add_subparsers(dest="command")
+    retry_parser = subparsers.add_parser("retry-dead-letters", help="replay the records that failed to load")
+    retry_parser.add_argument("logs_path")
+    retry_parser.add_argument("connection_args", help="Loader.get_connection() arguments as a JSON object")
+    retry_parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+    if args.command == "retry-dead-letters":
+        print(json.dumps(retry_dead_letters(args.logs_path, json.loads(args.connection_args), chunk_size=args.chunk_size)))
+    else:
+        parser.print_help()